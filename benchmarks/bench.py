@@ -0,0 +1,239 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Benchmark the virt-up overhead against the libvirt test driver.
+
+The external tools are replaced with the stub commands in the stubs
+directory, and the virt-install command is replaced in-process to define
+the domains in the libvirt test driver, so no hypervisor or images are
+required. Each scenario reports the wall time, the number of libvirt API
+calls (the RPC count on a remote driver), and the peak python memory.
+
+usage: python benchmarks/bench.py [--sizes 10,100,1000] [--json]
+"""
+
+import argparse
+import functools
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The environment must be setup before virt_up is imported.
+basedir = pathlib.Path(__file__).resolve().parent
+workdir = pathlib.Path(tempfile.mkdtemp(prefix='virt-up-bench-'))
+os.environ['PATH'] = f"{basedir / 'stubs'}:{os.environ['PATH']}"
+os.environ['LIBVIRT_DEFAULT_URI'] = 'test:///default'
+os.environ['VIRTUP_CONFIG_HOME'] = str(workdir / 'config')
+os.environ['VIRTUP_DATA_HOME'] = str(workdir / 'data')
+os.environ['VIRTUP_NO_DAEMON'] = '1'
+sys.path.insert(0, str(basedir.parent))
+
+import libvirt
+import virt_up.cli
+import virt_up.instance
+from virt_up.instance import Instance
+from virt_up.instance import Settings
+
+POOL = 'bench'
+TEMPLATE = 'bench/template0'
+
+class CallCounter:
+    """
+    Count the libvirt API calls.
+    """
+    classes = ('virConnect', 'virDomain', 'virStoragePool', 'virStorageVol')
+
+    def __init__(self):
+        self.count = 0
+        for name in self.classes:
+            cls = getattr(libvirt, name)
+            for attr, func in list(vars(cls).items()):
+                if attr.startswith('_') or not callable(func):
+                    continue
+                setattr(cls, attr, self._wrap(func))
+        libvirt.open = self._wrap(libvirt.open)
+
+    def _wrap(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.count += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+def write_settings(templates):
+    """
+    Write the common settings and the template definitions.
+    """
+    config = workdir / 'config'
+    (config / 'templates.d').mkdir(parents=True, exist_ok=True)
+    (config / 'settings.cfg').write_text(
+        '[common]\n'
+        f'pool = {POOL}\n'
+        'memory = 128\n'
+        'vcpus = 1\n'
+        'admission = no\n'
+    )
+    with open(config / 'templates.d' / 'bench.cfg', 'w') as fp:
+        for i in range(templates):
+            fp.write(f'[bench/template{i}]\n'
+                     f'desc = Benchmark template {i}\n'
+                     'os-version = centos-8.2\n'
+                     'os-variant = centos8\n'
+                     'arch = x86_64\n\n')
+
+def define_pool(conn):
+    """
+    Define a transient storage pool in the test driver for the images.
+    """
+    path = workdir / 'images'
+    path.mkdir(exist_ok=True)
+    return conn.storagePoolCreateXML(
+        f"<pool type='dir'><name>{POOL}</name>"
+        f"<target><path>{path}</path></target></pool>", 0)
+
+def fake_virt_install(*args, **kwargs):
+    """
+    Stand-in for virt-install to define and start a test driver domain.
+    """
+    opts = {}
+    args = [str(a) for a in args]
+    for i, arg in enumerate(args):
+        if arg.startswith('--') and i + 1 < len(args) and not args[i + 1].startswith('--'):
+            opts[arg[2:]] = args[i + 1]
+    name = opts['name']
+    disk = opts['disk']
+    mac = f"<mac address='{opts['mac']}'/>" if 'mac' in opts else ''
+    xml = f"""
+    <domain type='test'>
+      <name>{name}</name>
+      <memory unit='MiB'>{opts.get('memory', 128)}</memory>
+      <vcpu>{opts.get('vcpus', 1)}</vcpu>
+      <os><type>hvm</type></os>
+      <devices>
+        <disk type='file' device='disk'>
+          <source file='{disk}'/>
+          <target dev='vda'/>
+        </disk>
+        <interface type='network'>
+          {mac}
+          <source network='default'/>
+        </interface>
+      </devices>
+    </domain>"""
+    with virt_up.instance.Connection() as conn:
+        pool = conn.storagePoolLookupByName(POOL)
+        pool.createXML(f"<volume><name>{os.path.basename(disk)}</name>"
+                       "<capacity>1</capacity></volume>", 0)
+        domain = conn.defineXML(xml)
+        domain.create()
+
+def measure(name, size, func, counter):
+    """
+    Run one scenario and return the results.
+    """
+    tracemalloc.start()
+    calls = counter.count
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'scenario': name,
+        'size': size,
+        'wall': round(elapsed, 4),
+        'calls': counter.count - calls,
+        'peak_mib': round(peak / (1024 * 1024), 2),
+    }
+
+def run(size, counter, deletes):
+    """
+    Run the scenarios with size instances.
+    """
+    results = []
+    write_settings(size)
+    prefix = f'bench{size}-'
+    base = None
+    def build():
+        nonlocal base
+        base = Instance.build(TEMPLATE, prefix=prefix)
+    def clone():
+        for i in range(size):
+            base.clone(f'{prefix}{i}')
+    def all_():
+        list(Instance.all())
+    def inventory():
+        Instance.update_inventory()
+    def list_():
+        virt_up.cli.main.main(['-q', 'list'], standalone_mode=False)
+    def list_long():
+        virt_up.cli.main.main(['-q', 'list', '--long'], standalone_mode=False)
+    def delete():
+        for i in range(min(deletes, size)):
+            Instance(f'{prefix}{i}').delete()
+    def settings():
+        list(Settings.all())
+
+    results.append(measure('build', 1, build, counter))
+    results.append(measure('clone', size, clone, counter))
+    results.append(measure('Instance.all', size, all_, counter))
+    results.append(measure('update_inventory', size, inventory, counter))
+    results.append(measure('list', size, list_, counter))
+    results.append(measure('list --long', size, list_long, counter))
+    results.append(measure(f'delete x{min(deletes, size)}', size, delete, counter))
+    results.append(measure('Settings.all', size, settings, counter))
+
+    # Cleanup for the next size.
+    for instance in list(Instance.all()):
+        if instance.is_clone():
+            instance.delete()
+    base.delete()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark virt-up against the libvirt test driver.')
+    parser.add_argument('--sizes', default='10,100,1000', help='Comma separated instance counts.')
+    parser.add_argument('--deletes', type=int, default=10, help='Number of instances to delete.')
+    parser.add_argument('--json', action='store_true', help='Print results as json.')
+    args = parser.parse_args()
+
+    keeper = libvirt.open('test:///default') # Keep the test driver state.
+    define_pool(keeper)
+    virt_up.instance.virt_install = fake_virt_install
+    counter = CallCounter()
+    results = []
+    for size in [int(s) for s in args.sizes.split(',')]:
+        results.extend(run(size, counter, args.deletes))
+    keeper.close()
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print(f"{'# scenario': <20} {'size': >6} {'wall (s)': >10} {'calls': >8} {'peak (MiB)': >11}")
+        for r in results:
+            print(f"{r['scenario']: <20} {r['size']: >6} {r['wall']: >10.4f} {r['calls']: >8} {r['peak_mib']: >11.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -22,12 +22,15 @@ setup(
     install_requires=[
         'Click',
         'libvirt-python',
-        'sh',
     ],
+    extras_require={
+        'fleet': ['PyYAML'],
+    },
     entry_points={
         'console_scripts': [
             'virt-up=%s.cli:main' % name,
             'vu=%s.cli:main' % name,
+            'virt-up-inventory=%s.inventory:main' % name,
         ],
     },
     classifiers=[
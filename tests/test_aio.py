@@ -0,0 +1,48 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+import asyncio
+
+from virt_up import aio
+from virt_up.instance import Instance
+
+def test_aio_clones(config_files):
+    async def main():
+        base = await aio.build('generic/centos8', prefix='__TEST_AIO__')
+        names = [f'_test_virt_up_aio_{i}' for i in range(3)]
+        clones = await asyncio.gather(*[base.clone(n) for n in names])
+        try:
+            results = await asyncio.gather(*[c.run_command('hostname') for c in clones])
+            for clone, (code, out, err) in zip(clones, results):
+                assert(code == 0)
+                assert(out.strip() == clone.name)
+                assert(Instance(clone.name).meta['address'] == await clone.address())
+            await asyncio.gather(*[c.stop() for c in clones])
+            assert(not any(c.domain.isActive() for c in clones))
+            await clones[0].start()
+            assert(await clones[0].wait_for_port(22))
+            assert((await aio.lookup(names[0])).name == names[0])
+        finally:
+            await asyncio.gather(*[c.delete() for c in clones])
+            await base.delete()
+        for name in names:
+            assert(not Instance.exists(name))
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+import logging
+import os
+import socket
+import types
+
+import click
+
+from virt_up.daemon import Client
+from virt_up.daemon import Job
+from virt_up.daemon import _ClientLogHandler
+from virt_up.daemon import command_name
+from virt_up.daemon import peer_uid
+
+def test_command_name():
+    assert(command_name(['-d', 'list', '--all']) == 'list')
+    assert(command_name(['--quiet', 'show', 'paths']) == 'show')
+    assert(command_name(['--version']) is None)
+
+def test_connect_not_running(tmp_path):
+    assert(Client.connect(str(tmp_path / 'virt-up.sock')) is None)
+
+def test_connect_owner(tmp_path, monkeypatch):
+    path = str(tmp_path / 'virt-up.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    try:
+        client = Client.connect(path)
+        assert(client is not None)
+        assert(peer_uid(client.sock) == os.getuid())
+        client.sock.close()
+        # A socket of another user is not used.
+        uid = os.getuid() + 1
+        monkeypatch.setattr(os, 'getuid', lambda: uid)
+        assert(Client.connect(path) is None)
+    finally:
+        server.close()
+
+def test_absolute_paths(tmp_path, monkeypatch):
+    from virt_up import cli
+    (tmp_path / 'fleet.yaml').write_text('instances: []\n')
+    monkeypatch.chdir(tmp_path)
+    ctx = click.Context(cli.main)
+    fleet = str(tmp_path / 'fleet.yaml')
+    assert(cli._absolute_paths(ctx, ['-d', 'up', '-j', '2', 'fleet.yaml']) ==
+           ['-d', 'up', '-j', '2', fleet])
+    # Playbooks not found here are searched for by the command.
+    assert(cli._absolute_paths(ctx, ['playbook', 'fleet.yaml', 'site.yaml']) ==
+           ['playbook', 'fleet.yaml', 'site.yaml'])
+    assert(cli._absolute_paths(ctx, ['list', '--long']) == ['list', '--long'])
+
+def test_job_thread_output(monkeypatch):
+    from virt_up import cli
+    from virt_up.instance import Instance
+    @click.command()
+    def fake_main():
+        log = logging.getLogger('virt_up.test')
+        instances = [types.SimpleNamespace(name=n, start=lambda n=n: log.info(f"Instance '{n}' is up."))
+                     for n in ('a', 'b')]
+        Instance.start_all(instances, jobs=2)
+    monkeypatch.setattr(cli, 'main', fake_main)
+    messages = []
+    handler = _ClientLogHandler()
+    root = logging.getLogger()
+    level = root.level
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    try:
+        assert(Job([], messages.append).run() == 0)
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(level)
+    assert(sorted(m['err'] for m in messages) == ["Instance 'a' is up.\n", "Instance 'b' is up.\n"])
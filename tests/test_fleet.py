@@ -0,0 +1,157 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+import threading
+import types
+
+import pytest
+
+import virt_up.fleet
+from virt_up.fleet import Fleet
+
+def test_fleet_members():
+    fleet = Fleet({
+        'defaults': {'memory': 1024},
+        'instances': [
+            {'name': 'web', 'template': 'generic/centos8', 'count': 3},
+            {'name': 'db', 'template': 'generic/debian10', 'vcpus': 2, 'dns-domain': 'example.com'},
+        ],
+    })
+    assert(sorted(fleet.members) == ['db', 'web1', 'web2', 'web3'])
+    template, options = fleet.members['db']
+    assert(template == 'generic/debian10')
+    assert(options['memory'] == 1024)
+    assert(options['vcpus'] == 2)
+    assert(options['dns_domain'] == 'example.com')
+    assert(fleet.templates() == ['generic/centos8', 'generic/debian10'])
+
+def test_fleet_duplicate_names():
+    with pytest.raises(ValueError):
+        Fleet({'instances': [
+            {'name': 'web1', 'template': 'generic/centos8'},
+            {'name': 'web', 'template': 'generic/centos8', 'count': 2},
+        ]})
+
+def test_fleet_unsupported_option():
+    with pytest.raises(ValueError):
+        Fleet({'instances': [{'name': 'web', 'template': 'generic/centos8', 'disk': 'x'}]})
+
+def test_fleet_load_json(tmp_path):
+    path = tmp_path / 'fleet.json'
+    path.write_text('{"instances": [{"name": "web", "template": "generic/centos8"}]}')
+    fleet = Fleet.load(str(path))
+    assert(list(fleet.members) == ['web'])
+
+class FakeInstance:
+    """
+    Record the calls made by the fleet scheduler.
+    """
+    existing = []
+    calls = []
+    lock = threading.Lock()
+
+    def __init__(self, name, meta):
+        self.name = name
+        self.meta = meta
+
+    @classmethod
+    def _call(cls, *call):
+        with cls.lock:
+            cls.calls.append(call)
+
+    @classmethod
+    def all(cls):
+        return list(cls.existing)
+
+    @classmethod
+    def build(cls, template, prefix='VIRTUP-'):
+        cls._call('build', template)
+        if template == 'broken':
+            raise RuntimeError('build failed')
+        return cls(f'{prefix}{template}', {'template': template})
+
+    def is_clone(self):
+        return 'cloned' in self.meta
+
+    def is_template(self):
+        return 'cloned' not in self.meta
+
+    def stop(self):
+        self._call('stop', self.name)
+
+    def save_state(self):
+        self._call('save_state', self.name)
+
+    def prefetch(self):
+        self._call('prefetch', self.name)
+
+    def clone(self, name, provision=True, **options):
+        assert(not provision)
+        self._call('clone', self.name, name)
+        return FakeInstance(name, {'template': self.meta['template'], 'cloned': 'now'})
+
+    def wait_for_port(self, port):
+        pass
+
+    def provision(self, clones, inventory=False, snapshot=None):
+        self._call('provision', self.name, tuple(sorted(c.name for c in clones)))
+
+@pytest.fixture
+def fake_instance(monkeypatch):
+    FakeInstance.existing = []
+    FakeInstance.calls = []
+    monkeypatch.setattr(virt_up.fleet, 'Instance', FakeInstance)
+    monkeypatch.setattr(virt_up.fleet, 'Settings',
+                        lambda template: types.SimpleNamespace(restore=True, prefetch=False))
+    return FakeInstance
+
+def test_fleet_plan(fake_instance):
+    fake_instance.existing = [
+        FakeInstance('web1', {'template': 'a', 'cloned': 'now'}),
+        FakeInstance('db', {'template': 'other', 'cloned': 'now'}),
+        FakeInstance('VIRTUP-a', {'template': 'a'}),
+    ]
+    fleet = Fleet({'instances': [
+        {'name': 'web', 'template': 'a', 'count': 2},
+        {'name': 'db', 'template': 'b'},
+    ]})
+    assert(fleet.plan() == (['web2'], ['web1'], ['db']))
+
+def test_fleet_up(fake_instance):
+    fleet = Fleet({'prefix': 'T-', 'instances': [
+        {'name': 'web', 'template': 'a', 'count': 3},
+        {'name': 'db', 'template': 'b'},
+        {'name': 'bad', 'template': 'broken'},
+    ]})
+    errors = fleet.up(jobs=4)
+    assert(sorted(errors) == ['bad'])
+    calls = fake_instance.calls
+    assert(sorted(c[1] for c in calls if c[0] == 'build') == ['a', 'b', 'broken'])
+    assert(sorted(c[2] for c in calls if c[0] == 'clone') == ['db', 'web1', 'web2', 'web3'])
+    # The base is stopped and saved once, before its clones.
+    for base in ('T-a', 'T-b'):
+        steps = [c[0] for c in calls if c[1] == base]
+        assert(steps.count('stop') == 1)
+        assert(steps.count('save_state') == 1)
+        assert(steps.index('save_state') < steps.index('clone'))
+    # The new clones of a base are provisioned together.
+    provisions = sorted(c[1:] for c in calls if c[0] == 'provision')
+    assert(provisions == [('T-a', ('web1', 'web2', 'web3')), ('T-b', ('db',))])
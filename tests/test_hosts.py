@@ -0,0 +1,92 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+import types
+
+import pytest
+
+from virt_up.instance import Admission
+from virt_up.instance import host_capacity
+from virt_up.instance import select_host
+
+NODE = """
+<node>
+  <cpu>
+    <mhz>2000</mhz>
+    <model>x86_64</model>
+    <nodes>1</nodes>
+    <sockets>1</sockets>
+    <cores>{cpus}</cores>
+    <threads>1</threads>
+    <active>{cpus}</active>
+  </cpu>
+  <memory>{memory}</memory>
+</node>
+"""
+
+@pytest.fixture
+def hosts(tmp_path):
+    """
+    Create libvirt test driver hosts with 2, 8, and 4 GiB of memory.
+    """
+    uris = []
+    for i, (memory, cpus) in enumerate([(2, 2), (8, 4), (4, 8)]):
+        path = tmp_path / f'host{i}.xml'
+        path.write_text(NODE.format(memory=memory * 2**20, cpus=cpus))
+        uris.append(f'test://{path}')
+    return uris
+
+def test_host_capacity(hosts):
+    free, cpus = host_capacity(hosts[0])
+    assert(0 < free <= 2048)
+    assert(cpus == 2)
+
+def test_select_host_most_free_memory(hosts):
+    assert(select_host(hosts, 1024, 1) == hosts[1])
+
+def test_select_host_enough_cpus(hosts):
+    assert(select_host(hosts, 1024, 6) == hosts[2])
+
+def test_select_host_skips_unavailable(hosts, tmp_path):
+    missing = f"test://{tmp_path / 'missing.xml'}"
+    assert(select_host([missing] + hosts, 1024, 1) == hosts[1])
+
+def test_select_host_none_available(tmp_path):
+    with pytest.raises(ConnectionError):
+        select_host([f"test://{tmp_path / 'missing.xml'}"], 1024, 1)
+
+def admission_settings(timeout=0):
+    return types.SimpleNamespace(admission=True, admission_timeout=timeout, cpu_overcommit=1.0)
+
+def test_admission(hosts):
+    with Admission('test', hosts[1], 1024, 2, admission_settings()):
+        pass
+
+def test_admission_exceeds_host_memory(hosts):
+    with pytest.raises(ValueError):
+        with Admission('test', hosts[0], 4096, 1, admission_settings()):
+            pass
+
+def test_admission_timeout(hosts):
+    with pytest.raises(TimeoutError) as e:
+        with Admission('test', hosts[0], 1024, 4, admission_settings()):
+            pass
+    assert('needs 4 vcpus' in str(e.value))
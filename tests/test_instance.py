@@ -18,16 +18,27 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import contextlib
 import os
+import threading
+import types
 
 import pytest
 
+import virt_up.instance
 from virt_up.instance import virtup_data_home
 from virt_up.instance import query_storage_pool
+from virt_up.instance import select_storage_pool
 from virt_up.instance import MacAddresses
 from virt_up.instance import Creds
 from virt_up.instance import Settings
 from virt_up.instance import Instance
+from virt_up.instance import LockFile
+from virt_up.instance import Timings
+from virt_up.instance import write_atomic
+from virt_up.instance import prefetch_file
+from virt_up.instance import virt_builder_cache
+from virt_up.instance import prefetch_templates
 
 def remove_file(path):
     if os.path.exists(path) and os.path.isfile(path):
@@ -37,6 +48,80 @@ def remove_dir(path):
     if os.path.exists(path) and os.path.isdir(path):
         os.removedirs(path)
 
+def test_write_atomic(tmp_path):
+    path = tmp_path / 'instance' / 'test.json'
+    write_atomic(str(path), '{"a": 1}')
+    write_atomic(str(path), '{"a": 2}')
+    assert(path.read_text() == '{"a": 2}')
+    assert(oct(path.stat().st_mode & 0o777) == oct(0o600))
+    assert(os.listdir(path.parent) == ['test.json'])
+
+def test_prefetch_file(tmp_path):
+    path = tmp_path / 'sparse.img'
+    with open(path, 'wb') as f:
+        f.write(b'x' * 65536)
+        f.seek(64 * 2**20)
+        f.write(b'x' * 65536)
+    # Only the allocated extents are read, when holes are supported.
+    assert(2 * 65536 <= prefetch_file(str(path)) <= path.stat().st_size)
+    empty = tmp_path / 'empty.img'
+    empty.write_bytes(b'')
+    assert(prefetch_file(str(empty)) == 0)
+
+def test_virt_builder_cache(monkeypatch):
+    def fake_virt_builder(*args, _out=None, **kwargs):
+        assert(args == ('--print-cache',))
+        _out.write('cache directory: /var/cache/virt-builder\n'
+                   'centos-8.2               x86_64     cached\n'
+                   'debian-10                x86_64     no\n'
+                   'fedora-32                aarch64    cached\n')
+    monkeypatch.setattr(virt_up.instance, 'virt_builder', fake_virt_builder)
+    directory, cached = virt_builder_cache()
+    assert(directory == '/var/cache/virt-builder')
+    assert(cached == {('centos-8.2', 'x86_64'), ('fedora-32', 'aarch64')})
+
+def test_prefetch_templates(tmp_path, monkeypatch):
+    downloads = []
+    def fake_virt_builder(*args, _out=None, **kwargs):
+        if args == ('--print-cache',):
+            _out.write(f'cache directory: {tmp_path}/cache\n'
+                       'centos-8.2               x86_64     cached\n'
+                       'fedora-32                aarch64    cached\n')
+        else:
+            downloads.append(args[:3])
+    monkeypatch.setattr(virt_up.instance, 'virt_builder', fake_virt_builder)
+    monkeypatch.setattr(virt_up.instance, 'virtup_data_home', str(tmp_path))
+    monkeypatch.setattr(os, 'uname', lambda: types.SimpleNamespace(machine='x86_64'))
+    templates = [
+        types.SimpleNamespace(template_name='a', os_version='centos-8.2', arch=''),
+        types.SimpleNamespace(template_name='b', os_version='fedora-32', arch='aarch64'),
+        types.SimpleNamespace(template_name='c', os_version='fedora-32', arch='x86_64'),
+        types.SimpleNamespace(template_name='d', os_version='centos-8.2', arch='x86_64'),
+    ]
+    entries = prefetch_templates(templates)
+    assert([(e['os_version'], e['arch'], e['templates'], e['cached']) for e in entries] == [
+        ('centos-8.2', 'x86_64', ['a', 'd'], True),
+        ('fedora-32', 'aarch64', ['b'], True),
+        ('fedora-32', 'x86_64', ['c'], False),
+    ])
+    assert(downloads == [('fedora-32', '--arch', 'x86_64')])
+
+def test_provision_batch(monkeypatch):
+    runs = []
+    def fake_run_playbook_all(instances, playbook, forks=None):
+        runs.append(([i.name for i in instances], playbook, forks))
+    monkeypatch.setattr(Instance, 'run_playbook_all', fake_run_playbook_all)
+    base = types.SimpleNamespace(_span=lambda *args: open(os.devnull))
+    clones = [types.SimpleNamespace(name=f'c{i}') for i in range(3)]
+    settings = types.SimpleNamespace(instance_playbook='site.yml', forks=0, snapshot=False)
+    Instance.provision(base, clones, settings, inventory=True)
+    assert(runs == [(['c0', 'c1', 'c2'], 'site.yml', 3)])
+    settings.forks = 2
+    Instance.provision(base, clones, settings, inventory=True)
+    assert(runs[-1][2] == 2)
+    Instance.provision(base, clones, settings, inventory=False)
+    assert(len(runs) == 2)
+
 def test_mac_registry():
     name = '__test_virt_up_mac_addrs_1'
     mac = '01:23:45:67:89:ab'
@@ -73,6 +158,44 @@ def test_query_storage_pool_path():
     assert(path is not None)
     assert(os.path.exists(path)) # Since running locally.
 
+@pytest.mark.parametrize('policy', ['round-robin', 'most-free', 'least-overlays'])
+def test_select_storage_pool(policy):
+    name, path = select_storage_pool(['default', 'default'], policy)
+    assert(name == 'default')
+    assert(path == query_storage_pool('default'))
+
+def test_select_storage_pool_least_overlays(tmp_path, monkeypatch, store):
+    for pool in ('p1', 'p2'):
+        (tmp_path / pool).mkdir()
+    monkeypatch.setattr(virt_up.instance, 'query_storage_pool',
+                        lambda name, uri=None: f'{tmp_path}/{name}')
+    store.put('c1', {'cloned': 'now', 'pool': 'p1', 'disk': f'{tmp_path}/p1/c1.qcow2'})
+    store.put('c2', {'cloned': 'now', 'disk': f'{tmp_path}/p1/c2.qcow2'})
+    store.put('c3', {'cloned': 'now', 'pool': 'p2', 'disk': f'{tmp_path}/p2/c3.qcow2'})
+    store.put('base', {'pool': 'p2', 'disk': f'{tmp_path}/p2/base.qcow2'})
+    store.put('remote', {'cloned': 'now', 'pool': 'p2', 'uri': 'qemu+ssh://other/system'})
+    assert(select_storage_pool(['p1', 'p2'], 'least-overlays') == ('p2', f'{tmp_path}/p2'))
+    store.put('c4', {'cloned': 'now', 'pool': 'p2', 'disk': f'{tmp_path}/p2/c4.qcow2'})
+    store.put('c5', {'cloned': 'now', 'pool': 'p2', 'disk': f'{tmp_path}/p2/c5.qcow2'})
+    assert(select_storage_pool(['p1', 'p2'], 'least-overlays')[0] == 'p1')
+
+def test_lock_file_keys():
+    # A keyed lock does not wait for the default lock or other keys.
+    acquired = threading.Event()
+    def other():
+        with LockFile('_test_virt_up_b'):
+            acquired.set()
+    with LockFile(), LockFile('_test_virt_up_a'):
+        thread = threading.Thread(target=other)
+        thread.start()
+        assert(acquired.wait(10))
+        thread.join()
+
+def test_select_storage_pool_round_robin():
+    indexes = [virt_up.instance._next_pool_index(3) for _ in range(4)]
+    for i, index in enumerate(indexes):
+        assert(index == (indexes[0] + i) % 3)
+
 @pytest.mark.parametrize('template', ['generic/centos8', 'generic/debian10'])
 def test_build(config_files, template):
     instance = Instance.build(template, prefix='__TEST_BUILD__')
@@ -126,3 +249,178 @@ def test_address_source_arp(config_files):
     finally:
         # cleanup
         instance.delete()
+
+def test_reset(config_files):
+    source = Instance.build('generic/centos8', prefix='__TEST_RESET__')
+    target = None
+    try:
+        target = source.clone('_test_virt_up_reset', snapshot=True)
+        assert('snapshot' in target.meta)
+        address = target.address()
+        mac = target.mac()
+        code, _, _ = target.run_command('touch', '/tmp/dirty')
+        assert(code == 0)
+        target.reset()
+        code, _, _ = target.run_command('test', '-e', '/tmp/dirty')
+        assert(code != 0)
+        assert(target.address() == address)
+        assert(target.mac() == mac)
+    finally:
+        if target:
+            target.delete()
+        source.delete()
+
+def test_run_command_agent(config_files):
+    source = Instance.build('generic/centos8', prefix='__TEST_AGENT__')
+    target = None
+    try:
+        target = source.clone('_test_virt_up_agent')
+        assert(target.wait_for_agent())
+        assert(target.agent_ready())
+        code, out, err = target.run_command('id', '-un', transport='agent')
+        assert(code == 0)
+        assert(out.strip() == target.meta['user']['username'])
+        code, out, err = target.run_command('id', '-u', sudo=True, transport='agent')
+        assert(code == 0)
+        assert(out.strip() == '0')
+        code, _, _ = target.run_command('false', transport='agent')
+        assert(code != 0)
+    finally:
+        if target:
+            target.delete()
+        source.delete()
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """
+    A metadata store in a temp directory.
+    """
+    monkeypatch.setattr(virt_up.instance, 'virtup_data_home', str(tmp_path))
+    monkeypatch.setattr(Timings, 'filename', str(tmp_path / 'timings.jsonl'))
+    return virt_up.instance.metadata_store()
+
+class FakeCreds:
+    def __init__(self, username, password=None):
+        self.username = username
+        self.password = password
+        self.ssh_identity = f'/nonexistent/{username}/id_rsa'
+
+    @classmethod
+    def generate_password(cls, length=24):
+        return 'x' * length
+
+@pytest.fixture
+def offline(tmp_path, monkeypatch, store):
+    """
+    Attach instances without libvirt, and place the images in the temp
+    directory. The image tools are left to the tests.
+    """
+    def fake_attach(self, uri=None):
+        self._read_meta()
+        self.uri = uri
+        self.domain = None
+    monkeypatch.setattr(Instance, '_attach', fake_attach)
+    monkeypatch.setattr(Instance, 'exists', classmethod(lambda cls, name: False))
+    monkeypatch.setattr(Instance, '_domain_exists', classmethod(lambda cls, name, uri=None: False))
+    monkeypatch.setattr(Instance, 'stop', lambda self: None)
+    monkeypatch.setattr(Instance, 'mac', lambda self: '52:54:00:00:00:01')
+    monkeypatch.setattr(Instance, 'address', lambda self: '192.0.2.1')
+    monkeypatch.setattr(Instance, 'update_inventory', classmethod(lambda cls: None))
+    monkeypatch.setattr(virt_up.instance, 'Creds', FakeCreds)
+    monkeypatch.setattr(virt_up.instance, 'Admission', lambda *args: contextlib.nullcontext())
+    monkeypatch.setattr(virt_up.instance, 'select_storage_pool',
+                        lambda pools, policy, uri: ('default', str(tmp_path)))
+    return store
+
+def test_clone_while_refreshed(tmp_path, monkeypatch, offline):
+    store = offline
+    deleted = []
+    monkeypatch.setattr(Instance, 'delete', lambda self: deleted.append(self.name))
+    def fake_create(*args, **kwargs):
+        open(args[-1], 'w').close()
+    monkeypatch.setattr(virt_up.instance, 'qemu_img', types.SimpleNamespace(create=fake_create))
+    monkeypatch.setattr(virt_up.instance, 'virt_sysprep', lambda *args, **kwargs: None)
+
+    # Swap the base instances while the clone is imported, after the image
+    # is created and before the clone metadata is written, as refresh() does.
+    def fake_virt_install(*args, **kwargs):
+        with store.transaction():
+            meta = store.get('BASE')
+            meta['retired'] = 'now'
+            store.put('BASE', meta)
+            store.rename('BASE', 'BASE.retired')
+            store.put('BASE', dict(meta, disk=f'{tmp_path}/BASE.new.qcow2'))
+        Instance._delete_retired('BASE.retired')
+    monkeypatch.setattr(virt_up.instance, 'virt_install', fake_virt_install)
+
+    store.put('BASE', {
+        'template': 'generic/test',
+        'created': 'now',
+        'os_version': 'test-1',
+        'os_variant': 'test1',
+        'disk': f'{tmp_path}/BASE.qcow2',
+        'image_format': 'qcow2',
+        'memory': 1024,
+        'vcpus': 1,
+        'user': {'username': 'tester'},
+    })
+    settings = types.SimpleNamespace(
+        memory=1024, vcpus=1, hosts=[], pools=['default'], pool_policy='round-robin',
+        graphics='none', dns_domain='', restore=False, image_format='qcow2',
+        password_length=8, user='tester', virt_sysprep_args=[], network=None,
+        virt_install_args=[], cpu_overcommit=1.0)
+    clone = Instance('BASE').clone('c1', settings=settings, provision=False)
+
+    # The retired base is not deleted, and is the base of the clone.
+    assert(deleted == [])
+    assert(store.clones('BASE.retired') == ['c1'])
+    assert(store.clones('BASE') == [])
+    assert(clone.meta['from'] == 'BASE.retired')
+    assert('cloning' not in store.get('c1'))
+    assert(store.get('c1')['cloned'])
+
+def test_build_image_of_retired_base(tmp_path, monkeypatch, offline):
+    store = offline
+    images = []
+    def fake_virt_builder(*args, **kwargs):
+        images.append(args[args.index('--output') + 1])
+    monkeypatch.setattr(virt_up.instance, 'virt_builder', fake_virt_builder)
+    monkeypatch.setattr(virt_up.instance, 'virt_install', lambda *args, **kwargs: None)
+    # The retired base keeps the image of the old base instance.
+    store.put('BASE.retired', {'template': 'generic/test', 'retired': 'now',
+                               'disk': f'{tmp_path}/BASE.qcow2'})
+    open(f'{tmp_path}/BASE.qcow2', 'w').close()
+    settings = types.SimpleNamespace(
+        os_version='test-1', os_variant='test1', memory=1024, vcpus=1, hosts=[],
+        pools=['default'], pool_policy='round-robin', graphics='none', dns_domain='',
+        image_format='qcow2', password_length=8, user='tester', virt_builder_args=[],
+        network=None, virt_install_args=[], address_source='agent',
+        template_playbook=None, compact=False)
+    base = Instance.build('generic/test', target='BASE', settings=settings)
+    assert(len(images) == 1)
+    assert(images[0] != f'{tmp_path}/BASE.qcow2')
+    assert(os.path.basename(images[0]).startswith('BASE.'))
+    assert(base.meta['disk'] == images[0])
+
+def test_meta_transaction(monkeypatch, offline):
+    store = offline
+    store.put('i1', {'template': 'generic/test'})
+    instance = Instance('i1')
+    puts = []
+    put = store.put
+    monkeypatch.setattr(store, 'put', lambda name, meta: puts.append(name) or put(name, meta))
+    # Nested transactions write the updates once, when the outermost ends.
+    with instance.transaction():
+        instance._update_meta({'a': 1})
+        with instance.transaction():
+            instance._update_meta({'b': 2})
+        assert(puts == [])
+    assert(puts == ['i1'])
+    assert(store.get('i1') == {'template': 'generic/test', 'a': 1, 'b': 2})
+    # Updates which change nothing are not written.
+    with instance.transaction():
+        instance._update_meta({'a': 1})
+    instance._update_meta({'b': 2})
+    assert(puts == ['i1'])
+    instance._update_meta({'b': 3})
+    assert(puts == ['i1', 'i1'])
@@ -0,0 +1,62 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+from virt_up.inventory import group_name, inventory
+
+def meta(address, **fields):
+    return {
+        'address': address,
+        'user': {'username': 'joe', 'ssh_identity': '/k/joe'},
+        'ssh_options': {'StrictHostKeyChecking': 'no', 'LogLevel': 'ERROR'},
+        **fields,
+    }
+
+ITEMS = [
+    ('VIRTUP-generic-centos8', meta('10.0.0.1', template='generic/centos8')),
+    ('VIRTUP-generic-centos8.retired-1', meta('10.0.0.9', template='generic/centos8', retired='now')),
+    ('a', meta('10.0.0.2', template='generic/centos8', cloned='now', **{'from': 'VIRTUP-generic-centos8'})),
+    ('b', meta('10.0.0.3', template='generic/centos8', cloned='now',
+               **{'from': 'VIRTUP-generic-centos8.retired-1'})),
+    ('c', meta(None, template='generic/debian10', cloned='now', **{'from': 'VIRTUP-generic-debian10'})),
+]
+
+def test_group_name():
+    assert(group_name('template', 'generic/centos8') == 'template_generic_centos8')
+    assert(group_name('base', 'VIRTUP-generic-centos8.1') == 'base_VIRTUP_generic_centos8_1')
+
+def test_inventory():
+    data = inventory(ITEMS)
+    assert(data['virt_up_managed']['hosts'] == ['a', 'b'])
+    assert(data['virt_up_templates']['hosts'] == ['VIRTUP-generic-centos8'])
+    assert(data['template_generic_centos8']['hosts'] == ['a', 'b'])
+    assert(data['base_VIRTUP_generic_centos8']['hosts'] == ['a'])
+    assert(data['base_VIRTUP_generic_centos8_retired_1']['hosts'] == ['b'])
+    assert('template_generic_debian10' not in data)  # No address.
+    assert('_meta' not in data['all']['children'])
+    assert('virt_up_managed' in data['all']['children'])
+    hostvars = data['_meta']['hostvars']
+    assert(sorted(hostvars) == ['VIRTUP-generic-centos8', 'a', 'b'])
+    assert(hostvars['a']['ansible_host'] == '10.0.0.2')
+    assert(hostvars['a']['ansible_user'] == 'joe')
+    assert(hostvars['a']['ansible_private_key_file'] == '/k/joe')
+    assert(hostvars['a']['ansible_ssh_common_args'] == '-o StrictHostKeyChecking=no -o LogLevel=ERROR')
+    assert(hostvars['a']['virt_up_base'] == 'VIRTUP-generic-centos8')
+    assert('virt_up_base' not in hostvars['VIRTUP-generic-centos8'])
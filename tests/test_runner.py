@@ -0,0 +1,95 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+import asyncio
+import io
+import sys
+import time
+
+import pytest
+
+from virt_up import runner
+
+def test_capture_output():
+    echo = runner.Command('echo')
+    assert(echo('hello', 'world') == 'hello world\n')
+
+def test_line_callbacks():
+    lines = []
+    sh = runner.Command('sh', out=lines.append)
+    sh('-c', 'echo one; echo two')
+    assert(lines == ['one\n', 'two\n'])
+
+def test_file_output():
+    out = io.StringIO()
+    err = io.StringIO()
+    sh = runner.Command('sh')
+    sh('-c', 'echo out; echo err >&2', _out=out, _err=err)
+    assert(out.getvalue() == 'out\n')
+    assert(err.getvalue() == 'err\n')
+
+def test_list_arguments():
+    echo = runner.Command('echo')
+    assert(echo(['a', ['b', 1]], 'c') == 'a b 1 c\n')
+
+def test_input():
+    cat = runner.Command('cat')
+    assert(cat(_in='hello\n') == 'hello\n')
+
+def test_error_return_code():
+    sh = runner.Command('sh')
+    with pytest.raises(runner.ErrorReturnCode) as e:
+        sh('-c', 'echo oops >&2; exit 3')
+    assert(e.value.exit_code == 3)
+    assert(e.value.stderr == 'oops\n')
+
+def test_timeout():
+    sleep = runner.Command('sleep')
+    with pytest.raises(runner.TimeoutException):
+        sleep(10, _timeout=0.2)
+
+def test_command_not_found():
+    missing = runner.Command('_virt_up_this_does_not_exist')
+    assert(not missing)
+    with pytest.raises(runner.CommandNotFound):
+        missing()
+
+def test_sub_command():
+    echo = runner.Command('echo')
+    assert(echo.hello('world') == 'hello world\n')
+
+def test_gather():
+    sleep = runner.Command('sleep')
+    started = time.monotonic()
+    results = runner.gather(*[sleep.run_async(0.5) for _ in range(4)])
+    assert(results == ['', '', '', ''])
+    assert(time.monotonic() - started < 1.5)
+
+def test_long_line():
+    python = runner.Command(sys.executable)
+    out = python('-c', "print('x' * (3 * 2**20)); print('end', end='')")
+    assert(out == 'x' * (3 * 2**20) + '\nend')
+
+def test_running_loop():
+    echo = runner.Command('echo')
+    async def main():
+        return echo('hello')
+    assert(asyncio.run(main()) == 'hello\n')
@@ -0,0 +1,64 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import pytest
+
+from virt_up import saveimage
+
+def make_image(path, xml, cookie=b'<qemu-migration/>', data_len=256):
+    data = xml.encode() + b'\0'
+    offset = len(data)
+    data += cookie + b'\0'
+    data += b'\0' * (data_len - len(data))
+    header = [saveimage.MAGIC, 2, data_len, 1, 0, offset] + [0] * 14
+    with open(path, 'wb') as fp:
+        fp.write(saveimage.HEADER.pack(*header))
+        fp.write(data)
+        fp.write(b'QEVM') # start of the migration stream
+
+def test_read_xml(tmp_path):
+    path = tmp_path / 'test.save'
+    make_image(path, '<domain><name>a</name></domain>')
+    assert(saveimage.read_xml(path) == '<domain><name>a</name></domain>')
+
+def test_write_xml(tmp_path):
+    path = tmp_path / 'test.save'
+    make_image(path, '<domain><name>a</name></domain>')
+    saveimage.write_xml(path, '<domain><name>longer-name</name></domain>')
+    assert(saveimage.read_xml(path) == '<domain><name>longer-name</name></domain>')
+    with open(path, 'rb') as fp:
+        header = saveimage.HEADER.unpack(fp.read(saveimage.HEADER.size))
+        data = fp.read(header[2])
+        stream = fp.read()
+    assert(header[2] == 256)
+    assert(data[header[5]:].split(b'\0', 1)[0] == b'<qemu-migration/>')
+    assert(stream == b'QEVM')
+
+def test_write_xml_too_long(tmp_path):
+    path = tmp_path / 'test.save'
+    make_image(path, '<domain/>', data_len=64)
+    with pytest.raises(ValueError):
+        saveimage.write_xml(path, '<domain>' + 'x' * 64 + '</domain>')
+
+def test_not_a_save_image(tmp_path):
+    path = tmp_path / 'test.save'
+    path.write_bytes(b'\0' * 128)
+    with pytest.raises(ValueError):
+        saveimage.read_xml(path)
@@ -0,0 +1,64 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import subprocess
+import sys
+
+# Import time budgets, relative to the time to import click, measured in
+# the same run, since the command line interface cannot start faster.
+HELP_RATIO = 2.5
+LIST_RATIO = 4.0
+
+def importtime(*args):
+    """
+    Run python with -X importtime and return the import time of each
+    imported module, in microseconds, not counting its nested imports.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', *args],
+                          capture_output=True, text=True, check=True)
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue # heading
+        modules[fields[2].strip()] = int(fields[0])
+    return modules
+
+def baseline():
+    return sum(importtime('-c', 'import click').values())
+
+def test_help_startup():
+    modules = importtime('-m', 'virt_up', '--help')
+    for heavy in ('cookiecutter', 'sh', 'libvirt'):
+        assert(heavy not in modules)
+    assert(sum(modules.values()) < HELP_RATIO * baseline())
+
+def test_paths_startup():
+    modules = importtime('-c', 'import virt_up.cli, virt_up.paths')
+    for heavy in ('cookiecutter', 'sh', 'libvirt', 'virt_up.instance'):
+        assert(heavy not in modules)
+
+def test_list_startup():
+    modules = importtime('-c', 'import virt_up.cli, virt_up.instance')
+    for heavy in ('cookiecutter', 'sh'):
+        assert(heavy not in modules)
+    assert(sum(modules.values()) < LIST_RATIO * baseline())
@@ -0,0 +1,129 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+import json
+import os
+import threading
+
+import pytest
+
+from virt_up import store
+
+@pytest.fixture
+def db(tmp_path):
+    return store.Store(str(tmp_path / 'virt-up.db'))
+
+def test_instances(db):
+    db.put('base', {'template': 'generic/centos8', 'user': {'username': 'joe', 'ssh_identity': '/k'}})
+    db.put('a', {'template': 'generic/centos8', 'from': 'base', 'cloned': 'now'})
+    db.put('b', {'template': 'generic/centos8', 'from': 'base', 'cloned': 'now'})
+    db.put('c', {'template': 'generic/debian10', 'from': 'other', 'cloned': 'now'})
+    assert(db.get('base')['user']['username'] == 'joe')
+    assert(db.get('missing') is None)
+    assert(db.names() == ['a', 'b', 'base', 'c'])
+    assert(db.names(template='generic/debian10') == ['c'])
+    assert(db.clones('base') == ['a', 'b'])
+    assert([n for n, _ in db.items()] == ['a', 'b', 'base', 'c'])
+    assert(db.items()[3][1]['from'] == 'other')
+    db.delete('a')
+    assert(db.clones('base') == ['b'])
+
+def test_private_files(tmp_path):
+    old_umask = os.umask(0o022)
+    try:
+        db = store.Store(str(tmp_path / 'virt-up.db'))
+        db.put('a', {'root': {'username': 'root', 'password': 'secret'}})
+    finally:
+        os.umask(old_umask)
+    paths = list(tmp_path.glob('virt-up.db*'))
+    assert(len(paths) == 3)
+    for path in paths:
+        assert(oct(path.stat().st_mode & 0o777) == oct(0o600))
+
+def test_creds(db):
+    db.put('base', {'root': {'username': 'root', 'ssh_identity': '/r'},
+                    'user': {'username': 'joe', 'ssh_identity': '/j'}})
+    rows = db.db.execute('SELECT username, ssh_identity FROM creds ORDER BY username').fetchall()
+    assert(rows == [('joe', '/j'), ('root', '/r')])
+    db.delete('base')
+    assert(db.db.execute('SELECT count(*) FROM creds').fetchone()[0] == 0)
+
+def test_rename(db):
+    db.put('base', {'template': 'generic/centos8', 'user': {'username': 'joe', 'ssh_identity': '/k'}})
+    db.put('a', {'template': 'generic/centos8', 'from': 'base', 'cloned': 'now',
+                 'user': {'username': 'joe', 'ssh_identity': '/a'}})
+    db.rename('base', 'base.retired')
+    assert(db.get('base') is None)
+    assert(db.get('base.retired')['user']['username'] == 'joe')
+    assert(db.clones('base') == [])
+    assert(db.clones('base.retired') == ['a'])
+    assert(db.get('a')['from'] == 'base.retired')
+    rows = db.db.execute('SELECT instance FROM creds ORDER BY instance').fetchall()
+    assert(rows == [('a',), ('base.retired',)])
+    assert(db.history('base')[-1][2:] == ('renamed', 'base.retired'))
+    with pytest.raises(LookupError):
+        db.rename('missing', 'other')
+
+def test_macs(db):
+    db.set_mac('a', '52:54:00:AA:BB:CC')
+    assert(db.mac('a') == '52:54:00:aa:bb:cc')
+    assert(db.mac_owner('52:54:00:aa:bb:cc') == 'a')
+    db.erase_mac('a')
+    assert(db.mac('a') is None)
+
+def test_history(db):
+    db.record('a', 'built')
+    db.record('b', 'cloned', 'a')
+    db.record('a', 'deleted')
+    assert([e[2] for e in db.history('a')] == ['built', 'deleted'])
+    assert(db.history()[1][1:] == ('b', 'cloned', 'a'))
+
+def test_transaction_rollback(db):
+    with pytest.raises(ValueError):
+        with db.transaction():
+            db.put('a', {})
+            raise ValueError()
+    assert(db.get('a') is None)
+
+def test_migrate(tmp_path):
+    (tmp_path / 'instance').mkdir()
+    (tmp_path / 'instance' / 'base.json').write_text(json.dumps({'template': 't'}))
+    (tmp_path / 'instance' / 'a.json').write_text(json.dumps({'template': 't', 'from': 'base'}))
+    (tmp_path / 'instance' / 'bad.json').write_text('{')
+    (tmp_path / 'macaddrs.json').write_text(json.dumps({'a': '52:54:00:00:00:01'}))
+    db = store.Store(str(tmp_path / 'virt-up.db'))
+    assert(db.names() == ['a', 'base'])
+    assert(db.clones('base') == ['a'])
+    assert(db.mac('a') == '52:54:00:00:00:01')
+    # Only once.
+    (tmp_path / 'instance' / 'later.json').write_text(json.dumps({'template': 't'}))
+    db = store.Store(str(tmp_path / 'virt-up.db'))
+    assert(db.names() == ['a', 'base'])
+
+def test_connect_per_thread(tmp_path):
+    path = str(tmp_path / 'virt-up.db')
+    main = store.connect(path)
+    assert(store.connect(path) is main)
+    others = []
+    thread = threading.Thread(target=lambda: others.append(store.connect(path)))
+    thread.start()
+    thread.join()
+    assert(others[0] is not main)
@@ -0,0 +1,83 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import pytest
+
+from virt_up.instance import Timings
+from virt_up.instance import Span
+from virt_up.instance import ToolLog
+
+@pytest.fixture
+def timings_file(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'timings.jsonl')
+    monkeypatch.setattr(Timings, 'filename', filename)
+    return filename
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert(Timings.percentile(values, 50) == 50)
+    assert(Timings.percentile(values, 95) == 95)
+    assert(Timings.percentile([3.0], 95) == 3.0)
+    assert(Timings.percentile([], 50) is None)
+
+def test_span_records(timings_file):
+    with Span('build', 'virt-builder', '_test_virt_up', 'generic/centos8'):
+        pass
+    try:
+        with Span('build', 'virt-install', '_test_virt_up', 'generic/centos8'):
+            raise ValueError()
+    except ValueError:
+        pass
+    entries = list(Timings.entries())
+    assert(len(entries) == 2)
+    assert(entries[0]['phase'] == 'virt-builder')
+    assert(entries[0]['status'] == 'ok')
+    assert(entries[1]['status'] == 'error')
+
+def test_summary_by_template(timings_file):
+    for elapsed in (1.0, 2.0, 3.0):
+        Timings.record('clone', 'virt-sysprep', 'a', 'generic/centos8', elapsed)
+    Timings.record('clone', 'virt-sysprep', 'b', 'generic/debian10', 10.0)
+    summary = Timings.summary('generic/centos8')
+    assert(summary == [('clone', 'virt-sysprep', 3, 2.0, 3.0)])
+    summary = Timings.summary()
+    assert(summary[0][2] == 4)
+
+def test_tool_log(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr('virt_up.instance.virtup_data_home', str(tmp_path))
+    caplog.set_level('INFO')
+    with ToolLog('_test_virt_up', 'virt-builder') as tool_log:
+        tool_log.out('[   1.0] Downloading: http://example.com/centos-8.xz\n')
+        tool_log.out('##########                    33.3%\n')
+        tool_log.err('warning: something\n')
+        tool_log.out('[  12.3] Running: ssh-keygen -A\n')
+    text = (tmp_path / 'logs' / '_test_virt_up' / 'virt-builder.log').read_text()
+    assert('33.3%' in text)
+    assert('warning: something' in text)
+    progress = [r.getMessage() for r in caplog.records if r.name == 'virt_up.instance']
+    assert(progress == [
+        '_test_virt_up: Downloading: http://example.com/centos-8.xz',
+        '_test_virt_up: Running: ssh-keygen -A',
+    ])
+
+def test_record_error(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(Timings, 'filename', str(tmp_path))
+    Span.record('build', 'total', '_test_virt_up', 'generic/centos8', 1.0)
+    assert('Unable to record timings' in caplog.text)
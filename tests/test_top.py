@@ -0,0 +1,105 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+from virt_up.top import Monitor, sort, table, totals
+
+def record(cpu=0, read=0, write=0, rx=0, tx=0, rss=1048576):
+    return {
+        'cpu.time': cpu,
+        'block.count': 2,
+        'block.0.rd.bytes': read, 'block.0.wr.bytes': write,
+        'block.1.rd.bytes': read, 'block.1.wr.bytes': write,
+        'net.count': 1,
+        'net.0.rx.bytes': rx, 'net.0.tx.bytes': tx,
+        'balloon.current': 2097152,
+        'balloon.rss': rss,
+    }
+
+def test_totals():
+    t = totals(record(cpu=5, read=10, write=20, rx=30, tx=40))
+    assert(t == {'cpu': 5, 'read': 20, 'write': 40, 'rx': 30, 'tx': 40, 'memory': 1048576})
+    assert(totals({'balloon.current': 1024})['memory'] == 1024)
+    assert(totals({})['read'] == 0)
+
+def test_rates_need_two_samples():
+    m = Monitor()
+    m.add('a', 0.0, record())
+    rates = m.rates()
+    assert(rates == [{'name': 'a', 'memory': 1024, 'cpu': None,
+                      'read': None, 'write': None, 'rx': None, 'tx': None}])
+
+def test_rates():
+    m = Monitor(window=3)
+    m.add('a', 0.0, record())
+    m.add('a', 1.0, record(cpu=500000000, read=1000, write=2000, rx=300, tx=400))
+    r = m.rates()[0]
+    assert(r['cpu'] == 50.0)
+    assert(r['read'] == 2000)
+    assert(r['write'] == 4000)
+    assert(r['rx'] == 300)
+    assert(r['tx'] == 400)
+
+def test_counter_reset():
+    m = Monitor(window=3)
+    m.add('a', 0.0, record(cpu=900000000, read=5000, rx=500))
+    m.add('a', 1.0, record(cpu=100000000, read=1000, rx=100))
+    r = m.rates()[0]
+    assert(r['cpu'] == 0.0)
+    assert(r['read'] == 0)
+    assert(r['rx'] == 0)
+
+def test_same_time():
+    m = Monitor()
+    m.add('a', 1.0, record())
+    m.add('a', 1.0, record(cpu=1000))
+    assert(m.rates()[0]['cpu'] is None)
+
+def test_ring_buffer():
+    m = Monitor(window=2)
+    m.add('a', 0.0, record())
+    m.add('a', 1.0, record(cpu=1000000000))
+    m.add('a', 2.0, record(cpu=1500000000))
+    assert(len(m.samples['a']) == 2)
+    assert(m.rates()[0]['cpu'] == 50.0)
+
+def test_forget():
+    m = Monitor()
+    m.add('a', 0.0, record())
+    m.add('b', 0.0, record())
+    m.forget({'b'})
+    assert(list(m.samples) == ['b'])
+
+def test_sort():
+    rates = [
+        {'name': 'b', 'cpu': 1.0},
+        {'name': 'a', 'cpu': None},
+        {'name': 'c', 'cpu': 5.0},
+    ]
+    assert([r['name'] for r in sort(rates, 'cpu')] == ['c', 'b', 'a'])
+    assert([r['name'] for r in sort(rates, 'name')] == ['a', 'b', 'c'])
+
+def test_table():
+    m = Monitor()
+    m.add('a', 0.0, record())
+    m.add('a', 1.0, record(read=1024*1024))
+    lines = table(m.rates())
+    assert(lines[0].startswith('# name'))
+    assert(lines[1].split() == ['a', '0.0', '1024', '2M', '0', '0', '0'])
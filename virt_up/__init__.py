@@ -1,3 +1,8 @@
 __version__ = '2.2.0'
-from .instance import Instance
-Instance # hush lint
+
+def __getattr__(name):
+    # Defer importing the instance module (and libvirt) until first use.
+    if name == 'Instance':
+        from .instance import Instance
+        return Instance
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,279 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+"""
+Asyncio API of virt-up.
+
+AsyncInstance wraps an Instance, with the same metadata, so the instances
+created with this module are managed by the virt-up command and the other
+way around. The waits for the domain state, the address, and open ports
+poll with asyncio.sleep(), and the guest commands are run as asyncio
+subprocesses, so many instances are driven from one event loop:
+
+    async def main():
+        base = await aio.build('generic/centos8')
+        instances = await asyncio.gather(*[base.clone(f'test{i}') for i in range(20)])
+        await asyncio.gather(*[i.run_command('uname', '-r') for i in instances])
+
+Only the domain state checks are made in the event loop thread. The
+domain create, shutdown, and destroy calls and the guest agent queries
+can block for seconds, so they run in the default executor of the event
+loop, like build(), clone(), and delete(), which call the libvirt image
+tools and libguestfs. These are bounded by the size of the executor.
+"""
+
+import asyncio
+import functools
+import io
+import logging
+import shlex
+import socket
+import time
+
+import libvirt
+
+from virt_up.instance import Instance
+from virt_up.instance import ping
+from virt_up.instance import ssh
+from virt_up.runner import ErrorReturnCode
+
+log = logging.getLogger(__name__)
+
+# Number of polls, and the seconds between them, of the waits.
+RETRIES = 120
+INTERVAL = 2
+
+async def _call(func, *args, **kwargs):
+    """
+    Run a synchronous function in the default executor.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+async def _ping(address):
+    try:
+        await ping.run_async('-c', 2, address)
+        return True
+    except ErrorReturnCode as e:
+        log.debug(f"Unable to ping address '{address}'; ping code {e.exit_code}.")
+        return False
+
+async def build(template, **kwargs):
+    """
+    Build a base instance, or return the existing base instance. See
+    Instance.build().
+    """
+    return AsyncInstance(await _call(Instance.build, template, **kwargs))
+
+async def lookup(name):
+    """
+    Returns the existing instance.
+    """
+    if not Instance.exists(name):
+        raise LookupError(f"Instance '{name}' not found.")
+    return AsyncInstance(Instance(name))
+
+class AsyncInstance:
+    """
+    Asyncio wrapper of an Instance.
+    """
+    def __init__(self, instance):
+        self.instance = instance
+
+    def __repr__(self):
+        return f"AsyncInstance('{self.name}')"
+
+    @property
+    def name(self):
+        return self.instance.name
+
+    @property
+    def meta(self):
+        return self.instance.meta
+
+    @property
+    def domain(self):
+        return self.instance.domain
+
+    async def clone(self, target, **kwargs):
+        """
+        Clone this instance to a new target instance. See Instance.clone().
+        """
+        return AsyncInstance(await _call(self.instance.clone, target, **kwargs))
+
+    async def delete(self):
+        """
+        Delete the instance, disk images, and instance metadata.
+        """
+        return await _call(self.instance.delete)
+
+    async def start(self):
+        """
+        Start the instance.
+        """
+        if self.domain.isActive():
+            return
+        log.info(f"Starting instance '{self.name}'.")
+        with self.instance._span('start', 'total'):
+            for retries in range(RETRIES, -1, -1):
+                try:
+                    await _call(self.domain.create)
+                except libvirt.libvirtError as e:
+                    if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
+                        raise e
+                if self.domain.isActive():
+                    return
+                if retries > 0:
+                    await asyncio.sleep(INTERVAL)
+            raise TimeoutError(f"Failed to start instance '{self.name}'.")
+
+    async def stop(self, grace=None):
+        """
+        Shutdown the instance. The shutdown request is repeated every 10
+        seconds. If a grace period is given, in seconds, the instance is
+        destroyed when it is still running after the grace period.
+        """
+        if not self.domain.isActive():
+            return
+        log.info(f"Stopping instance '{self.name}'.")
+        timeout = RETRIES * INTERVAL if grace is None else grace
+        deadline = time.monotonic() + timeout
+        resend = 0
+        with self.instance._span('stop', 'total'):
+            while self.domain.isActive():
+                if time.monotonic() >= deadline:
+                    if grace is None:
+                        raise TimeoutError(f"Failed to stop instance '{self.name}'.")
+                    log.warning(f"Forcing off instance '{self.name}'.")
+                    await _call(self.domain.destroy)
+                    break
+                if time.monotonic() >= resend:
+                    try:
+                        await _call(self.domain.shutdown)
+                    except libvirt.libvirtError as e:
+                        if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
+                            raise e
+                    resend = time.monotonic() + 10
+                await asyncio.sleep(1)
+
+    async def _find_address(self, source):
+        if source in ('agent', 'lease'):
+            sources = {
+                'agent': libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT,
+                'lease': libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE,
+            }
+            try:
+                ia = await _call(self.domain.interfaceAddresses, sources[source])
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_AGENT_UNRESPONSIVE:
+                    raise e
+                return None
+            addresses = self.instance._ia_to_addresses(ia)
+            return addresses[0] if addresses else None
+        if source == 'arp':
+            for address in self.instance._arp_table().get(self.instance.mac(), []):
+                if await _ping(address):
+                    return address
+            return None
+        if source == 'dns':
+            hostname = self.meta.get('hostname')
+            if not hostname:
+                raise LookupError(f"hostname is missing in instance '{self.name}' meta file.")
+            loop = asyncio.get_running_loop()
+            try:
+                ai = await loop.getaddrinfo(hostname, 22, family=socket.AF_INET, proto=socket.IPPROTO_TCP)
+            except OSError:
+                return None
+            if ai and await _ping(ai[0][4][0]):
+                return ai[0][4][0]
+            return None
+        raise ValueError(f"Invalid address_source '{source}' in instance '{self.name}'.")
+
+    async def address(self):
+        """
+        Get the public IPv4 address for login.
+        """
+        address = self.meta.get('address')
+        if address:
+            return address
+        await self.start()
+        source = self.meta.get('address-source', 'agent')
+        log.info(f"Waiting for instance '{self.name}' address.")
+        with self.instance._span('address', source):
+            for retries in range(RETRIES, -1, -1):
+                address = await self._find_address(source)
+                if address:
+                    break
+                if retries > 0:
+                    await asyncio.sleep(INTERVAL)
+            else:
+                raise LookupError(f"Unable to find address for instance '{self.name}'.")
+        self.instance._update_meta({'address': address})
+        log.info(f"Instance '{self.name}' has address '{address}'.")
+        return address
+
+    async def wait_for_port(self, port):
+        """
+        Wait for open port.
+        """
+        address = await self.address()
+        with self.instance._span('wait', f'port {port}'):
+            for retries in range(RETRIES, -1, -1):
+                try:
+                    _, writer = await asyncio.wait_for(
+                        asyncio.open_connection(address, int(port)), INTERVAL)
+                    writer.close()
+                    return True
+                except (OSError, asyncio.TimeoutError):
+                    pass
+                if retries > 0:
+                    await asyncio.sleep(INTERVAL)
+            raise LookupError(f"Unable to connect to '{address}:{port}'.")
+
+    async def run_command(self, *args, sudo=False, transport='ssh', timeout=120):
+        """
+        Run a command via ssh and return the exit code, stdout, and
+        stderr as a tuple. See Instance.run_command(); the timeout, in
+        seconds, applies to the ssh transport too.
+        """
+        if transport == 'agent':
+            return await _call(self.instance.run_command, *args, sudo=sudo,
+                               transport=transport, timeout=timeout)
+        if transport != 'ssh':
+            raise ValueError(f"Unsupported transport '{transport}'.")
+        await self.wait_for_port(22)
+        user = self.meta['user']['username']
+        if sudo:
+            args = ['sudo', '-n'] + list(args)
+        ssh_args = [
+            '-i', self.meta['user']['ssh_identity'],
+            *self.instance._ssh_option_args(),
+            f"{user}@{self.meta['address']}",
+            shlex.join(args),
+        ]
+        code = 0
+        out = io.StringIO()
+        err = io.StringIO()
+        try:
+            await ssh.run_async(ssh_args, _out=out, _err=err, _timeout=timeout)
+        except ErrorReturnCode as e:
+            code = e.exit_code
+        return code, out.getvalue(), err.getvalue()
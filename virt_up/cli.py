@@ -23,31 +23,72 @@ import sys
 import logging
 import pathlib
 import pprint
-import string
 
-import sh
 import click
 import virt_up
 
-from cookiecutter.main import cookiecutter
+# Commands import the virt_up.instance module when they run, so the
+# startup for --help and simple commands stays fast.
 
-# OS names supported in the embedded cookiecutter template.
-_template_oses = [
-    'centos7',
-    'centos8',
-    'fedora33',
-    'debian9',
-    'debian10',
-    'ubuntu18',
-    'opensuse42',
-    'other',
-]
+def _absolute_paths(ctx, argv):
+    """
+    Returns the command line arguments with the relative paths of the path
+    arguments made absolute, since the daemon does not run in the working
+    directory of the client. Paths which do not exist here are left as is,
+    so they are still searched for by the command.
+    """
+    from virt_up.daemon import command_name
+    name = command_name(argv)
+    command = ctx.command.get_command(ctx, name) if name else None
+    if command is None:
+        return list(argv)
+    takes_value = set()
+    for param in command.params:
+        if isinstance(param, click.Option) and not (param.is_flag or param.count):
+            takes_value.update(param.opts)
+    arguments = [p for p in command.params if isinstance(p, click.Argument)]
+    args = list(argv)
+    index = args.index(name) + 1
+    position = 0
+    options = True
+    while index < len(args):
+        arg = args[index]
+        if options and arg == '--':
+            options = False
+        elif options and arg.startswith('-') and arg != '-':
+            if arg in takes_value:
+                index += 1 # skip the option value
+        elif position < len(arguments):
+            param = arguments[position]
+            if isinstance(param.type, click.Path) and not os.path.isabs(arg) and os.path.exists(arg):
+                args[index] = os.path.abspath(arg)
+            if param.nargs == 1:
+                position += 1
+        index += 1
+    return args
+
+def _forward(ctx):
+    """
+    Run the command in the virt-up daemon, if it is running.
+
+    Returns the exit code, or None if the command is to be run here.
+    """
+    if os.environ.get('VIRTUP_NO_DAEMON'):
+        return None
+    from virt_up.daemon import Client, LOCAL_COMMANDS
+    if ctx.invoked_subcommand in LOCAL_COMMANDS:
+        return None
+    client = Client.connect()
+    if client is None:
+        return None
+    return client.run(_absolute_paths(ctx, sys.argv[1:]))
 
 @click.group()
 @click.version_option(version=virt_up.__version__)
 @click.option('-d', '--debug', is_flag=True)
 @click.option('-q', '--quiet', is_flag=True)
-def main(debug, quiet):
+@click.pass_context
+def main(ctx, debug, quiet):
     if debug:
         level = logging.DEBUG
     elif quiet:
@@ -55,9 +96,9 @@ def main(debug, quiet):
     else:
         level = logging.INFO
     logging.basicConfig(level=level, format='%(message)s')
-    # Adjust the sh logger level to avoid printing cmd output
-    # unless --debug is given.
-    logging.getLogger(sh.__name__).setLevel(level + 10)
+    code = _forward(ctx)
+    if code is not None:
+        ctx.exit(code)
 
 @main.command()
 @click.argument('names', metavar='<name>', nargs=-1)
@@ -70,19 +111,74 @@ def main(debug, quiet):
 @click.option('--graphics', help='Graphics type (example: spice).')
 @click.option('--dns-domain', help='DNS domain name (example: example.com).')
 @click.option('--inventory/--no-inventory', help='Include/exclude from virt-up ansible inventory.', default=True)
-def create(names, template, **args):
+@click.option('--snapshot/--no-snapshot', help='Take a clean snapshot for reset (default: template setting).', default=None)
+@click.option('--restore/--no-restore', help='Restore clones from the saved state of the base (default: template setting).', default=None)
+@click.option('--forks', type=int, help='Number of parallel ansible processes for the instance playbook (default: one per instance).')
+def create(names, template, forks, **args):
     """
     Create instances.
 
     Build a base instance then clone zero or more instances from the
     base instance. Use 'virt-up show templates' to list available templates.
     """
-    base = virt_up.Instance.build(template, **args)
+    from virt_up.instance import Instance, Settings
+    base = Instance.build(template, **args)
+    if names and Settings(template).prefetch:
+        try:
+            base.prefetch()
+        except OSError as e:
+            click.echo(f"Unable to prefetch instance '{base.name}': {e}", err=True)
+    instances = []
+    created = []
     for name in names:
-        instance = base.clone(name, **args)
+        exists = Instance.exists(name)
+        instance = base.clone(name, provision=False, **args)
+        instances.append(instance)
+        if not exists:
+            created.append(instance)
+    base.provision(created, inventory=args['inventory'], snapshot=args['snapshot'], forks=forks)
+    for instance in instances:
         instance.wait_for_port(22)
         click.echo(f"Instance '{instance.name}' is up.")
 
+@main.command()
+@click.argument('path', metavar='<fleet-file>', type=click.Path(dir_okay=False))
+@click.option('-j', '--jobs', type=int, default=4, help='Maximum number of parallel jobs (default: 4).')
+@click.option('-n', '--dry-run', is_flag=True, help='Show the changes without creating instances.')
+def up(path, jobs, dry_run):
+    """
+    Create the instances declared in a fleet file.
+
+    Base instances are built before their clones and independent templates
+    are processed in parallel. Existing instances are left as is.
+    """
+    from virt_up.fleet import Fleet
+    fleet = Fleet.load(path)
+    create, exists, conflicts = fleet.plan()
+    for name in create:
+        click.echo(f"+ {name}")
+    for name in exists:
+        click.echo(f"= {name}")
+    for name in conflicts:
+        click.echo(f"! {name}")
+    if dry_run:
+        return
+    errors = fleet.up(jobs=jobs)
+    for name, error in sorted(errors.items()):
+        click.echo(f"Instance '{name}' failed: {error}", err=True)
+    if errors:
+        sys.exit(1)
+
+@main.command()
+@click.argument('path', metavar='<fleet-file>', type=click.Path(dir_okay=False))
+@click.option('--bases', is_flag=True, help='Delete the unused base instances too.')
+def down(path, bases):
+    """
+    Destroy the instances declared in a fleet file.
+    """
+    from virt_up.fleet import Fleet
+    Fleet.load(path).down(bases=bases)
+
 @main.command()
 @click.argument('names', metavar='<name>', nargs=-1)
 def destroy(names):
@@ -92,25 +188,236 @@ def destroy(names):
     Shutdown and delete the instances. Use virt-up list [--all]
     to list instance names.
     """
+    from virt_up.instance import Instance
     for name in names:
-        if not virt_up.Instance.exists(name):
+        if not Instance.exists(name):
             click.echo(f"Instance '{name}' not found.")
         else:
-            virt_up.Instance(name).delete()
+            Instance(name).delete()
+
 
+@main.command()
+@click.argument('names', metavar='<name>', nargs=-1)
+def reset(names):
+    """
+    Reset instances to their clean snapshot.
+
+    Revert instances to the snapshot taken when the instance was created
+    with --snapshot, or with the 'snapshot' command.
+    """
+    from virt_up.instance import Instance
+    for name in names:
+        if not Instance.exists(name):
+            click.echo(f"Instance '{name}' not found.", err=True)
+        else:
+            Instance(name).reset()
+
+@main.command()
+@click.argument('names', metavar='<name>', nargs=-1)
+def snapshot(names):
+    """
+    Take a clean snapshot of instances.
+
+    Replace the snapshot restored by the 'reset' command with the current
+    state of the instances.
+    """
+    from virt_up.instance import Instance
+    for name in names:
+        if not Instance.exists(name):
+            click.echo(f"Instance '{name}' not found.", err=True)
+        else:
+            Instance(name).snapshot()
+
+def _bases(templates, missing=None):
+    """
+    Returns the current base instances of the templates. The templates
+    without a base instance are added to missing, if given, otherwise
+    reported.
+    """
+    from virt_up.instance import Instance, metadata_store
+    bases = {}
+    for name, meta in metadata_store().items():
+        if 'cloned' not in meta and 'retired' not in meta:
+            bases.setdefault(meta.get('template'), name)
+    instances = []
+    for template in templates:
+        if template in bases:
+            instances.append(Instance(bases[template]))
+        elif missing is not None:
+            missing.append(template)
+        else:
+            click.echo(f"Base instance of template '{template}' not found.", err=True)
+    return instances
+
+@main.command()
+@click.argument('templates', metavar='<template>', nargs=-1)
+@click.option('-a', '--all', is_flag=True, help='Download the virt-builder templates of all templates.')
+@click.option('-j', '--jobs', type=int, default=4, help='Maximum number of parallel downloads (default: 4).')
+def prefetch(templates, all, jobs):
+    """
+    Read base images into the page cache.
+
+    Warm the page cache with the base image of each template before
+    creating many instances from it. The virt-builder template is
+    downloaded instead for templates without a base instance, or for
+    all templates with --all.
+    """
+    from virt_up.instance import Settings, prefetch_templates
+    if all:
+        missing = list(Settings.all())
+    else:
+        names = []
+        for instance in _bases(templates, names):
+            instance.prefetch()
+        missing = [Settings(template) for template in names]
+    if not missing:
+        return
+    results = prefetch_templates(missing, jobs=jobs)
+    click.echo(f"{'# os-version': <24} {'arch': <8} {'cache': <6} {'size (MiB)': >10}  templates")
+    for r in results:
+        cache = 'error' if r['error'] else ('hit' if r['cached'] else 'miss')
+        click.echo(f"{r['os_version']: <24} {r['arch']: <8} {cache: <6} {r['size'] // 2**20: >10}  "
+                   f"{', '.join(r['templates'])}")
+    if any(r['error'] for r in results):
+        sys.exit(1)
+
+@main.command()
+@click.argument('templates', metavar='<template>', nargs=-1)
+@click.option('-a', '--all', is_flag=True, help='Refresh the base instances of all templates.')
+@click.option('-f', '--force', is_flag=True, help='Refresh even when the base instance is not older than max-age.')
+def refresh(templates, all, force):
+    """
+    Rebuild base instances older than max-age.
+
+    The new base instance replaces the old one when it is ready; existing
+    instances keep using the old base until they are destroyed.
+    """
+    from virt_up.instance import Instance
+    if all:
+        errors = Instance.refresh_all(force=force)
+        if errors:
+            sys.exit(1)
+        return
+    for base in _bases(templates):
+        base.refresh(force=force)
+
+def _select(names, all, template):
+    """
+    Returns the instances given by name, or all of the (non-base) instances,
+    or the instances created from a template.
+    """
+    from virt_up.instance import Instance
+    instances = []
+    for name in names:
+        if not Instance.exists(name):
+            click.echo(f"Instance '{name}' not found.", err=True)
+        else:
+            instances.append(Instance(name))
+    if all or template:
+        for instance in Instance.all():
+            if instance.is_template() or instance.name in names:
+                continue
+            if template and instance.meta.get('template') != template:
+                continue
+            instances.append(instance)
+    return instances
+
+@main.command()
+@click.argument('names', metavar='<name>', nargs=-1)
+@click.option('-a', '--all', is_flag=True, help='Start all instances.')
+@click.option('-t', '--template', help='Start the instances created from this template.')
+@click.option('-j', '--jobs', type=int, default=8, help='Maximum number of parallel starts (default: 8).')
+def start(names, all, template, jobs):
+    """
+    Start instances.
+    """
+    from virt_up.instance import Instance
+    errors = Instance.start_all(_select(names, all, template), jobs=jobs)
+    if errors:
+        sys.exit(1)
+
+@main.command()
+@click.argument('names', metavar='<name>', nargs=-1)
+@click.option('-a', '--all', is_flag=True, help='Stop all instances.')
+@click.option('-t', '--template', help='Stop the instances created from this template.')
+@click.option('-g', '--grace', type=int, default=60,
+              help='Seconds to wait for shutdown before the instances are destroyed (default: 60).')
+def stop(names, all, template, grace):
+    """
+    Stop instances.
+
+    Request all of the instances to shutdown at once, then wait for them
+    together. Instances which are still running after the grace period
+    are forced off.
+    """
+    from virt_up.instance import Instance
+    errors = Instance.stop_all(_select(names, all, template), grace=grace)
+    if errors:
+        sys.exit(1)
 
 @main.command(name='list')
 @click.option('-a', '--all', is_flag=True, help='List base instances too.')
-def list_(all):
+@click.option('-l', '--long', is_flag=True, help='Show the state, vcpus, memory, and address.')
+@click.option('--json', 'json_', is_flag=True, help='Show the status as json.')
+def list_(all, long, json_):
     """
     List instances.
     """
+    from virt_up.instance import Instance
+    if long or json_:
+        status = Instance.status(templates=all)
+        if json_:
+            import json
+            click.echo(json.dumps(status, indent=4))
+            return
+        heading = ('# name', 'state', 'vcpus', 'memory', 'address', 'template')
+        click.echo(f"{heading[0]: <24} {heading[1]: <9} {heading[2]: >5} {heading[3]: >7} "
+                   f"{heading[4]: <16} {heading[5]}")
+        for s in status:
+            vcpus = s['vcpus'] if s['vcpus'] is not None else '-'
+            memory = s['memory'] if s['memory'] is not None else '-'
+            click.echo(f"{s['name']: <24} {s['state']: <9} {vcpus: >5} {memory: >7} "
+                       f"{s['address'] or '-': <16} {s['template'] or ''}")
+        return
     names = []
-    for instance in virt_up.Instance.all():
+    for instance in Instance.all():
         if all or not instance.is_template():
             names.append(instance.name)
     click.echo('\n'.join(sorted(names)))
 
+@main.command()
+@click.option('-a', '--all', is_flag=True, help='Show base instances too.')
+@click.option('-i', '--interval', type=float, default=2.0, help='Seconds between samples (default: 2).')
+@click.option('-w', '--window', type=int, default=3, help='Number of samples the rates are computed over (default: 3).')
+@click.option('-n', '--count', type=int, default=0, help='Number of updates, then exit (default: run until interrupted).')
+@click.option('-s', '--sort', type=click.Choice(['name', 'cpu', 'memory', 'read', 'write', 'rx', 'tx']),
+              default='cpu', help='Sort column (default: cpu).')
+@click.option('--json', 'json_', is_flag=True, help='Print one json line per update.')
+def top(all, interval, window, count, sort, json_):
+    """
+    Show the resource usage of running instances.
+    """
+    import json
+    import time
+    from virt_up import top
+    monitor = top.Monitor(window=window)
+    top.sample(monitor, templates=all)
+    updates = 0
+    try:
+        while not count or updates < count:
+            time.sleep(interval)
+            top.sample(monitor, templates=all)
+            rates = top.sort(monitor.rates(), sort)
+            updates += 1
+            if json_:
+                click.echo(json.dumps({'time': time.time(), 'instances': rates}))
+                continue
+            if sys.stdout.isatty():
+                click.clear()
+            click.echo('\n'.join(top.table(rates)))
+    except KeyboardInterrupt:
+        pass
+
 @main.group()
 def show():
     """
@@ -121,8 +428,9 @@ def show_paths():
     """
     Show configuration and data paths.
     """
-    config_home = pathlib.Path(virt_up.instance.virtup_config_home).resolve()
-    data_home = pathlib.Path(virt_up.instance.virtup_data_home).resolve()
+    from virt_up.paths import virtup_config_home, virtup_data_home
+    config_home = pathlib.Path(virtup_config_home).resolve()
+    data_home = pathlib.Path(virtup_data_home).resolve()
     sshkeys = data_home / 'sshkeys'
     playbooks = config_home / 'playbooks'
     inventory = data_home / 'inventory.yaml'
@@ -138,7 +446,8 @@ def show_playbooks(full_path):
     """
     Show available playbooks.
     """
-    config_home = pathlib.Path(virt_up.instance.virtup_config_home).resolve()
+    from virt_up.paths import virtup_config_home
+    config_home = pathlib.Path(virtup_config_home).resolve()
     path = config_home / 'playbooks'
     playbooks = list(path.glob('*.yml')) + list(path.glob('*.yaml'))
     for playbook in sorted(playbooks):
@@ -152,21 +461,45 @@ def show_templates():
     """
     Show available template definitions.
     """
+    from virt_up.instance import Settings
     heading = ('# template', 'description', 'arch')
     click.echo(f"{heading[0]: <24} {heading[1]: <30} {heading[2]}")
-    for s in virt_up.instance.Settings.all():
+    for s in Settings.all():
         click.echo(f"{s.template_name: <24} {s.desc: <30} {s.arch}")
 
+@show.command(name='timings')
+@click.option('-t', '--template', help='Show timings for this template only.')
+def show_timings(template):
+    """
+    Show per-phase timing percentiles.
+    """
+    from virt_up.instance import Timings
+    heading = ('# operation', 'phase', 'count', 'p50', 'p95')
+    click.echo(f"{heading[0]: <14} {heading[1]: <16} {heading[2]: >6} {heading[3]: >9} {heading[4]: >9}")
+    for operation, phase, count, p50, p95 in sorted(Timings.summary(template)):
+        click.echo(f"{operation: <14} {phase: <16} {count: >6} {p50: >9.1f} {p95: >9.1f}")
+
+@show.command(name='history')
+@click.argument('name', required=False)
+def show_history(name):
+    """
+    Show the instance lifecycle history.
+    """
+    from virt_up.instance import metadata_store
+    for time_, name_, event, detail in metadata_store().history(name):
+        click.echo(f"{time_[:19]}  {name_: <24} {event: <10} {detail or ''}".rstrip())
+
 @show.command(name='instance')
 @click.argument('name')
 def show_instance(name):
     """
     Show instance metadata.
     """
-    if not virt_up.Instance.exists(name):
+    from virt_up.instance import Instance
+    if not Instance.exists(name):
         click.echo(f"Instance '{name}' not found.", err=True)
         return 1
-    instance = virt_up.Instance(name)
+    instance = Instance(name)
     click.echo(pprint.pformat(instance.meta))
 
 @show.command(name='ssh-config')
@@ -175,10 +508,11 @@ def show_ssh_config(name):
     """
     Show instance ssh config.
     """
-    if not virt_up.Instance.exists(name):
+    from virt_up.instance import Instance
+    if not Instance.exists(name):
         click.echo(f"Instance '{name}' not found.", err=True)
         return 1
-    instance = virt_up.Instance(name)
+    instance = Instance(name)
     click.echo(f"Host {name}")
     click.echo(f"    Hostname {instance.meta['address']}")
     click.echo(f"    User {instance.meta['user']['username']}")
@@ -194,9 +528,10 @@ def login(names, protocol):
     """
     Login to an instance.
     """
+    from virt_up.instance import Instance
     if len(names) == 0:
         names = []
-        for i in virt_up.Instance.all():
+        for i in Instance.all():
             if not i.is_template():
                 names.append(i.name)
         if len(names) == 0:
@@ -211,26 +546,39 @@ def login(names, protocol):
         name = names[0]
     elif len(names) == 1:
         name = names[0]
-        if not virt_up.Instance.exists(name):
+        if not Instance.exists(name):
             click.echo(f"Instance '{name}' not found.", err=True)
             return 1
     if len(names) > 1:
         click.echo("Too many names.")
         return 1
-    instance = virt_up.Instance(name)
+    instance = Instance(name)
     instance.login(mode=protocol)
 
+@main.command()
+def daemon():
+    """
+    Run the virt-up daemon.
+
+    The daemon keeps the libvirt connection, settings, and instance metadata
+    warm and runs the commands forwarded by virt-up while it is running.
+    Set VIRTUP_NO_DAEMON=1 to run commands without the daemon.
+    """
+    from virt_up.daemon import serve
+    serve()
+
 @main.command()
 @click.argument('name')
-@click.argument('playbook')
+@click.argument('playbook', type=click.Path(dir_okay=False))
 def playbook(name, playbook):
     """
     Run an ansible playbook on an instance.
     """
-    if not virt_up.Instance.exists(name):
+    from virt_up.instance import Instance
+    if not Instance.exists(name):
         click.echo(f"Instance '{name}' not found.", err=True)
         return 1
-    virt_up.Instance(name).run_playbook(playbook)
+    Instance(name).run_playbook(playbook)
 
 if __name__ == '__main__':
     main()
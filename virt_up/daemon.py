@@ -0,0 +1,375 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Optional long running virt-up service.
+
+The daemon keeps the libvirt connection, the parsed settings, and the
+instance metadata warm between commands, and runs the commands forwarded
+by the virt-up command line client over a unix socket. Commands which
+change instances are run one at a time by a single worker, in the order
+received. Quick read-only commands are run as soon as they are received.
+
+The protocol is one json object per line. The client sends the request:
+
+    {"argv": [...], "env": {...}}
+
+and the daemon replies with any number of {"out": text} and {"err": text}
+messages followed by {"exit": code}, or {"refused": reason} when the
+client should run the command itself.
+
+The daemon does not change its working directory, so the client makes
+the relative path arguments absolute before sending the request. Only
+clients run by the user of the daemon are served, and the client only
+uses a socket owned by its own user.
+"""
+
+import contextvars
+import io
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Commands run as soon as they are received.
+QUICK_COMMANDS = ('list', 'show')
+
+# Commands which are always run by the client.
+LOCAL_COMMANDS = ('login', 'daemon', 'top')
+
+# Seconds between the checks for base instances older than max-age.
+REFRESH_INTERVAL = 900
+
+# Environment variables which must match between the client and daemon.
+ENVIRONMENT = (
+    'LIBVIRT_DEFAULT_URI',
+    'VIRTUP_CONFIG_HOME',
+    'VIRTUP_DATA_HOME',
+    'XDG_CONFIG_HOME',
+    'XDG_DATA_HOME',
+)
+
+def socket_path():
+    """
+    Path to the daemon socket; in the same directory as the lock file.
+    """
+    from virt_up.paths import runtime_dir
+    return f'{runtime_dir()}/virt-up.sock'
+
+def environment():
+    return {k: os.environ.get(k) for k in ENVIRONMENT}
+
+def peer_uid(sock):
+    """
+    Returns the user id of the process at the other end of a unix socket.
+    """
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+def command_name(argv):
+    """
+    Returns the command name given the command line arguments.
+    """
+    for arg in argv:
+        if not arg.startswith('-'):
+            return arg
+    return None
+
+class Client:
+    """
+    Forward command line arguments to a running daemon.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+
+    @classmethod
+    def connect(cls, path=None):
+        """
+        Connect to the daemon. Returns None if the daemon is not running,
+        or if the socket or the daemon is not owned by the current user.
+        """
+        if path is None:
+            path = socket_path()
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+            log.warning(f"Not using daemon socket '{path}'; it is not a socket owned by the current user.")
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            uid = peer_uid(sock)
+        except OSError as e:
+            log.debug(f"Unable to connect to daemon socket '{path}': {e}")
+            sock.close()
+            return None
+        if uid != os.getuid():
+            log.warning(f"Not using daemon socket '{path}'; the daemon is run by user id {uid}.")
+            sock.close()
+            return None
+        return cls(sock)
+
+    def run(self, argv):
+        """
+        Run the command in the daemon and copy the output. Returns the
+        command exit code, or None if the daemon refused the command.
+        """
+        request = {'argv': list(argv), 'env': environment()}
+        with self.sock, self.sock.makefile('rw') as fp:
+            fp.write(json.dumps(request) + '\n')
+            fp.flush()
+            for line in fp:
+                message = json.loads(line)
+                if 'out' in message:
+                    sys.stdout.write(message['out'])
+                    sys.stdout.flush()
+                elif 'err' in message:
+                    sys.stderr.write(message['err'])
+                    sys.stderr.flush()
+                elif 'exit' in message:
+                    return message['exit']
+                elif 'refused' in message:
+                    log.debug(f"Daemon refused command: {message['refused']}")
+                    return None
+        sys.stderr.write("Lost connection to virt-up daemon.\n")
+        return 1
+
+class _Output:
+    """
+    Output callbacks of the request being run.
+    """
+    def __init__(self, out=None, err=None, level=logging.INFO):
+        self.out = out
+        self.err = err
+        self.level = level
+
+# The output of the request being run in the current context. The thread
+# pools of the commands run their tasks in a copy of the context of the
+# submitting thread, so the output of those threads goes to the client too.
+_output = contextvars.ContextVar('output', default=_Output())
+
+class _ThreadStream(io.TextIOBase):
+    """
+    A stdout/stderr replacement which writes to the client of the request
+    running in the current context, or to the original stream.
+    """
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def write(self, text):
+        callback = getattr(_output.get(), self.name)
+        if callback is None:
+            return self.default.write(text)
+        callback(text)
+        return len(text)
+
+    def flush(self):
+        if getattr(_output.get(), self.name) is None:
+            self.default.flush()
+
+    def isatty(self):
+        return False
+
+class _ClientLogHandler(logging.Handler):
+    """
+    Send log messages of the request running in the current context to
+    the client.
+    """
+    def emit(self, record):
+        output = _output.get()
+        if output.err is None or record.levelno < output.level:
+            return
+        try:
+            output.err(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+class Job:
+    """
+    A forwarded command.
+    """
+    def __init__(self, argv, send):
+        self.argv = argv
+        self.send = send
+        self.code = None
+        self.done = threading.Event()
+        self.level = logging.INFO
+        if '-d' in argv or '--debug' in argv:
+            self.level = logging.DEBUG
+        elif '-q' in argv or '--quiet' in argv:
+            self.level = logging.WARNING
+
+    def run(self):
+        import click
+        from virt_up import cli
+        output = _Output(out=lambda text: self.send({'out': text}),
+                         err=lambda text: self.send({'err': text}),
+                         level=self.level)
+        token = _output.set(output)
+        try:
+            rv = cli.main.main(args=self.argv, prog_name='virt-up', standalone_mode=False)
+            self.code = rv if isinstance(rv, int) else 0
+        except SystemExit as e:
+            self.code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except click.exceptions.Exit as e:
+            self.code = e.exit_code
+        except click.ClickException as e:
+            output.err(f"Error: {e.format_message()}\n")
+            self.code = e.exit_code
+        except click.Abort:
+            output.err("Aborted!\n")
+            self.code = 1
+        except Exception as e:
+            log.debug("Command failed.", exc_info=True)
+            output.err(f"Error: {e}\n")
+            self.code = 1
+        finally:
+            _output.reset(token)
+            self.done.set()
+        return self.code
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        lock = threading.Lock()
+        def send(message):
+            with lock:
+                try:
+                    self.wfile.write((json.dumps(message) + '\n').encode())
+                    self.wfile.flush()
+                except OSError:
+                    pass # Client went away; keep running the job.
+
+        uid = peer_uid(self.request)
+        if uid != os.getuid():
+            log.warning(f"Refusing connection from user id {uid}.")
+            return
+        try:
+            request = json.loads(self.rfile.readline())
+            argv = request['argv']
+        except (ValueError, KeyError, TypeError):
+            send({'refused': 'malformed request'})
+            return
+        command = command_name(argv)
+        if request.get('env') != environment():
+            send({'refused': 'environment mismatch'})
+            return
+        if command is None or command in LOCAL_COMMANDS:
+            send({'refused': f"command '{command}' runs in the client"})
+            return
+        log.debug(f"Received command: {argv}")
+        job = Job(argv, send)
+        if command in QUICK_COMMANDS:
+            job.run()
+        else:
+            self.server.jobs.put(job)
+            job.done.wait()
+        send({'exit': job.code})
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def _worker(jobs):
+    while True:
+        job = jobs.get()
+        job.run()
+
+def _refresher():
+    from virt_up.instance import Instance
+    while True:
+        try:
+            Instance.refresh_all()
+        except Exception as e:
+            log.error(f"Failed to refresh base instances: {e}")
+        time.sleep(REFRESH_INTERVAL)
+
+def _event_loop():
+    import libvirt
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+def serve(path=None):
+    """
+    Run the daemon until interrupted.
+    """
+    import libvirt
+    from virt_up.instance import Connection
+
+    if path is None:
+        path = socket_path()
+    if Client.connect(path):
+        raise FileExistsError(f"A virt-up daemon is already listening on '{path}'.")
+    if os.path.exists(path):
+        os.remove(path) # stale socket
+
+    # Commands run by the daemon must not be forwarded again.
+    os.environ['VIRTUP_NO_DAEMON'] = '1'
+
+    # Route command output and log messages to the clients.
+    sys.stdout = _ThreadStream('out', sys.stdout)
+    sys.stderr = _ThreadStream('err', sys.stderr)
+    root = logging.getLogger()
+    for handler in root.handlers:
+        handler.setLevel(root.level)
+    client_handler = _ClientLogHandler()
+    client_handler.setFormatter(logging.Formatter('%(message)s'))
+    root.addHandler(client_handler)
+    root.setLevel(logging.DEBUG)
+
+    # The event loop runs the connection keepalive.
+    libvirt.virEventRegisterDefaultImpl()
+    threading.Thread(target=_event_loop, name='events', daemon=True).start()
+    conn = Connection.keep()
+    conn.setKeepAlive(5, 3)
+
+    jobs = queue.Queue()
+    threading.Thread(target=_worker, args=(jobs,), name='worker', daemon=True).start()
+
+    # Rebuild the expired base instances without blocking the worker.
+    threading.Thread(target=_refresher, name='refresh', daemon=True).start()
+
+    old_umask = os.umask(0o077)
+    try:
+        server = Server(path, _Handler)
+    finally:
+        os.umask(old_umask)
+    server.jobs = jobs
+    log.info(f"Listening on '{path}'.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        Connection.release()
+        log.info("Stopped.")
@@ -0,0 +1,265 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Declarative fleet of instances.
+
+A fleet file lists the instances to be created by template, count, and
+option overrides:
+
+    prefix: VIRTUP-
+    defaults:
+      memory: 1024
+    instances:
+      - name: web
+        template: generic/centos8
+        count: 3
+      - name: db
+        template: generic/debian10
+        vcpus: 2
+
+An entry with a count greater than one creates numbered instances (web1,
+web2, web3). Base instances are built before their clones, and instances
+of independent templates are created in parallel.
+"""
+
+import concurrent.futures
+import contextvars
+import json
+import logging
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from virt_up.instance import Instance
+from virt_up.instance import Settings
+from virt_up.instance import valid_name
+
+log = logging.getLogger(__name__)
+
+# Instance options which may be given in a fleet file.
+options = (
+    'user',
+    'password',
+    'root_password',
+    'memory',
+    'size',
+    'vcpus',
+    'graphics',
+    'dns_domain',
+    'inventory',
+    'snapshot',
+    'restore',
+)
+
+class Fleet:
+    """
+    A set of instances declared in a fleet file.
+    """
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            raise ValueError("Fleet spec must be a mapping.")
+        self.prefix = spec.get('prefix', 'VIRTUP-')
+        defaults = spec.get('defaults', {}) or {}
+        self.members = {} # name -> (template, options)
+        for entry in spec.get('instances', []) or []:
+            entry = {**defaults, **entry}
+            name = entry.pop('name', None)
+            template = entry.pop('template', None)
+            count = int(entry.pop('count', 1))
+            if not name or not template:
+                raise ValueError(f"Fleet entry '{entry}' requires a name and template.")
+            entry = {k.replace('-', '_'): v for k, v in entry.items()}
+            for key in entry:
+                if key not in options:
+                    raise ValueError(f"Unsupported option '{key}' for fleet entry '{name}'.")
+            entry.setdefault('inventory', True)
+            names = [name] if count == 1 else [f'{name}{i}' for i in range(1, count + 1)]
+            for n in names:
+                if not valid_name(n):
+                    raise ValueError(f"Instance name '{n}' is not valid.")
+                if n in self.members:
+                    raise ValueError(f"Instance name '{n}' is declared more than once.")
+                self.members[n] = (template, entry)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a fleet file. Files ending in .json are read as json,
+        otherwise as yaml.
+        """
+        with open(path) as fp:
+            if path.endswith('.json'):
+                spec = json.load(fp)
+            elif yaml is None:
+                raise ImportError("PyYAML is required to read yaml fleet files.")
+            else:
+                spec = yaml.safe_load(fp)
+        return cls(spec or {})
+
+    def templates(self):
+        """
+        Returns the template names used by the fleet.
+        """
+        return sorted(set(t for t, _ in self.members.values()))
+
+    def plan(self):
+        """
+        Compare the fleet to the existing instances.
+
+        Returns a tuple of the names to be created, the names which
+        already exist, and the names which exist with a different
+        template.
+        """
+        existing = {}
+        for instance in Instance.all():
+            if instance.is_clone():
+                existing[instance.name] = instance.meta.get('template')
+        create, exists, conflicts = [], [], []
+        for name, (template, _) in sorted(self.members.items()):
+            if name not in existing:
+                create.append(name)
+            elif existing[name] == template:
+                exists.append(name)
+            else:
+                conflicts.append(name)
+        return create, exists, conflicts
+
+    def up(self, jobs=4):
+        """
+        Create the missing instances.
+
+        The base instances are built first, in parallel, and the clones
+        of each base are started as soon as the base is ready. The new
+        clones of a template are provisioned together, with one run of
+        the instance playbook, once all of them are cloned. Returns a
+        dictionary of the instance names and the errors which prevented
+        them from being created.
+        """
+        create, _, conflicts = self.plan()
+        errors = {}
+        for name in conflicts:
+            template = self.members[name][0]
+            errors[name] = FileExistsError(
+                f"Instance '{name}' exists but was not created from template '{template}'.")
+        pending = {} # template -> names
+        for name in create:
+            pending.setdefault(self.members[name][0], []).append(name)
+        if not pending:
+            return errors
+
+        bases = {} # template -> base instance
+        cloned = {t: [] for t in pending} # template -> new instances
+        remaining = {t: len(names) for t, names in pending.items()}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            def submit(fn, *args):
+                # Run in a copy of this context, so the output of the jobs
+                # follows the command when it is run by the daemon.
+                return executor.submit(contextvars.copy_context().run, fn, *args)
+            futures = {}
+            for template in pending:
+                future = submit(self._build, template, pending[template])
+                futures[future] = ('build', template)
+            while futures:
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    kind, target = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        log.error(f"Failed to {kind} '{target}': {e}")
+                        if kind == 'build':
+                            for name in pending[target]:
+                                errors[name] = e
+                        elif kind == 'provision':
+                            for instance in cloned[target]:
+                                errors[instance.name] = e
+                        else:
+                            errors[target] = e
+                        result = None
+                    if kind == 'build' and result is not None:
+                        bases[target] = result
+                        for name in pending[target]:
+                            future = submit(self._clone, result, name)
+                            futures[future] = ('clone', name)
+                    elif kind == 'clone':
+                        # Provision the new instances of a template together
+                        # once all of them are cloned.
+                        template = self.members[target][0]
+                        if result is not None:
+                            cloned[template].append(result)
+                        remaining[template] -= 1
+                        if remaining[template] == 0 and cloned[template]:
+                            future = submit(self._provision, bases[template], cloned[template])
+                            futures[future] = ('provision', template)
+        return errors
+
+    def _build(self, template, names):
+        # The clones of a base are created in parallel, so the base is
+        # stopped, and its state saved, once before the clones are started.
+        base = Instance.build(template, prefix=self.prefix)
+        settings = Settings(template)
+        base.stop()
+        restore = [self.members[n][1].get('restore') for n in names]
+        if any(settings.restore if r is None else r for r in restore):
+            try:
+                base.save_state()
+            except FileExistsError as e:
+                log.warning(f"Not restoring from saved state; {e}")
+        if settings.prefetch:
+            try:
+                base.prefetch()
+            except OSError as e:
+                log.warning(f"Unable to prefetch instance '{base.name}': {e}")
+        return base
+
+    def _clone(self, base, name):
+        _, options = self.members[name]
+        instance = base.clone(name, provision=False, **options)
+        instance.wait_for_port(22)
+        log.info(f"Instance '{instance.name}' is up.")
+        return instance
+
+    def _provision(self, base, instances):
+        batches = {} # (inventory, snapshot) -> instances
+        for instance in instances:
+            _, options = self.members[instance.name]
+            key = (options.get('inventory', False), options.get('snapshot'))
+            batches.setdefault(key, []).append(instance)
+        for (inventory, snapshot), batch in batches.items():
+            base.provision(batch, inventory=inventory, snapshot=snapshot)
+
+    def down(self, bases=False):
+        """
+        Delete the fleet instances, and optionally the base instances of
+        the fleet templates which are no longer in use.
+        """
+        for name in sorted(self.members):
+            if Instance.exists(name):
+                Instance(name).delete()
+        if bases:
+            for instance in Instance.all():
+                if not instance.is_template() or not instance.name.startswith(self.prefix):
+                    continue
+                if instance.meta.get('template') in self.templates():
+                    instance.delete()
@@ -23,48 +23,114 @@ Create virtual machines quickly with virt-builder and virt-sysprep on a local
 libvirt-based hypervisor.
 """
 
+import base64
+import collections
+import concurrent.futures
 import configparser
+import contextlib
+import contextvars
 import datetime
+import errno
 import fcntl
 import getpass
 import glob
 import io
 import json
 import logging
+import math
 import os
 import pprint
+import re
 import secrets
 import shlex
+import shutil
 import socket
 import string
+import tempfile
+import threading
 import time
+import uuid
 import xml.etree.ElementTree
 
-import sh
 import libvirt
 
-log = logging.getLogger(__name__)
-
-# Environment variables
-libvirt_uri = os.environ.get('LIBVIRT_DEFAULT_URI', 'qemu:///session')
-
-virtup_config_home = os.path.expanduser(
-    os.environ.get('VIRTUP_CONFIG_HOME',
-    os.path.join(os.environ.get('XDG_CONFIG_HOME', '~/.config'), 'virt-up')))
+from virt_up import saveimage
+from virt_up.paths import libvirt_uri
+from virt_up.paths import runtime_dir
+from virt_up.paths import virtup_config_home
+from virt_up.paths import virtup_data_home
 
-virtup_data_home = os.path.expanduser(
-    os.environ.get('VIRTUP_DATA_HOME',
-    os.path.join(os.environ.get('XDG_DATA_HOME', '~/.local/share'), 'virt-up')))
+log = logging.getLogger(__name__)
 
 # Helpers
 def rm_f(path):
     if os.path.exists(path):
         os.remove(path)
 
+def allocated_size(path):
+    return os.stat(path).st_blocks * 512
+
+def prefetch_file(path):
+    """
+    Start reading the allocated extents of a file into the page cache,
+    skipping the holes. Returns the number of bytes requested.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        extents = []
+        offset = 0
+        try:
+            while offset < size:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+                offset = os.lseek(fd, start, os.SEEK_HOLE)
+                extents.append((start, offset - start))
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                pass # No data after offset.
+            elif e.errno == errno.EINVAL and not extents:
+                extents = [(0, size)] # SEEK_DATA is not supported.
+            else:
+                raise
+        for start, length in extents:
+            os.posix_fadvise(fd, start, length, os.POSIX_FADV_WILLNEED)
+        return sum(length for _, length in extents)
+    finally:
+        os.close(fd)
+
 def mkdir_p(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
+def metadata_store():
+    """
+    Returns the metadata store of the current thread.
+    """
+    from virt_up import store
+    return store.connect(f'{virtup_data_home}/virt-up.db')
+
+def write_atomic(path, text, mode=0o600):
+    """
+    Replace a file with a temporary file, so the file is never left empty
+    or partially written.
+    """
+    directory = os.path.dirname(path)
+    mkdir_p(directory)
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with os.fdopen(os.open(tmp, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, mode), 'w') as fp:
+            fp.write(text)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, path)
+    finally:
+        rm_f(tmp)
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def logout(line):
     line = line.rstrip()
     if line:
@@ -75,6 +141,14 @@ def logerr(line):
     if line:
         log.error(line)
 
+def as_bool(value):
+    """
+    Convert a config file value to a boolean.
+    """
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'yes', 'true', 'on')
+
 def valid_name(name):
     """
     Returns true only if name contains a restricted set of characters.
@@ -85,31 +159,75 @@ def valid_name(name):
             return False
     return True
 
-# The sh debug logging swamps the log file, so back off.
-def _adjust_sh_log():
-    logger = logging.getLogger(sh.__name__)
-    if logger.getEffectiveLevel() <= logging.DEBUG:
-        logger.setLevel(logging.INFO)
+class Command:
+    """
+    An external command which is looked up on first use.
+
+    The runner module (and asyncio) is imported and the command path is
+    searched only when the command is needed, to keep startup fast for
+    commands which do not run external tools.
+    """
+    def __init__(self, name, logged=True):
+        self.name = name
+        self.logged = logged
+        self._command = None
+
+    def _lookup(self):
+        if self._command is None:
+            from virt_up import runner
+            if self.logged:
+                self._command = runner.Command(self.name, out=logout, err=logerr)
+            else:
+                self._command = runner.Command(self.name)
+        return self._command
+
+    def __bool__(self):
+        return bool(self._lookup())
+
+    def __getattr__(self, attr):
+        return getattr(self._lookup(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self._lookup()(*args, **kwargs)
 
 # Commands
-cp = sh.Command('cp').bake(_out=logout, _err=logerr)
-ssh = sh.Command('ssh')
-sftp = sh.Command('sftp')
-ssh_keygen = sh.Command('ssh-keygen').bake(_out=logout, _err=logerr)
-qemu_img = sh.Command('qemu-img').bake(_out=logout, _err=logerr)
-virt_builder = sh.Command('virt-builder').bake(_out=logout, _err=logerr)
-virt_install = sh.Command('virt-install').bake(_out=logout, _err=logerr)
-virt_sysprep = sh.Command('virt-sysprep').bake(_out=logout, _err=logerr)
-try:
-    ansible = sh.Command('ansible-playbook').bake(_out=logout, _err=logerr)
-except sh.CommandNotFound:
-    ansible = None
+cp = Command('cp')
+ssh = Command('ssh', logged=False)
+sftp = Command('sftp', logged=False)
+ping = Command('ping', logged=False)
+ssh_keygen = Command('ssh-keygen')
+qemu_img = Command('qemu-img')
+virt_builder = Command('virt-builder')
+virt_install = Command('virt-install')
+virt_sysprep = Command('virt-sysprep')
+virt_sparsify = Command('virt-sparsify')
+ansible = Command('ansible-playbook')
 
 # Avoid writing "domain not found" errors to the console.
 def _libvirt_callback(userdata, err):
     pass
 
-libvirt.registerErrorHandler(f=_libvirt_callback, ctx=None)
+_libvirt_handler_registered = False
+
+def _register_libvirt_handler():
+    global _libvirt_handler_registered
+    if not _libvirt_handler_registered:
+        libvirt.registerErrorHandler(f=_libvirt_callback, ctx=None)
+        _libvirt_handler_registered = True
+
+# Guest command to renew the network configuration after a clone is
+# restored from a saved state and given a new mac address.
+restore_network_command = (
+    'if command -v nmcli >/dev/null; then nmcli networking off; nmcli networking on; '
+    'elif command -v networkctl >/dev/null; then systemctl restart systemd-networkd; '
+    'elif command -v dhclient >/dev/null; then dhclient -r; dhclient; '
+    'fi')
+
+def random_mac():
+    """
+    Generate a mac address in the range used by libvirt for qemu guests.
+    """
+    return '52:54:00:' + ':'.join('%02x' % secrets.randbelow(256) for _ in range(3))
 
 class Settings:
     """
@@ -137,7 +255,15 @@ class Settings:
         self.os_version = get('os-version', '')
         self.os_variant = get('os-variant', '')
         self.arch = get('arch', '')
-        self.pool = get('pool', 'default')
+        self.pools = get('pool', 'default').replace(',', ' ').split()
+        self.pool = self.pools[0] if self.pools else 'default'
+        self.pool_policy = get('pool-policy', 'round-robin')
+        self.hosts = get('hosts', '').replace(',', ' ').split()
+        self.admission = as_bool(get('admission', 'yes'))
+        self.admission_timeout = int(get('admission-timeout', 600))
+        self.cpu_overcommit = float(get('cpu-overcommit', 4))
+        if self.pool_policy not in pool_policies:
+            raise ValueError(f"Unknown storage pool policy '{self.pool_policy}' for '{name}'.")
         self.network = get('network', '')
         self.user = get('user', get('username', getpass.getuser()))
         self.password_length = int(get('password-length', 24))
@@ -151,17 +277,43 @@ class Settings:
         self.virt_sysprep_args = shlex.split(get('virt-sysprep-args', ''))
         self.virt_install_args = shlex.split(get('virt-install-args', ''))
         self.cp_args = shlex.split(get('cp-args', ''))
+        self.virt_sparsify_args = shlex.split(get('virt-sparsify-args', ''))
+        self.qemu_img_convert_args = shlex.split(get('qemu-img-convert-args', ''))
         self.template_playbook = get('template-playbook', '')
         self.instance_playbook = get('instance-playbook', '')
+        self.forks = int(get('forks', 0))
+        self.snapshot = as_bool(get('snapshot', 'no'))
+        self.restore = as_bool(get('restore', 'no'))
+        self.compact = as_bool(get('compact', 'no'))
+        self.compress = as_bool(get('compress', 'no'))
+        self.prefetch = as_bool(get('prefetch', 'yes'))
+        self.max_age = float(get('max-age', 0))
+        self.restore_network_command = get('restore-network-command', restore_network_command)
         log.debug("Settings: %s", pprint.pformat(vars(self)))
 
+    # Parsed config files, keyed by pattern.
+    _cache = {}
+
     @classmethod
     def _load(self, pattern):
         """
         Load settings from config files.
+
+        The parsed settings are cached until one of the files is changed,
+        added, or removed.
         """
         system_files = glob.glob(f'/etc/virt-up/{pattern}')
         user_files = glob.glob(f'{virtup_config_home}/{pattern}')
+        stamps = []
+        for f in system_files + user_files:
+            try:
+                stamps.append((f, os.stat(f).st_mtime_ns))
+            except FileNotFoundError:
+                pass
+        cached = Settings._cache.get(pattern)
+        if cached and cached[0] == stamps:
+            return cached[1]
+
         parser = configparser.ConfigParser()
         filesread = parser.read(system_files + user_files)
         for f in filesread:
@@ -174,6 +326,7 @@ class Settings:
             for option, value in parser[section].items():
                 settings[section][option] = value.replace('\n', ' ').strip()
 
+        Settings._cache[pattern] = (stamps, settings)
         return settings
 
     @classmethod
@@ -187,7 +340,17 @@ class Settings:
 class LockFile:
     """
     Interprocess lock file.
+
+    The default lock serializes the changes to the base instances and
+    the creation of clone images. A lock with a key, the name of the
+    instance being created, only serializes the work on that instance,
+    so builds and clones of different instances can run at once.
     """
+    key = None
+
+    def __init__(self, key=None):
+        self.key = key
+
     def _write(self, text):
         self.fp.seek(0)
         self.fp.truncate()
@@ -196,10 +359,10 @@ class LockFile:
         self.fp.seek(0)
 
     def __enter__(self):
-        if os.path.exists('/var/run/user/%d' % os.getuid()):
-            path = '/var/run/user/%d/virt-up.lock' % os.getuid()
+        if self.key is None:
+            path = f'{runtime_dir()}/virt-up.lock'
         else:
-            path = '/tmp/virt-up.lock'
+            path = f'{runtime_dir()}/virt-up-{self.key}.lock'
         log.debug("Waiting for lock")
         self.fp = open(path, 'a+')
         fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
@@ -213,25 +376,136 @@ class LockFile:
         self.fp.close()
         log.debug("Released lock")
 
+class Admission(LockFile):
+    """
+    Admit a new domain to a host when the host has the free memory and
+    cpus for it, otherwise wait until it does.
+
+    The lock file is held from the capacity check until the context is
+    exited, so the domain must be started within the context to be
+    counted in the next check, by this or any other virt-up process.
+    """
+    def __init__(self, name, uri, memory, vcpus, settings):
+        self.name = name
+        self.uri = uri
+        self.memory = int(memory)
+        self.vcpus = int(vcpus)
+        self.enabled = settings.admission
+        self.timeout = settings.admission_timeout
+        self.cpu_ratio = settings.cpu_overcommit
+
+    def check(self):
+        """
+        Returns the reason the domain does not fit on the host, or None.
+        """
+        free, cpus = host_capacity(self.uri, self.cpu_ratio)
+        reasons = []
+        if free < self.memory:
+            reasons.append(f"needs {self.memory} MiB memory, {free} MiB free")
+        if cpus < self.vcpus:
+            reasons.append(f"needs {self.vcpus} vcpus, {max(cpus, 0)} free")
+        return '; '.join(reasons) or None
+
+    def __enter__(self):
+        if not self.enabled:
+            return super().__enter__()
+        with Connection(self.uri) as conn:
+            info = conn.getInfo()
+        if self.memory > info[1]:
+            raise ValueError(f"Instance '{self.name}' memory {self.memory} MiB exceeds "
+                             f"the host memory {info[1]} MiB.")
+        host = self.uri or libvirt_uri
+        deadline = time.monotonic() + self.timeout
+        waiting = None
+        while True:
+            super().__enter__()
+            reason = self.check()
+            if reason is None:
+                if waiting:
+                    log.info(f"Admitted instance '{self.name}' to host '{host}'.")
+                return
+            super().__exit__()
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Instance '{self.name}' was not admitted to host '{host}': {reason}.")
+            if reason != waiting:
+                log.info(f"Instance '{self.name}' is queued for host '{host}': {reason}.")
+                waiting = reason
+            time.sleep(10)
+
 class Connection:
     """
     A libvirt connection context manager.
+
+    A long running process may call Connection.keep() to open a connection
+    which is then shared by the connection contexts, instead of opening a
+    new connection each time.
     """
     opens = 0
     closes = 0
-    def __enter__(self, uri=None):
+    shared = {} # uri -> kept connection
+
+    def __init__(self, uri=None):
+        self.uri = uri
+
+    def __enter__(self):
+        uri = self.uri
         if uri is None:
             uri = libvirt_uri
+        self.kept = False
+        conn = Connection.shared.get(uri)
+        if conn is not None:
+            if conn.isAlive():
+                self.conn = conn
+                self.kept = True
+                return self.conn
+            log.warning(f"Reopening libvirt connection: uri='{uri}'")
+            Connection.release(uri)
+            self.conn = Connection.keep(uri)
+            self.kept = True
+            return self.conn
         log.debug(f"Opening libvirt connection: uri='{uri}'")
+        _register_libvirt_handler()
         self.conn = libvirt.open(uri)
         Connection.opens += 1
         return self.conn
 
     def __exit__(self, *exc):
+        if self.kept:
+            return
         log.debug("Closing libvirt connection")
         self.conn.close()
         Connection.closes += 1
 
+    @classmethod
+    def keep(cls, uri=None):
+        """
+        Open a connection to be shared until released.
+        """
+        if uri is None:
+            uri = libvirt_uri
+        log.debug(f"Opening shared libvirt connection: uri='{uri}'")
+        _register_libvirt_handler()
+        conn = libvirt.open(uri)
+        cls.opens += 1
+        cls.shared[uri] = conn
+        return conn
+
+    @classmethod
+    def release(cls, uri=None):
+        """
+        Close a shared connection.
+        """
+        if uri is None:
+            uri = libvirt_uri
+        conn = cls.shared.pop(uri, None)
+        if conn is not None:
+            log.debug(f"Closing shared libvirt connection: uri='{uri}'")
+            try:
+                conn.close()
+            except libvirt.libvirtError as e:
+                log.debug(f"Failed to close connection: {e}")
+            cls.closes += 1
+
 class Creds:
     """
     Login information for a given user.
@@ -271,8 +545,6 @@ class Creds:
         return ssh_identity
 
 class MacAddresses:
-    filename = f'{virtup_data_home}/macaddrs.json'
-
     """
     Saved instance mac addresses.
 
@@ -281,39 +553,182 @@ class MacAddresses:
     instantiations so the recreated guests have consisent IP addresses.
     """
     def __init__(self):
-        self.addrs = {}
-        self._read()
+        self.store = metadata_store()
+
+    def lookup(self, name):
+        return self.store.mac(name)
+
+    def owner(self, mac):
+        """
+        Returns the name of the instance which was assigned the mac address.
+        """
+        return self.store.mac_owner(mac)
+
+    def update(self, name, mac):
+        if self.store.mac(name) != mac.lower():
+            self.store.set_mac(name, mac)
+
+    def erase(self, name):
+        self.store.erase_mac(name)
+
+class ToolLog:
+    """
+    Write the output of an external tool run for an instance to a log file
+    in the instance log directory, and show only the progress lines on the
+    console, one line per stage, prefixed with the instance name.
+    """
+    # virt-builder, virt-sysprep, virt-sparsify: "[  12.3] Stage"
+    # ansible-playbook: "TASK [name] ****"
+    progress = re.compile(r'^\[\s*\d+\.\d+\]\s+(.+)|^((?:PLAY|TASK) \[.*\])')
+
+    def __init__(self, name, tool):
+        self.name = name
+        self.tool = tool
+        self.path = f'{virtup_data_home}/logs/{name}/{tool}.log'
+        self.errors = collections.deque(maxlen=10)
+
+    def __enter__(self):
+        mkdir_p(os.path.dirname(self.path))
+        self.fp = open(self.path, 'a', buffering=2**16)
+        self.fp.write(f"--- {datetime.datetime.now()} {self.tool}\n")
+        log.debug(f"Writing {self.tool} output to '{self.path}'.")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.fp.close()
+        if exc_type is not None:
+            for line in self.errors:
+                log.error(f"{self.name}: {line}")
+            log.error(f"{self.name}: {self.tool} failed; see '{self.path}'.")
+
+    def out(self, line):
+        self.fp.write(line)
+        match = self.progress.match(line)
+        if match:
+            log.info(f"{self.name}: {(match.group(1) or match.group(2)).strip()}")
+
+    def err(self, line):
+        self.fp.write(line)
+        line = line.rstrip()
+        if line:
+            self.errors.append(line)
+
+class Timings:
+    """
+    Saved phase timings.
+
+    The elapsed time of each phase of an instance operation is appended
+    to the timings file as one json object per line, so the time spent
+    building and cloning instances can be summarized later.
+    """
+    filename = f'{virtup_data_home}/timings.jsonl'
 
-    def _read(self):
+    @classmethod
+    def record(cls, operation, phase, name, template, elapsed, status='ok'):
+        entry = {
+            'time': str(datetime.datetime.now()),
+            'operation': operation,
+            'phase': phase,
+            'instance': name,
+            'template': template,
+            'elapsed': round(elapsed, 3),
+            'status': status,
+        }
+        mkdir_p(os.path.dirname(cls.filename))
+        with open(cls.filename, 'a') as fp:
+            fp.write(json.dumps(entry) + '\n')
+
+    @classmethod
+    def entries(cls):
+        """
+        Generator to list each saved timing entry.
+        """
         try:
-            with open(self.filename) as fp:
-                self.addrs = json.load(fp)
+            with open(cls.filename) as fp:
+                for line in fp:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        log.debug(f"Skipping malformed timing entry: {line.rstrip()}")
         except FileNotFoundError:
             pass
 
-    def _write(self):
-        mkdir_p(os.path.dirname(self.filename))
-        with open(self.filename, 'w') as fp:
-            json.dump(self.addrs, fp, indent=4)
+    @classmethod
+    def percentile(cls, values, pct):
+        """
+        Nearest-rank percentile of a list of values.
+        """
+        values = sorted(values)
+        if not values:
+            return None
+        rank = max(1, math.ceil(pct / 100 * len(values)))
+        return values[rank - 1]
 
-    def lookup(self, name):
-        return self.addrs.get(name)
+    @classmethod
+    def summary(cls, template=None):
+        """
+        Summarize the successful timings by operation and phase.
 
-    def update(self, name, mac):
-        old_mac = self.addrs.get(name)
-        if old_mac is None or old_mac != mac:
-            self.addrs[name] = mac
-            self._write()
+        Returns a list of (operation, phase, count, p50, p95) tuples.
+        """
+        elapsed = {}
+        for entry in cls.entries():
+            if template and entry.get('template') != template:
+                continue
+            if entry.get('status') != 'ok':
+                continue
+            key = (entry['operation'], entry['phase'])
+            elapsed.setdefault(key, []).append(entry['elapsed'])
+        summary = []
+        for (operation, phase), values in elapsed.items():
+            summary.append((operation, phase, len(values),
+                            cls.percentile(values, 50),
+                            cls.percentile(values, 95)))
+        return summary
+
+class Span:
+    """
+    Context manager to time one phase of an instance operation.
+    """
+    def __init__(self, operation, phase, name, template=None):
+        self.operation = operation
+        self.phase = phase
+        self.name = name
+        self.template = template
 
-    def erase(self, name):
-        if self.addrs.pop(name, None):
-            self._write()
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        elapsed = time.monotonic() - self.started
+        status = 'ok' if exc_type is None else 'error'
+        log.debug(f"{self.operation} {self.phase} '{self.name}': {elapsed:.3f} seconds ({status}).")
+        Span.record(self.operation, self.phase, self.name, self.template, elapsed, status)
 
-def query_storage_pool(name):
+    @staticmethod
+    def record(operation, phase, name, template, elapsed, status='ok'):
+        """
+        Record a timing. Failing to write the timings file does not fail
+        the operation which was timed.
+        """
+        try:
+            Timings.record(operation, phase, name, template, elapsed, status)
+        except OSError as e:
+            log.warning(f"Unable to record timings: {e}")
+
+# Storage pool paths, keyed by uri and pool name.
+_pool_paths = {}
+
+def query_storage_pool(name, uri=None):
     """
-    Lookup a storage pool path.
+    Lookup a storage pool path. The path is cached, since it does not
+    change while the pool is defined.
     """
-    with Connection() as conn:
+    path = _pool_paths.get((uri, name))
+    if path:
+        return path
+    with Connection(uri) as conn:
         pool = conn.storagePoolLookupByName(name)
         root = xml.etree.ElementTree.fromstring(pool.XMLDesc())
         path = root.find('target/path')
@@ -322,28 +737,231 @@ def query_storage_pool(name):
         path = path.text
         if not path:
             raise LookupError(f"Path is empty in storage pool '{name}'.")
+        _pool_paths[(uri, name)] = path
         return path
 
+# Storage pool placement policies.
+pool_policies = ('round-robin', 'most-free', 'least-overlays')
+
+def _next_pool_index(count):
+    """
+    Returns the next round-robin index, shared by all virt-up processes.
+    """
+    with open(f'{runtime_dir()}/pool-index', 'a+') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        fp.seek(0)
+        try:
+            index = int(fp.read() or 0)
+        except ValueError:
+            index = 0
+        fp.seek(0)
+        fp.truncate()
+        fp.write(str(index + 1))
+    return index % count
+
+def select_storage_pool(pools, policy='round-robin', uri=None):
+    """
+    Select the storage pool for a new image from a list of pool names.
+    Returns the pool name and path.
+    """
+    if not pools:
+        raise ValueError("No storage pools are defined.")
+    if len(pools) == 1:
+        name = pools[0]
+    elif policy == 'round-robin':
+        name = pools[_next_pool_index(len(pools))]
+    elif policy == 'most-free':
+        available = {}
+        with Connection(uri) as conn:
+            for pool in pools:
+                available[pool] = conn.storagePoolLookupByName(pool).info()[3]
+        name = max(pools, key=lambda p: available[p])
+    elif policy == 'least-overlays':
+        # Count the clones on this host from the metadata, without looking
+        # up the domains. The image directory is used when the pool of a
+        # clone is not recorded.
+        paths = {query_storage_pool(p, uri): p for p in pools}
+        overlays = dict.fromkeys(pools, 0)
+        for _, meta in metadata_store().items():
+            if 'cloned' not in meta or meta.get('uri') != uri:
+                continue
+            pool = meta.get('pool')
+            if pool not in overlays:
+                pool = paths.get(os.path.dirname(meta.get('disk', '')))
+            if pool:
+                overlays[pool] += 1
+        name = min(pools, key=lambda p: overlays[p])
+    else:
+        raise ValueError(f"Unknown storage pool policy '{policy}'.")
+    path = query_storage_pool(name, uri)
+    if not os.access(path, os.R_OK | os.W_OK):
+        raise PermissionError(f"Read and write access is required for path '{path}'.")
+    log.debug(f"Selected storage pool '{name}' ({policy}).")
+    return name, path
+
+def host_capacity(uri, cpu_ratio=1.0):
+    """
+    Returns the free memory, in MiB, and the number of cpus not assigned
+    to running domains of a host. The memory of the running domains is
+    counted as used, even when not yet touched by the guests. The number
+    of cpus is multiplied by cpu_ratio to allow overcommit.
+    """
+    with Connection(uri) as conn:
+        info = conn.getInfo() # model, memory, cpus, ...
+        domains = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        infos = [d.info() for d in domains] # state, max memory, memory, vcpus, cpu time
+        free = info[1] - sum(i[2] for i in infos) // 1024
+        try:
+            free = min(free, conn.getFreeMemory() // 2**20)
+        except libvirt.libvirtError:
+            pass # Not supported by all drivers.
+    return free, int(info[2] * cpu_ratio) - sum(i[3] for i in infos)
+
+def select_host(hosts, memory, vcpus, cpu_ratio=1.0):
+    """
+    Select the host for a new instance from a list of libvirt uris. The
+    host with the most free memory is selected from the hosts with enough
+    free memory and cpus, or from all of the hosts if none have enough.
+    """
+    capacity = {}
+    for uri in hosts:
+        try:
+            capacity[uri] = host_capacity(uri, cpu_ratio)
+        except libvirt.libvirtError as e:
+            log.warning(f"Skipping host '{uri}': {e}")
+    if not capacity:
+        raise ConnectionError("None of the hosts are available.")
+    for uri, (free, cpus) in capacity.items():
+        log.debug(f"Host '{uri}': {free} MiB free memory, {cpus} free cpus.")
+    fits = [u for u, (free, cpus) in capacity.items() if free >= int(memory) and cpus >= int(vcpus)]
+    if not fits:
+        log.warning(f"No host has {memory} MiB of free memory and {vcpus} free cpus.")
+        fits = list(capacity)
+    uri = max(fits, key=lambda u: capacity[u])
+    log.info(f"Selected host '{uri}'.")
+    return uri
+
+def virt_builder_cache():
+    """
+    Returns the virt-builder cache directory and the set of the cached
+    templates, as (os-version, arch) tuples.
+    """
+    out = io.StringIO()
+    virt_builder('--print-cache', _out=out)
+    directory = None
+    cached = set()
+    for line in out.getvalue().splitlines():
+        if line.startswith('cache directory:'):
+            directory = line.split(':', 1)[1].strip()
+            continue
+        fields = line.split()
+        if len(fields) == 3 and fields[2] == 'cached':
+            cached.add((fields[0], fields[1]))
+    return directory, cached
+
+def prefetch_templates(templates, jobs=4):
+    """
+    Download the virt-builder templates of template definitions into the
+    virt-builder cache, at most jobs at a time, so builds do not wait on
+    downloads. virt-builder has no option to download one template, so
+    each missing template is built to a scratch image which is deleted.
+
+    Returns a list of dictionaries of the os-version, arch, the template
+    definition names, whether the template was cached already, the size
+    of the cached files, and the error which prevented the download. The
+    arch is the template arch, or the host arch when it is not set.
+    """
+    host_arch = os.uname().machine
+    directory, cached = virt_builder_cache()
+    entries = {}
+    for settings in templates:
+        if not settings.os_version:
+            log.warning(f"Skipping template '{settings.template_name}'; os-version is not defined.")
+            continue
+        arch = settings.arch or host_arch
+        entry = entries.setdefault((settings.os_version, arch), {
+            'os_version': settings.os_version,
+            'arch': arch,
+            'templates': [],
+            'cached': (settings.os_version, arch) in cached,
+            'size': 0,
+            'error': None,
+        })
+        entry['templates'].append(settings.template_name)
+
+    def download(entry):
+        name = f"{entry['os_version']}.{entry['arch']}"
+        log.info(f"Downloading virt-builder template '{name}'.")
+        mkdir_p(virtup_data_home)
+        with tempfile.TemporaryDirectory(prefix='prefetch-', dir=virtup_data_home) as scratch, \
+             ToolLog('prefetch', f'virt-builder-{name}') as tool_log:
+            virt_builder(entry['os_version'], '--arch', entry['arch'],
+                         '--output', f'{scratch}/{name}.img',
+                         '--format', 'raw', '--no-sync',
+                         _out=tool_log.out, _err=tool_log.err)
+
+    missing = [e for e in entries.values() if not e['cached']]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(contextvars.copy_context().run, download, e): e for e in missing}
+        for future in concurrent.futures.as_completed(futures):
+            entry = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                log.error(f"Failed to download virt-builder template '{entry['os_version']}.{entry['arch']}': {e}")
+                entry['error'] = str(e)
+
+    if directory is None:
+        directory, _ = virt_builder_cache()
+    for entry in entries.values():
+        if directory:
+            for path in glob.glob(f"{directory}/{entry['os_version']}.{entry['arch']}.*"):
+                entry['size'] += os.path.getsize(path)
+    return [entries[key] for key in sorted(entries)]
+
 class Instance:
     """
     A libvirt domain with metadata.
     """
-    def __init__(self, name, meta=None):
+    def __init__(self, name, meta=None, write=True):
+        """
+        Attach to the domain and read the metadata. The given meta fields
+        are updated and written, unless write is false, in which case they
+        are written when the next transaction ends.
+        """
         self.name = name
-        self.metafile = f'{virtup_data_home}/instance/{name}.json'
         self.meta = {}
         self._mac = None
         self._disks = None
-        self._attach()
+        self._transactions = 0
+        self._dirty = False
+        self._attach(meta.get('uri') if meta else None)
         if meta:
-            self._update_meta(meta)
+            self._update_meta(meta, write=write)
 
-    def _attach(self):
-        with Connection() as conn:
-            self.domain = conn.lookupByName(self.name)
+    def _attach(self, uri=None):
         self._read_meta()
+        self.uri = uri or self.meta.get('uri')
+        with Connection(self.uri) as conn:
+            self.domain = conn.lookupByName(self.name)
 
-    def _update_meta(self, meta):
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Group metadata updates into one write when the outermost transaction
+        ends. The changes are written even when the transaction ends with an
+        exception, since the metadata describes the domain and images which
+        were already changed.
+        """
+        self._transactions += 1
+        try:
+            yield self
+        finally:
+            self._transactions -= 1
+            if self._transactions == 0 and self._dirty:
+                self._write_meta()
+
+    def _update_meta(self, meta, write=True):
         changed = []
         for key in meta:
             value = meta[key]
@@ -353,21 +971,26 @@ class Instance:
         if changed:
             changed = ', '.join(changed)
             log.debug(f"Updating metadata fields: {changed}")
-            self._write_meta()
+            self._dirty = True
+            if write and self._transactions == 0:
+                self._write_meta()
 
     def _read_meta(self):
-        try:
-            with open(self.metafile, 'r') as fp:
-                self.meta = json.load(fp)
-        except FileNotFoundError:
-            pass
+        self.meta = metadata_store().get(self.name) or {}
 
     def _write_meta(self):
-        log.debug(f"Writing metafile '{self.metafile}'.")
-        mkdir_p(os.path.dirname(self.metafile))
-        flags = os.O_CREAT | os.O_TRUNC | os.O_RDWR
-        with os.fdopen(os.open(self.metafile, flags, 0o600), 'w') as fp:
-            json.dump(self.meta, fp, indent=4)
+        log.debug(f"Writing metadata of '{self.name}'.")
+        metadata_store().put(self.name, self.meta)
+        self._dirty = False
+
+    def _record(self, event, detail=None):
+        """
+        Add an event to the instance history.
+        """
+        metadata_store().record(self.name, event, detail)
+
+    def _span(self, operation, phase):
+        return Span(operation, phase, self.name, self.meta.get('template'))
 
     def is_clone(self):
         return 'cloned' in self.meta
@@ -399,79 +1022,495 @@ class Instance:
         """
         if not self.domain.isActive():
             log.info(f"Starting instance '{self.name}'.")
-            for retries in range(120, -1, -1):
-                try:
-                    self.domain.create()
-                except libvirt.libvirtError as e:
-                    if e.get_error_code() == libvirt.VIR_ERR_OPERATION_INVALID:
-                        pass  # domain is running
-                    else:
-                        raise e
-                if self.domain.isActive():
-                    return
-                if retries > 0:
-                    log.debug(f"Waiting for running state; {retries} left.")
-                    time.sleep(2)
-            if not self.domain.isActive():
-                raise TimeoutError(f"Failed to start instance '{self.name}'.")
+            with self._span('start', 'total'):
+                for retries in range(120, -1, -1):
+                    try:
+                        self.domain.create()
+                    except libvirt.libvirtError as e:
+                        if e.get_error_code() == libvirt.VIR_ERR_OPERATION_INVALID:
+                            pass  # domain is running
+                        else:
+                            raise e
+                    if self.domain.isActive():
+                        return
+                    if retries > 0:
+                        log.debug(f"Waiting for running state; {retries} left.")
+                        time.sleep(2)
+                if not self.domain.isActive():
+                    raise TimeoutError(f"Failed to start instance '{self.name}'.")
 
-    def stop(self):
+    def stop(self, grace=None):
         """
-        Shutdown the instance.
+        Shutdown the instance. If a grace period is given, in seconds, the
+        instance is destroyed when it is still running after the grace
+        period.
         """
+        if grace is not None:
+            errors = Instance.stop_all([self], grace=grace)
+            if errors:
+                raise errors[self.name]
+            return
         if self.domain.isActive():
             log.info(f"Stopping instance '{self.name}'.")
-            for retries in range(120, -1, -1):
+            with self._span('stop', 'total'):
+                for retries in range(120, -1, -1):
+                    try:
+                        self.domain.shutdown()
+                    except libvirt.libvirtError as e:
+                        if e.get_error_code() == libvirt.VIR_ERR_OPERATION_INVALID:
+                            pass  # domain is not running
+                        else:
+                            raise e
+                    if not self.domain.isActive():
+                        return
+                    if retries > 0:
+                        log.debug(f"Waiting for shutdown state; {retries} left.")
+                        time.sleep(2)
+                if self.domain.isActive():
+                    raise TimeoutError(f"Failed to stop instance '{self.name}'.")
+
+    @classmethod
+    def start_all(cls, instances, jobs=8):
+        """
+        Start instances in parallel. Returns a dictionary of the instance
+        names and the errors which prevented them from being started.
+        """
+        errors = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(contextvars.copy_context().run, i.start): i for i in instances}
+            for future in concurrent.futures.as_completed(futures):
+                instance = futures[future]
                 try:
-                    self.domain.shutdown()
-                except libvirt.libvirtError as e:
-                    if e.get_error_code() == libvirt.VIR_ERR_OPERATION_INVALID:
-                        pass  # domain is not running
-                    else:
-                        raise e
-                if not self.domain.isActive():
-                    return
-                if retries > 0:
-                    log.debug(f"Waiting for shutdown state; {retries} left.")
-                    time.sleep(2)
-            if self.domain.isActive():
-                raise TimeoutError(f"Failed to stop instance '{self.name}'.")
+                    future.result()
+                except Exception as e:
+                    log.error(f"Failed to start instance '{instance.name}': {e}")
+                    errors[instance.name] = e
+        return errors
+
+    @classmethod
+    def stop_all(cls, instances, grace=60):
+        """
+        Shutdown instances together. The shutdown request is repeated
+        until the instances are stopped, since guests may miss it while
+        booting, and the instances still running after the grace period,
+        in seconds, are destroyed. Returns a dictionary of the instance
+        names and the errors which prevented them from being stopped.
+        """
+        errors = {}
+        def signal(instance, request):
+            try:
+                request()
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
+                    log.error(f"Failed to stop instance '{instance.name}': {e}")
+                    errors[instance.name] = e
+
+        running = [i for i in instances if i.domain.isActive()]
+        for instance in running:
+            log.info(f"Stopping instance '{instance.name}'.")
+        deadline = time.monotonic() + grace
+        resend = 0
+        while running and time.monotonic() < deadline:
+            if time.monotonic() >= resend:
+                for instance in running:
+                    signal(instance, instance.domain.shutdown)
+                resend = time.monotonic() + 10
+            time.sleep(1)
+            running = [i for i in running if i.name not in errors and i.domain.isActive()]
+        for instance in running:
+            log.warning(f"Instance '{instance.name}' did not shutdown in {grace} seconds; destroying.")
+            signal(instance, instance.domain.destroy)
+        return errors
+
+    def in_use(self):
+        """
+        Returns the names of the clones which use the image of this
+        instance as their backing file.
+        """
+        store = metadata_store()
+        in_use = []
+        for name in store.clones(self.name):
+            meta = store.get(name) or {}
+            if meta.get('image_format', '') == 'qcow2':
+                in_use.append(name)
+        return in_use
 
     def delete(self):
         """
         Delete the instance, disk images, and instance meta data.
         """
-        in_use = []
-        for instance in Instance.all():
-            from_ = instance.meta.get('from', '')
-            format_ = instance.meta.get('image_format', '')
-            if from_ == self.name and format_ == 'qcow2':
-                in_use.append(instance.name)
+        store = metadata_store()
+        in_use = self.in_use()
         if in_use:
             in_use = ', '.join(["'%s'" %x for x in in_use])
             log.error(f"Unable to delete '{self.name}'; in use by {in_use}.")
             return 1
 
         log.info(f"Destroying instance '{self.name}'.")
-        rm_f(self.metafile)
-        self.meta = None
-        if self.domain.isActive():
-            self.domain.destroy()  # Pull the plug.
-        with Connection() as conn:
-            for disk in self.disks():
-                source = disk['source']
-                volume = conn.storageVolLookupByPath(source)
-                if volume:
-                    log.info(f"Deleting volume '{source}'.")
-                    volume.delete()
-        log.info(f"Undefining domain '{self.name}'.")
-        self.domain.undefine()
+        base = self.meta.get('from')
+        with self._span('delete', 'total'):
+            with store.transaction():
+                store.delete(self.name)
+                store.record(self.name, 'deleted')
+            rm_f(self._saved_state_path())
+            self.meta = None
+            if self.domain.isActive():
+                self.domain.destroy()  # Pull the plug.
+            with Connection(self.uri) as conn:
+                for disk in self.disks():
+                    source = disk['source']
+                    volume = conn.storageVolLookupByPath(source)
+                    if volume:
+                        log.info(f"Deleting volume '{source}'.")
+                        volume.delete()
+            log.info(f"Undefining domain '{self.name}'.")
+            self.domain.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA)
         self.domain = None
         self.name = None
         self._disks = None
         self._mac = None
         self._address = None
         Instance.update_inventory()
+        if base:
+            Instance._delete_retired(base)
+
+    @classmethod
+    def _delete_retired(cls, name):
+        """
+        Delete a retired base instance when its last clone is deleted.
+        """
+        meta = metadata_store().get(name)
+        if not meta or 'retired' not in meta:
+            return
+        instance = Instance(name)
+        if instance.in_use():
+            return
+        log.info(f"Deleting retired base instance '{name}'.")
+        instance.delete()
+
+    def compact(self, settings):
+        """
+        Trim the free space in the image and rewrite it with a compact
+        layout, optionally compressed. The instance is stopped. The image
+        size before and after is saved in the metadata.
+        """
+        image = self.meta['disk']
+        image_format = self.meta.get('image_format', 'qcow2')
+        before = allocated_size(image)
+        self.stop()
+        with LockFile():
+            log.info(f"Trimming free space in image file '{image}'.")
+            with ToolLog(self.name, 'virt-sparsify') as tool_log:
+                virt_sparsify('--in-place', *settings.virt_sparsify_args, image,
+                              _out=tool_log.out, _err=tool_log.err)
+            extra_args = list(settings.qemu_img_convert_args)
+            if settings.compress:
+                if image_format == 'qcow2':
+                    extra_args.append('-c')
+                else:
+                    log.warning(f"Not compressing image file '{image}'; requires the qcow2 image format.")
+            log.info(f"Compacting image file '{image}'.")
+            tmp = f'{image}.compact'
+            try:
+                with ToolLog(self.name, 'qemu-img') as tool_log:
+                    qemu_img.convert('-f', image_format, '-O', image_format, *extra_args, image, tmp,
+                                     _out=tool_log.out, _err=tool_log.err)
+                os.replace(tmp, image)
+            finally:
+                rm_f(tmp)
+        after = allocated_size(image)
+        log.info(f"Compacted image file '{image}' from {before // 2**20} MiB to {after // 2**20} MiB.")
+        self._update_meta({'compacted': {
+            'before': before,
+            'after': after,
+            'compressed': settings.compress and image_format == 'qcow2',
+            'date': str(datetime.datetime.now()),
+        }})
+
+    def prefetch(self):
+        """
+        Warm the page cache with the image of this base instance, and the
+        saved state when clones are restored from it, so a burst of new
+        clones does not fault in the backing file with random reads.
+        """
+        paths = [self.meta['disk']]
+        saved = self.meta.get('saved_state', {}).get('path')
+        if saved and os.path.exists(saved):
+            paths.append(saved)
+        total = 0
+        with self._span('prefetch', 'total'):
+            for path in paths:
+                log.debug(f"Prefetching file '{path}'.")
+                total += prefetch_file(path)
+        log.info(f"Prefetched {total // 2**20} MiB of instance '{self.name}'.")
+        return total
+
+    # Name of the snapshot used to reset instances.
+    clean_snapshot = 'virt-up-clean'
+
+    def snapshot(self):
+        """
+        Take the clean snapshot to be restored by reset().
+
+        An internal snapshot of the disk and memory state is taken, so
+        a reset instance resumes running with the same mac address, address,
+        and credentials. The previous clean snapshot is replaced. Requires
+        the qcow2 image format.
+        """
+        image_format = self.meta.get('format', self.meta.get('image_format'))
+        if image_format != 'qcow2':
+            raise ValueError(f"Snapshots require the qcow2 image format; '{self.name}' is '{image_format}'.")
+        log.info(f"Taking snapshot of instance '{self.name}'.")
+        with self._span('snapshot', 'total'):
+            try:
+                self.domain.snapshotLookupByName(self.clean_snapshot).delete()
+            except libvirt.libvirtError as e:
+                if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN_SNAPSHOT:
+                    raise e
+            self.domain.snapshotCreateXML(
+                '<domainsnapshot>'
+                f'<name>{self.clean_snapshot}</name>'
+                '<description>virt-up clean state</description>'
+                '</domainsnapshot>')
+        self._update_meta({'snapshot': str(datetime.datetime.now())})
+        self._record('snapshot')
+
+    def reset(self):
+        """
+        Revert the instance to the clean snapshot.
+        """
+        if 'snapshot' not in self.meta:
+            raise LookupError(f"Instance '{self.name}' does not have a clean snapshot.")
+        log.info(f"Resetting instance '{self.name}'.")
+        with self._span('reset', 'total'):
+            snapshot = self.domain.snapshotLookupByName(self.clean_snapshot)
+            self.domain.revertToSnapshot(snapshot, libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_RUNNING)
+        self._record('reset')
+
+    def agent_command(self, command, arguments=None, timeout=30):
+        """
+        Send a command to the qemu guest agent and return the result.
+        """
+        import libvirt_qemu
+        request = {'execute': command}
+        if arguments is not None:
+            request['arguments'] = arguments
+        reply = libvirt_qemu.qemuAgentCommand(self.domain, json.dumps(request), timeout, 0)
+        return json.loads(reply).get('return')
+
+    def agent_ready(self):
+        """
+        Returns true if the qemu guest agent responds to a ping.
+        """
+        try:
+            self.agent_command('guest-ping', timeout=5)
+            return True
+        except libvirt.libvirtError as e:
+            if e.get_error_code() not in (libvirt.VIR_ERR_AGENT_UNRESPONSIVE,
+                                          libvirt.VIR_ERR_AGENT_UNSYNCED,
+                                          libvirt.VIR_ERR_OPERATION_INVALID):
+                raise e
+            return False
+
+    def wait_for_agent(self):
+        """
+        Wait until the qemu guest agent responds.
+        """
+        for retries in range(120, -1, -1):
+            if self.agent_ready():
+                return True
+            if retries > 0:
+                suffix = 'ies' if retries > 1 else 'y'
+                log.debug(f"Waiting for instance '{self.name}' guest agent; {retries} retr{suffix} left.")
+                time.sleep(2)
+        raise TimeoutError(f"Guest agent of instance '{self.name}' is not responding.")
+
+    def guest_exec(self, path, args=(), input=None, timeout=120):
+        """
+        Run a command with the qemu guest agent and return the exit code,
+        stdout, and stderr as a tuple.
+        """
+        arguments = {'path': path, 'arg': [str(a) for a in args], 'capture-output': True}
+        if input is not None:
+            arguments['input-data'] = base64.b64encode(input.encode()).decode()
+        pid = self.agent_command('guest-exec', arguments)['pid']
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            status = self.agent_command('guest-exec-status', {'pid': pid})
+            if status.get('exited'):
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Command '{path}' timed out on instance '{self.name}'.")
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+        out = base64.b64decode(status.get('out-data', '')).decode(errors='replace')
+        err = base64.b64decode(status.get('err-data', '')).decode(errors='replace')
+        code = status.get('exitcode', -status.get('signal', 1))
+        return code, out, err
+
+    def _saved_state_path(self):
+        return f'{virtup_data_home}/saved/{self.name}.save'
+
+    def save_state(self):
+        """
+        Save the running state of this base instance, so clones can be
+        restored from it instead of booting. The state is saved once, and
+        saved again only if the base image has been changed since.
+        Returns the path of the save image.
+
+        The base instance must be booted to save its state, which writes
+        to its image, so the state is not saved while the image is the
+        backing file of clones.
+        """
+        path = self._saved_state_path()
+        with LockFile():
+            # Another clone may have saved the state while we waited.
+            self._read_meta()
+            saved = self.meta.get('saved_state', {})
+            disk_mtime = os.stat(self.meta['disk']).st_mtime_ns
+            if os.path.exists(path) and saved.get('disk_mtime') == disk_mtime and not self.domain.isActive():
+                return path
+            in_use = self.in_use()
+            if in_use:
+                in_use = ', '.join(["'%s'" % x for x in in_use])
+                raise FileExistsError(f"Unable to save the state of '{self.name}'; "
+                                      f"its image is the backing file of {in_use}.")
+            log.info(f"Saving the running state of instance '{self.name}'.")
+            self.start()
+            self.address()
+            self.wait_for_agent()
+            mkdir_p(os.path.dirname(path))
+            rm_f(path)
+            self.domain.save(path) # Stops the domain.
+            self._update_meta({'saved_state': {
+                'path': path,
+                'saved': str(datetime.datetime.now()),
+                'disk_mtime': os.stat(self.meta['disk']).st_mtime_ns,
+            }})
+        return path
+
+    def _restore_clone(self, save_image, target, target_image, mac, hostname,
+                       root_creds, user_creds, settings):
+        """
+        Create the target domain by restoring the saved state of this
+        instance with the target name, disk, and mac address, then give
+        the guest its new identity with the guest agent.
+        """
+        with Connection(self.uri) as conn:
+            root = xml.etree.ElementTree.fromstring(conn.saveImageGetXMLDesc(
+                save_image, libvirt.VIR_DOMAIN_SAVE_IMAGE_XML_SECURE))
+        root.find('name').text = target
+        root.find('uuid').text = str(uuid.uuid4())
+        for disk in root.findall('devices/disk'):
+            source = disk.find('source')
+            if source is not None and source.get('file') == self.meta['disk']:
+                source.set('file', target_image)
+        old_mac = None
+        for interface in root.findall('devices/interface'):
+            old_mac = interface.find('mac').get('address')
+            interface.find('mac').set('address', mac)
+            break # Only the first interface is supported.
+        for seclabel in root.findall('seclabel'):
+            if seclabel.get('type') == 'dynamic':
+                for element in seclabel.findall('label') + seclabel.findall('imagelabel'):
+                    seclabel.remove(element)
+        for channel in root.findall('devices/channel'):
+            source = channel.find('source')
+            if channel.get('type') == 'unix' and source is not None and '/channel/target/' in source.get('path', ''):
+                channel.remove(source) # Let libvirt generate the path.
+
+        # Restore a copy of the saved state with the new identity. The guest
+        # is kept paused until the link is down, so the old mac address is
+        # never seen on the network.
+        target_save = f'{os.path.dirname(save_image)}/{target}.save'
+        try:
+            cp('--reflink=auto', save_image, target_save)
+            saveimage.write_xml(target_save, xml.etree.ElementTree.tostring(root, encoding='unicode'))
+            admission = Admission(target, self.uri, self.meta['memory'], self.meta['vcpus'], settings)
+            with admission, Connection(self.uri) as conn:
+                log.info(f"Restoring instance '{target}' from '{save_image}'.")
+                conn.restoreFlags(target_save, None, libvirt.VIR_DOMAIN_SAVE_PAUSED)
+                domain = conn.lookupByName(target)
+                conn.defineXML(domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE |
+                                              libvirt.VIR_DOMAIN_XML_SECURE))
+        finally:
+            rm_f(target_save)
+        domain.setAutostart(1)
+        self._set_link(domain, mac, 'down')
+        domain.resume()
+
+        instance = Instance.__new__(Instance)
+        instance.name = target
+        instance.uri = self.uri
+        instance.domain = domain
+        instance.meta = {}
+        instance.wait_for_agent()
+        try:
+            instance.agent_command('guest-set-time')
+        except libvirt.libvirtError as e:
+            log.debug(f"Unable to set guest time: {e}")
+
+        # Give the guest its new identity.
+        user = user_creds.username
+        home = f'/home/{user}'
+        with open(f'{user_creds.ssh_identity}.pub') as fp:
+            pubkey = fp.read().strip()
+        with open(user_creds.ssh_identity) as fp:
+            privkey = fp.read()
+        script = [
+            'set -e',
+            f'for d in /sys/class/net/*; do if [ "$(cat $d/address)" = "{old_mac}" ]; then '
+            f'ip link set dev ${{d##*/}} address {mac}; fi; done',
+            f'hostname {shlex.quote(hostname)}',
+            f'echo {shlex.quote(hostname)} > /etc/hostname',
+            'rm -f /etc/machine-id',
+            'systemd-machine-id-setup >/dev/null 2>&1 || dbus-uuidgen > /etc/machine-id',
+            'rm -f /etc/ssh/ssh_host_*',
+            'ssh-keygen -A >/dev/null',
+            '(systemctl restart sshd || systemctl restart ssh) >/dev/null 2>&1 || true',
+        ]
+        if user != self.meta['user']['username']:
+            script.append(f'id {user} >/dev/null 2>&1 || useradd -m -s /bin/bash {user}')
+        script.extend([
+            f'install -d -m 700 -o {user} -g $(id -gn {user}) {home}/.ssh',
+            f'echo {shlex.quote(pubkey)} >> {home}/.ssh/authorized_keys',
+            f'chown {user}: {home}/.ssh/authorized_keys',
+        ])
+        code, _, err = instance.guest_exec('/bin/sh', ['-c', '\n'.join(script)])
+        if code != 0:
+            raise RuntimeError(f"Failed to prepare restored instance '{target}': {err.strip()}")
+        passwords = f'root:{root_creds.password}\n{user}:{user_creds.password}\n'
+        code, _, err = instance.guest_exec('/usr/sbin/chpasswd', input=passwords)
+        if code != 0:
+            raise RuntimeError(f"Failed to set passwords on instance '{target}': {err.strip()}")
+        key = f'{home}/.ssh/{os.path.basename(user_creds.ssh_identity)}'
+        code, _, err = instance.guest_exec('/bin/sh', ['-c',
+            f'umask 077; cat > {key}; chown {user}: {key}'], input=privkey)
+        if code != 0:
+            raise RuntimeError(f"Failed to copy ssh key to instance '{target}': {err.strip()}")
+
+        # Renew the network configuration with the new mac address.
+        self._set_link(domain, mac, 'up')
+        code, _, err = instance.guest_exec('/bin/sh', ['-c', settings.restore_network_command])
+        if code != 0:
+            log.warning(f"Network refresh failed on instance '{target}': {err.strip()}")
+
+    @staticmethod
+    def _set_link(domain, mac, state):
+        """
+        Set the link state of the interface with the given mac address.
+        """
+        root = xml.etree.ElementTree.fromstring(domain.XMLDesc())
+        for interface in root.findall('devices/interface'):
+            if interface.find('mac').get('address') != mac:
+                continue
+            link = interface.find('link')
+            if link is None:
+                link = xml.etree.ElementTree.SubElement(interface, 'link')
+            link.set('state', state)
+            domain.updateDeviceFlags(xml.etree.ElementTree.tostring(interface, encoding='unicode'),
+                                     libvirt.VIR_DOMAIN_AFFECT_LIVE)
 
     def _ia_to_addresses(self, ia):
         """
@@ -570,11 +1609,11 @@ class Instance:
         """
         Verify the address is pingable.
         """
-        ping = sh.Command('ping')
+        from virt_up.runner import ErrorReturnCode
         try:
             ping('-c', 2, address)
             return True
-        except sh.ErrorReturnCode as e:
+        except ErrorReturnCode as e:
             log.debug(f"Unable to ping address '{address}'; ping code {e.exit_code}.")
             return False
 
@@ -631,16 +1670,17 @@ class Instance:
             self.start()
 
         address_source = self.meta.get('address-source', 'agent')
-        if address_source == 'agent':
-            address = self._address_from_ia(source='agent')
-        elif address_source == 'lease':
-            address = self._address_from_ia(source='lease')
-        elif address_source == 'arp':
-            address = self._address_from_arp()
-        elif address_source == 'dns':
-            address = self._address_from_dns()
-        else:
-            raise ValueError(f"Invalid address_source '{address_source}' in instance '{self.name}'.")
+        with self._span('address', address_source):
+            if address_source == 'agent':
+                address = self._address_from_ia(source='agent')
+            elif address_source == 'lease':
+                address = self._address_from_ia(source='lease')
+            elif address_source == 'arp':
+                address = self._address_from_arp()
+            elif address_source == 'dns':
+                address = self._address_from_dns()
+            else:
+                raise ValueError(f"Invalid address_source '{address_source}' in instance '{self.name}'.")
 
         self._update_meta({'address': address})
         log.info(f"Instance '{self.name}' has address '{address}'.")
@@ -651,42 +1691,107 @@ class Instance:
         Wait for open port.
         """
         address = self.address()
-        for retries in range(120, -1, -1):
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            try:
-                s.settimeout(2)
-                s.connect((address, int(port)))
-                return True
-            except:
-                pass
-            finally:
+        with self._span('wait', f'port {port}'):
+            for retries in range(120, -1, -1):
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 try:
-                    s.shutdown(socket.SHUT_RDWR)
-                    s.close()
+                    s.settimeout(2)
+                    s.connect((address, int(port)))
+                    return True
                 except:
                     pass
-            if retries > 0:
-                suffix = 'ies' if retries > 1 else 'y'
-                log.debug(f"Waiting for open port '{port}' on address '{address}'; {retries} retr{suffix} left.")
-                time.sleep(2)
+                finally:
+                    try:
+                        s.shutdown(socket.SHUT_RDWR)
+                        s.close()
+                    except:
+                        pass
+                if retries > 0:
+                    suffix = 'ies' if retries > 1 else 'y'
+                    log.debug(f"Waiting for open port '{port}' on address '{address}'; {retries} retr{suffix} left.")
+                    time.sleep(2)
 
-        raise LookupError(f"Unable to connect to '{address}:{port}'.")
+            raise LookupError(f"Unable to connect to '{address}:{port}'.")
 
     @classmethod
     def all(cls):
-        pattern = f'{virtup_data_home}/instance/*.json'
-        for path in glob.glob(pattern):
-            name = os.path.basename(path).replace('.json', '')
+        for name, meta in metadata_store().items():
+            if 'cloning' in meta:
+                continue # No domain yet.
             yield Instance(name)
 
+    # libvirt domain states
+    states = {
+        libvirt.VIR_DOMAIN_NOSTATE: 'nostate',
+        libvirt.VIR_DOMAIN_RUNNING: 'running',
+        libvirt.VIR_DOMAIN_BLOCKED: 'blocked',
+        libvirt.VIR_DOMAIN_PAUSED: 'paused',
+        libvirt.VIR_DOMAIN_SHUTDOWN: 'shutdown',
+        libvirt.VIR_DOMAIN_SHUTOFF: 'shutoff',
+        libvirt.VIR_DOMAIN_CRASHED: 'crashed',
+        libvirt.VIR_DOMAIN_PMSUSPENDED: 'suspended',
+    }
+
+    @classmethod
+    def status(cls, templates=False):
+        """
+        Returns the status of the instances, as a list of dictionaries.
+
+        The domain state, vcpus, and memory are fetched with one
+        getAllDomainStats call per host, and joined with the metadata,
+        so the instances are not attached one by one.
+        """
+        entries = {}
+        hosts = {}
+        for name, meta in metadata_store().items():
+            if 'cloning' in meta or (not templates and 'cloned' not in meta):
+                continue
+            entries[name] = {
+                'name': name,
+                'state': 'missing',
+                'vcpus': None,
+                'memory': None,
+                'address': meta.get('address'),
+                'template': meta.get('template'),
+                'from': meta.get('from'),
+                'uri': meta.get('uri'),
+            }
+            hosts.setdefault(meta.get('uri'), set()).add(name)
+        stats = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BALLOON
+        for uri, names in hosts.items():
+            try:
+                with Connection(uri) as conn:
+                    records = conn.getAllDomainStats(stats)
+            except libvirt.libvirtError as e:
+                log.warning(f"Unable to get domain stats from '{uri or libvirt_uri}': {e}")
+                continue
+            for domain, record in records:
+                name = domain.name()
+                if name not in names:
+                    continue
+                entry = entries[name]
+                entry['state'] = cls.states.get(record.get('state.state'), 'unknown')
+                entry['vcpus'] = record.get('vcpu.current')
+                memory = record.get('balloon.current', record.get('balloon.maximum'))
+                if memory is not None:
+                    entry['memory'] = memory // 1024
+        return [entries[name] for name in sorted(entries)]
+
+    def clones(self):
+        """
+        Returns the instances cloned from this instance.
+        """
+        store = metadata_store()
+        return [Instance(name) for name in store.clones(self.name) if 'cloning' not in store.get(name)]
+
     @classmethod
-    def _domain_exists(cls, name):
+    def _domain_exists(cls, name, uri=None):
         """
         Returns true if the domain already exists.
         """
         assert(name)
         domain = None
-        with Connection() as conn:
+        with Connection(uri) as conn:
             try:
                 domain = conn.lookupByName(name)
             except libvirt.libvirtError as e:
@@ -698,10 +1803,12 @@ class Instance:
     def exists(cls, name):
         """
         Returns true if the instance already exists, that is
-        the domain and metadata file both exist.
+        the domain and metadata both exist.
         """
-        metafile = f'{virtup_data_home}/instance/{name}.json'
-        return os.path.exists(metafile) and cls._domain_exists(name)
+        meta = metadata_store().get(name)
+        if meta is None:
+            return False
+        return cls._domain_exists(name, meta.get('uri'))
 
     @classmethod
     def build(cls,
@@ -722,7 +1829,6 @@ class Instance:
         Build a base instance with virt-builder and virt-install.
         Returns the base instance if it already exists.
         """
-        _adjust_sh_log()
 
         if target:
             name = target
@@ -739,22 +1845,30 @@ class Instance:
             log.info(f"Instance '{name}' already exists.")
             return Instance(name)
 
+        started = time.monotonic()
         if settings is None:
             settings = Settings(template)
 
         maddrs = MacAddresses()
-        path = query_storage_pool(settings.pool)
-        if not os.access(path, os.R_OK | os.W_OK):
-            raise PermissionError(f"Read and write access is required for path '{path}'.")
+        uri = None
+        if settings.hosts:
+            uri = select_host(settings.hosts, memory or settings.memory, vcpus or settings.vcpus,
+                              settings.cpu_overcommit)
+        pool, path = select_storage_pool(settings.pools, settings.pool_policy, uri)
 
         image = f'{path}/{name}.{settings.image_format}'
+        if any(meta.get('disk') == image for _, meta in metadata_store().items()):
+            # The image of a refreshed base instance is kept by the retired
+            # base instance, under the old name, until its clones are deleted.
+            stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+            image = f'{path}/{name}.{stamp}.{settings.image_format}'
 
         # Sanity checks.
         if not settings.os_version:
             raise LookupError(f"virt-builder <os_version> is not defined for '{template}'.")
         if not settings.os_variant:
             raise LookupError(f"virt-install <os_variant> is not defined for '{template}'.")
-        if cls._domain_exists(name):
+        if cls._domain_exists(name, uri):
             raise FileExistsError(f"Domain '{name}' without metadata already exists.")
         if os.path.exists(image):
             raise FileExistsError(f"Image file '{image}' already exists.")
@@ -786,7 +1900,10 @@ class Instance:
         if size:
             extra_args.extend(['--size', size])
 
-        with LockFile():
+        with LockFile(name), Span('build', 'virt-builder', name, template), \
+             ToolLog(name, 'virt-builder') as tool_log:
+            if os.path.exists(image):
+                raise FileExistsError(f"Image file '{image}' already exists.")
             log.info(f"Building image file '{image}'.")
             virt_builder(
                 settings.os_version,
@@ -803,7 +1920,8 @@ class Instance:
                 '--copy-in', f"{user_creds.ssh_identity}:/home/{user_creds.username}/.ssh",
                 '--run-command', 'mkdir -p /etc/sudoers.d',
                 '--write',  f'/etc/sudoers.d/99-virt-up:{user_creds.username} ALL=(ALL) NOPASSWD: ALL',
-                *extra_args)
+                *extra_args,
+                _out=tool_log.out, _err=tool_log.err)
 
         # Setup virt-install options. Reuse the last mac address for this
         # instance so it will (hopefully) be assigned the same address.
@@ -813,8 +1931,11 @@ class Instance:
             optional_args.extend(['--mac', mac])
         if settings.network:
             optional_args.extend(['--network', settings.network])
+        if uri:
+            optional_args.extend(['--connect', uri])
         extra_args = settings.virt_install_args
-        with LockFile():
+        with Admission(name, uri, memory, vcpus, settings), Span('build', 'virt-install', name, template), \
+             ToolLog(name, 'virt-install') as tool_log:
             log.info(f"Importing instance '{name}'.")
             virt_install(
                 '--import',
@@ -826,7 +1947,8 @@ class Instance:
                 '--os-variant', settings.os_variant,
                 '--noautoconsole',
                 *optional_args,
-                *extra_args)
+                *extra_args,
+                _out=tool_log.out, _err=tool_log.err)
 
         # Attach the new domain instance and update the meta data. Save the
         # assigned mac address for next time.
@@ -838,6 +1960,7 @@ class Instance:
             'hostname': hostname,
             'disk': image,
             'image_format': settings.image_format,
+            'pool': pool,
             'memory': memory,
             'vcpus': vcpus,
             'graphics': graphics,
@@ -858,15 +1981,120 @@ class Instance:
         }
         if size:
             meta['size'] = size
-        instance = Instance(name, meta=meta)
-        maddrs.update(name, instance.mac())
-        instance.address() # Wait for address to be assigned.
+        if uri:
+            meta['uri'] = uri
+        instance = Instance(name, meta=meta, write=False)
+        with instance.transaction():
+            maddrs.update(name, instance.mac())
+            instance.address() # Wait for address to be assigned.
         Instance.update_inventory()
         if settings.template_playbook:
-            instance.run_playbook(settings.template_playbook)
-
+            with instance._span('build', 'playbook'):
+                instance.run_playbook(settings.template_playbook)
+        if settings.compact:
+            with instance._span('build', 'compact'):
+                instance.compact(settings)
+
+        instance._record('built', template)
+        Span.record('build', 'total', name, template, time.monotonic() - started)
         return instance
 
+    def _rename(self, target):
+        """
+        Rename the stopped domain and the metadata of this instance.
+        """
+        log.info(f"Renaming instance '{self.name}' to '{target}'.")
+        self.domain.rename(target, 0)
+        store = metadata_store()
+        with store.transaction():
+            store.rename(self.name, target)
+            store.set_mac(target, self.mac())
+        self.name = target
+
+    def refresh(self, settings=None, force=False):
+        """
+        Rebuild this base instance when it is older than the template
+        max-age, or when forced.
+
+        The new base instance is built under a temporary name, so new
+        clones are created from this base until the new one is ready.
+        Then this base is renamed and retired, and the new one takes its
+        name. Existing clones keep their backing file, and the retired
+        base is deleted with its last clone. Returns the new base
+        instance, or None if this base is current.
+        """
+        if self.is_clone():
+            raise ValueError(f"Instance '{self.name}' is not a base instance.")
+        if 'retired' in self.meta:
+            raise ValueError(f"Base instance '{self.name}' is retired.")
+        template = self.meta['template']
+        if settings is None:
+            settings = Settings(template)
+        created = datetime.datetime.fromisoformat(self.meta['created'])
+        age = datetime.datetime.now() - created
+        if not force and (not settings.max_age or age < datetime.timedelta(days=settings.max_age)):
+            log.debug(f"Base instance '{self.name}' is current.")
+            return None
+
+        name = self.name
+        stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        log.info(f"Refreshing base instance '{name}' of template '{template}'.")
+        new = Instance.build(
+            template,
+            target=f'{name}.{stamp}',
+            settings=settings,
+            user=self.meta['user']['username'],
+            memory=self.meta.get('memory'),
+            size=self.meta.get('size'),
+            vcpus=self.meta.get('vcpus'),
+            graphics=self.meta.get('graphics'))
+
+        # Swap the base instances.
+        new.stop()
+        self.stop()
+        store = metadata_store()
+        with LockFile(), store.transaction():
+            rm_f(self._saved_state_path())
+            self.meta.pop('saved_state', None)
+            self._update_meta({'retired': str(datetime.datetime.now())})
+            self._rename(f'{name}.retired-{stamp}')
+            try:
+                new._rename(name)
+            except Exception:
+                self.domain.rename(name, 0)
+                self.name = name
+                raise
+        self._record('retired', new.meta['disk'])
+        new._record('refreshed', self.name)
+        Instance.update_inventory()
+        Instance._delete_retired(self.name)
+        return new
+
+    @classmethod
+    def refresh_all(cls, force=False):
+        """
+        Refresh the base instances older than the max-age of their
+        templates. Returns a dictionary of the base instance names and
+        the errors which prevented them from being refreshed.
+        """
+        errors = {}
+        for name, meta in metadata_store().items():
+            if 'cloned' in meta or 'retired' in meta:
+                continue
+            try:
+                settings = Settings(meta.get('template'))
+            except LookupError as e:
+                log.debug(f"Not refreshing base instance '{name}': {e}")
+                continue
+            if not force and not settings.max_age:
+                continue
+            try:
+                Instance(name).refresh(settings, force=force)
+            except Exception as e:
+                log.error(f"Failed to refresh base instance '{name}': {e}")
+                errors[name] = e
+        return errors
+
     def clone(self,
             target,
             settings=None,
@@ -880,14 +2108,19 @@ class Instance:
             graphics=None,
             dns_domain=None,
             inventory=False,
+            snapshot=None,
+            restore=None,
+            provision=True,
             **kwargs):
         """
         Clone this instance to a new target instance.
 
         This instance will be stopped if it is running. The image will
-        be cloned and virt-sysprep'd for the new target instance.
+        be cloned and virt-sysprep'd for the new target instance. When
+        provision is false, the instance playbook and the clean snapshot
+        are left to the caller, so several clones can be provisioned at
+        once with provision().
         """
-        _adjust_sh_log()
         assert(target)
         if not valid_name(target):
             raise ValueError(f"target '{target}' contains invalid characters.")
@@ -899,6 +2132,9 @@ class Instance:
         if Instance._domain_exists(target):
             raise FileExistsError(f"Domain '{target}' without metadata already exists.")
 
+        started = time.monotonic()
+        template = self.meta.get('template')
+
         # Required meta data elements needed to clone.
         for element in ('os_version', 'os_variant', 'disk'):
             if not element in self.meta:
@@ -907,15 +2143,20 @@ class Instance:
         if settings is None:
             settings = Settings(self.meta['template'])
         maddrs = MacAddresses()
-        path = query_storage_pool(settings.pool)
-        if not os.access(path, os.R_OK | os.W_OK):
-            raise PermissionError(f"Read and write access is required for path '{path}'.")
 
         # Get default values from the current template settings.
         if not memory:
             memory = settings.memory
         if not vcpus:
             vcpus = settings.vcpus
+
+        # Place the new instance.
+        uri = None
+        if settings.hosts:
+            uri = select_host(settings.hosts, memory, vcpus, settings.cpu_overcommit)
+            if Instance._domain_exists(target, uri):
+                raise FileExistsError(f"Domain '{target}' without metadata already exists.")
+        pool, path = select_storage_pool(settings.pools, settings.pool_policy, uri)
         if not graphics:
             graphics = settings.graphics
         if dns_domain is None:
@@ -926,6 +2167,29 @@ class Instance:
             else:
                 hostname = target
 
+        # Restore from the saved state of this instance instead of booting,
+        # when enabled. The saved state has the memory size and vcpus of
+        # this instance, so the clone must too.
+        if restore is None:
+            restore = settings.restore
+        if restore:
+            if settings.image_format != 'qcow2':
+                log.warning("Not restoring from saved state; requires the qcow2 image format.")
+                restore = False
+            elif str(memory) != str(self.meta['memory']) or str(vcpus) != str(self.meta['vcpus']):
+                log.warning("Not restoring from saved state; memory and vcpus differ from the base instance.")
+                restore = False
+            elif uri != self.uri:
+                log.warning("Not restoring from saved state; the base instance is on another host.")
+                restore = False
+        if restore:
+            try:
+                with Span('clone', 'save-state', target, template):
+                    save_image = self.save_state()
+            except FileExistsError as e:
+                log.warning(f"Not restoring from saved state; {e}")
+                restore = False
+
         # Clone the image.
         source_image = self.meta['disk']
         target_image = f'{path}/{target}.{settings.image_format}'
@@ -933,142 +2197,217 @@ class Instance:
             raise FileExistsError(f"Image file '{target_image}' already exists.")
         self.stop()  # Ensure we are stopped before cloning.
 
-        with LockFile():
+        store = metadata_store()
+        with LockFile(), Span('clone', 'image', target, template), \
+             ToolLog(target, 'clone') as tool_log:
+            if (store.get(self.name) or {}).get('disk') != source_image:
+                raise LookupError(f"Base instance '{self.name}' was refreshed while cloning '{target}'.")
             log.info(f"Cloning '{source_image}' to '{target_image}'.")
             if settings.image_format == 'qcow2':
-                qemu_img.create('-f', 'qcow2', '-F', 'qcow2', '-b', source_image, target_image)
+                qemu_img.create('-f', 'qcow2', '-F', 'qcow2', '-b', source_image, target_image,
+                                _out=tool_log.out, _err=tool_log.err)
             else:
                 extra_args = settings.cp_args
-                cp(*extra_args, source_image, target_image)
-
-        # Setup credentials for new instance.
-        if not root_password:
-            root_password = Creds.generate_password(settings.password_length)
-        root_creds = Creds('root', password=root_password)
-        if not user:
-            user = settings.user
-        if not password:
-            password = Creds.generate_password(settings.password_length)
-        user_creds = Creds(user, password=password)
-
-        # Args to setup user creds in cloned instance.
-        user_args = []
-        if user_creds.username != self.meta['user']['username']:
-            user_args.extend(['--run-command', f"useradd -m -s /bin/bash {user_creds.username}"])
-        user_args.extend([
-            '--password', f"{user_creds.username}:password:{user_creds.password}",
-            '--ssh-inject', f'{user_creds.username}:file:{user_creds.ssh_identity}.pub',
-            '--copy-in', f"{user_creds.ssh_identity}:/home/{user_creds.username}/.ssh"
-        ])
-
-        # Setup virt-sysprep args.
-        extra_args = settings.virt_sysprep_args
-
-        with LockFile():
-            log.info(f"Preparing target image '{target_image}'.")
-            virt_sysprep(
-                '--quiet',
-                '--add', target_image,
-                '--operations', 'defaults,-ssh-userdir',
-                '--hostname', hostname,
-                '--root-password', f"password:{root_creds.password}",
-                *user_args,
-                *extra_args)
-
-        # Setup virt-install options. Reuse the last mac address for this
-        # instance so it will (hopefully) be assigned the same address.
-        optional_args = []
-        mac = maddrs.lookup(target)
-        if mac:
-            optional_args.extend(['--mac', mac])
-        if settings.network:
-            optional_args.extend(['--network', settings.network])
-
-        extra_args = settings.virt_install_args
+                cp(*extra_args, source_image, target_image,
+                   _out=tool_log.out, _err=tool_log.err)
+            # Reserve the target in the store until the clone is ready, so
+            # a refresh of this base renames it along with the recorded
+            # clones, and does not delete the backing file of its image.
+            reserved = {
+                'template': template,
+                'from': self.name,
+                'disk': target_image,
+                'image_format': settings.image_format,
+                'pool': pool,
+                'cloned': None,
+                'cloning': str(datetime.datetime.now()),
+            }
+            if uri:
+                reserved['uri'] = uri
+            store.put(target, reserved)
 
-        with LockFile():
-            log.info(f"Importing instance '{target}'.")
-            virt_install(
-                '--import',
-                '--name', target,
-                '--disk', target_image,
-                '--memory', memory,
-                '--vcpus', vcpus,
-                '--graphics', graphics,
-                '--os-variant', self.meta['os_variant'],
-                '--noautoconsole',
-                '--autostart',
-                *optional_args,
-                *extra_args)
+        try:
+            # Setup credentials for new instance.
+            if not root_password:
+                root_password = Creds.generate_password(settings.password_length)
+            root_creds = Creds('root', password=root_password)
+            if not user:
+                user = settings.user
+            if not password:
+                password = Creds.generate_password(settings.password_length)
+            user_creds = Creds(user, password=password)
+
+            if restore:
+                mac = maddrs.lookup(target) or random_mac()
+                with Span('clone', 'restore', target, template):
+                    self._restore_clone(save_image, target, target_image, mac,
+                                        hostname, root_creds, user_creds, settings)
+            else:
+                # Args to setup user creds in cloned instance.
+                user_args = []
+                if user_creds.username != self.meta['user']['username']:
+                    user_args.extend(['--run-command', f"useradd -m -s /bin/bash {user_creds.username}"])
+                user_args.extend([
+                    '--password', f"{user_creds.username}:password:{user_creds.password}",
+                    '--ssh-inject', f'{user_creds.username}:file:{user_creds.ssh_identity}.pub',
+                    '--copy-in', f"{user_creds.ssh_identity}:/home/{user_creds.username}/.ssh"
+                ])
+
+                # Setup virt-sysprep args.
+                extra_args = settings.virt_sysprep_args
+
+                with LockFile(target), Span('clone', 'virt-sysprep', target, template), \
+                     ToolLog(target, 'virt-sysprep') as tool_log:
+                    log.info(f"Preparing target image '{target_image}'.")
+                    virt_sysprep(
+                        '--add', target_image,
+                        '--operations', 'defaults,-ssh-userdir',
+                        '--hostname', hostname,
+                        '--root-password', f"password:{root_creds.password}",
+                        *user_args,
+                        *extra_args,
+                        _out=tool_log.out, _err=tool_log.err)
+
+                # Setup virt-install options. Reuse the last mac address for this
+                # instance so it will (hopefully) be assigned the same address.
+                optional_args = []
+                mac = maddrs.lookup(target)
+                if mac:
+                    optional_args.extend(['--mac', mac])
+                if settings.network:
+                    optional_args.extend(['--network', settings.network])
+                if uri:
+                    optional_args.extend(['--connect', uri])
+
+                extra_args = settings.virt_install_args
+
+                with Admission(target, uri, memory, vcpus, settings), Span('clone', 'virt-install', target, template), \
+                     ToolLog(target, 'virt-install') as tool_log:
+                    log.info(f"Importing instance '{target}'.")
+                    virt_install(
+                        '--import',
+                        '--name', target,
+                        '--disk', target_image,
+                        '--memory', memory,
+                        '--vcpus', vcpus,
+                        '--graphics', graphics,
+                        '--os-variant', self.meta['os_variant'],
+                        '--noautoconsole',
+                        '--autostart',
+                        *optional_args,
+                        *extra_args,
+                        _out=tool_log.out, _err=tool_log.err)
+        except BaseException:
+            self._release(target)
+            raise
 
         # Attach the new domain instance and update the meta data. Save the
         # assigned mac address for next time.
         meta = self.meta.copy()
         meta.pop('address', None)  # Remove the parent's address.
+        meta.pop('snapshot', None)
         meta['cloned'] = str(datetime.datetime.now())
         meta['from'] = self.name
         meta['hostname'] = hostname
         meta['disk'] = target_image
         meta['format'] = settings.image_format
+        meta['pool'] = pool
+        if uri:
+            meta['uri'] = uri
+        else:
+            meta.pop('uri', None)
         meta['memory'] = memory
         meta['vcpus'] = vcpus
         meta['graphics'] = graphics
         meta['root'] = vars(root_creds)
         meta['user'] = vars(user_creds)
-        instance = Instance(target, meta=meta)
-        maddrs.update(target, instance.mac())
-        instance.address() # Wait for an address to be assigned.
+        meta.pop('saved_state', None)
+        if restore:
+            meta['restored'] = save_image
+        with store.transaction():
+            # This base may have been refreshed and retired while cloning;
+            # the reserved entry was renamed with it.
+            meta['from'] = (store.get(target) or {}).get('from', self.name)
+            instance = Instance(target, meta=meta, write=False)
+            instance.meta.pop('cloning', None)
+            instance._write_meta()
+        with instance.transaction():
+            maddrs.update(target, instance.mac())
+            instance.address() # Wait for an address to be assigned.
         if inventory:
             Instance.update_inventory()
-            if settings.instance_playbook:
-                instance.run_playbook(settings.instance_playbook)
+        if provision:
+            self.provision([instance], settings, inventory=inventory, snapshot=snapshot)
 
+        instance._record('cloned', meta['from'])
+        Span.record('clone', 'total', target, template, time.monotonic() - started)
         return instance
 
+    @classmethod
+    def _release(cls, target):
+        """
+        Remove the store entry reserved for a clone which failed, and the
+        base instance if it was retired while cloning.
+        """
+        store = metadata_store()
+        with store.transaction():
+            meta = store.get(target)
+            if not meta or 'cloning' not in meta:
+                return
+            store.delete(target)
+        try:
+            Instance._delete_retired(meta['from'])
+        except Exception as e:
+            log.warning(f"Unable to delete retired base instance '{meta['from']}': {e}")
+
+    def provision(self, clones, settings=None, inventory=False, snapshot=None, forks=None):
+        """
+        Run the instance playbook on new clones of this instance with one
+        ansible-playbook run, then take the clean snapshots of the clones.
+        The playbook is run with one fork per clone, unless the forks
+        setting or argument is given.
+        """
+        if not clones:
+            return
+        if settings is None:
+            settings = Settings(self.meta['template'])
+        if inventory and settings.instance_playbook:
+            if not forks:
+                forks = settings.forks or len(clones)
+            with self._span('clone', 'playbook'):
+                Instance.run_playbook_all(clones, settings.instance_playbook, forks=forks)
+        if snapshot is None:
+            snapshot = settings.snapshot
+        if snapshot:
+            for instance in clones:
+                instance.wait_for_port(22)
+                instance.snapshot()
+
     @classmethod
     def update_inventory(cls):
         """
         Create an ansible inventory file for the cloned instances.
         """
+        from virt_up import inventory
         filename = f'{virtup_data_home}/inventory.yaml'
-        clones = {}
-        templates = {}
-        for instance in Instance.all():
-            name = instance.name
-            address = instance.meta.get('address', None)
-            if not address:
-                log.warning(f"Skipping inventory entry for instance '{name}'; address is not available.")
-                continue
-            host = {
-                'ansible_user': instance.meta['user']['username'],
-                'ansible_host': address,
-                'ansible_port': '22',
-                'ansible_private_key_file': instance.meta['user']['ssh_identity'],
-                'ansible_connection': 'ssh',
-                'ansible_ssh_common_args': ' '.join(instance._ssh_option_args()),
-            }
-            if instance.is_clone():
-                clones[name] = host
-            else:
-                templates[name] = host
-        with open(filename, 'w') as fp:
-            fp.writelines([
-                '---\n',
-                'all:\n',
-                '  children:\n',
-                '    virt_up_managed:\n',
-                '      hosts:\n'])
-            for name in clones.keys():
-                fp.write(f'        {name}:\n')
-                for key, value in clones[name].items():
-                    fp.write(f'          {key}: "{value}"\n')
+        data = inventory.inventory()
+        hostvars = data['_meta']['hostvars']
+        # Write a temporary file and rename it, so concurrent updates
+        # never leave a partially written inventory.
+        fp = io.StringIO()
+        fp.writelines([
+            '---\n',
+            'all:\n',
+            '  children:\n'])
+        for group in ('virt_up_managed', 'virt_up_templates'):
             fp.writelines([
-                '    virt_up_templates:\n',
+                f'    {group}:\n',
                 '      hosts:\n'])
-            for name in templates.keys():
+            for name in data[group]['hosts']:
                 fp.write(f'        {name}:\n')
-                for key, value in templates[name].items():
+                for key, value in hostvars[name].items():
                     fp.write(f'          {key}: "{value}"\n')
+        write_atomic(filename, fp.getvalue(), mode=0o644)
 
     def _ssh_option_args(self):
         """
@@ -1106,11 +2445,24 @@ class Instance:
         os.execv(modes[mode], args) # Drop into interactive shell, never to return.
         raise AssertionError('exec failed')
 
-    def run_command(self, *args, sudo=False):
+    def run_command(self, *args, sudo=False, transport='ssh', timeout=120):
         """
         Run a command via ssh and return the exit code, stdout,
         and stderr as a tuple.
+
+        With transport='agent' the command is run by the qemu guest agent
+        instead, which does not need the network or ssh to be up. The
+        timeout, in seconds, applies to the agent transport.
         """
+        if transport == 'agent':
+            self.wait_for_agent()
+            command = shlex.join(args)
+            if not sudo:
+                user = self.meta['user']['username']
+                return self.guest_exec('/bin/su', ['-', user, '-c', command], timeout=timeout)
+            return self.guest_exec('/bin/sh', ['-c', command], timeout=timeout)
+        if transport != 'ssh':
+            raise ValueError(f"Unsupported transport '{transport}'.")
         self.wait_for_port(22)
         address = self.address()
         user = self.meta['user']['username']
@@ -1124,12 +2476,13 @@ class Instance:
             f'{user}@{address}',
             command,
         ]
+        from virt_up.runner import ErrorReturnCode
         code = 0
         out = io.StringIO()
         err = io.StringIO()
         try:
             ssh(ssh_args, _out=out, _err=err)
-        except sh.ErrorReturnCode as e:
+        except ErrorReturnCode as e:
             code = e.exit_code
         return code, out.getvalue(), err.getvalue()
 
@@ -1137,7 +2490,16 @@ class Instance:
         """
         Run an ansible playbook on this instance.
         """
-        inventory = f'{virtup_data_home}/inventory.yaml'
+        Instance.run_playbook_all([self], playbook)
+
+    @classmethod
+    def run_playbook_all(cls, instances, playbook, forks=None):
+        """
+        Run an ansible playbook on several instances with one
+        ansible-playbook run, limited to the instances. The output is
+        written to the log of each instance.
+        """
+        inventory = shutil.which('virt-up-inventory') or f'{virtup_data_home}/inventory.yaml'
         if not ansible:
             log.error("Skipping playbook; 'ansible-playbook' command not found.")
             return
@@ -1156,10 +2518,29 @@ class Instance:
             log.error(f"Skipping playbook; '{playbook}' file not found. Searched: {searched}.")
             return
         playbook = found
-        self.wait_for_port(22)
-        address = self.address()
-        if not address:
-            log.warning(f"Skipping playbook; address for '{self.name}' is not available.")
+        ready = []
+        for instance in instances:
+            instance.wait_for_port(22)
+            if not instance.address():
+                log.warning(f"Skipping playbook; address for '{instance.name}' is not available.")
+                continue
+            ready.append(instance)
+        if not ready:
             return
-        log.info(f"Running playbook '{playbook}' on '{self.name}'.")
-        ansible('-i', inventory, '--limit', self.name, playbook)
+        names = ','.join(i.name for i in ready)
+        log.info(f"Running playbook '{playbook}' on '{names}'.")
+        optional_args = []
+        if forks:
+            optional_args.extend(['--forks', forks])
+        with contextlib.ExitStack() as stack:
+            logs = [stack.enter_context(ToolLog(i.name, 'ansible-playbook')) for i in ready]
+            def out(line):
+                logs[0].out(line) # Show the progress once.
+                for tool_log in logs[1:]:
+                    tool_log.fp.write(line)
+            def err(line):
+                logs[0].err(line)
+                for tool_log in logs[1:]:
+                    tool_log.fp.write(line)
+            ansible('-i', inventory, '--limit', names, *optional_args, playbook,
+                    _out=out, _err=err)
@@ -0,0 +1,120 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+"""
+Dynamic ansible inventory of the virt-up instances.
+
+The virt-up-inventory command implements the ansible inventory script
+protocol. The inventory is generated from the instance metadata each time
+ansible runs, so it is always current:
+
+    virt-up-inventory --list
+    virt-up-inventory --host <name>
+
+The clones are in the virt_up_managed group, and the base instances are
+in the virt_up_templates group. The clones are also grouped by template
+(template_<template>) and by base instance (base_<base>), with the
+characters which are not valid in group names replaced by underscores.
+"""
+
+import argparse
+import json
+import logging
+import re
+import sys
+
+log = logging.getLogger(__name__)
+
+def group_name(kind, name):
+    """
+    Returns a valid ansible group name for a template or base instance.
+    """
+    return f"{kind}_{re.sub(r'[^A-Za-z0-9_]', '_', name)}"
+
+def hostvars(meta):
+    """
+    Returns the ansible connection variables of an instance.
+    """
+    options = []
+    for k, v in meta.get('ssh_options', {}).items():
+        options.extend(['-o', f'{k}={v}'])
+    variables = {
+        'ansible_user': meta['user']['username'],
+        'ansible_host': meta['address'],
+        'ansible_port': '22',
+        'ansible_private_key_file': meta['user']['ssh_identity'],
+        'ansible_connection': 'ssh',
+        'ansible_ssh_common_args': ' '.join(options),
+    }
+    if meta.get('template'):
+        variables['virt_up_template'] = meta['template']
+    if meta.get('from'):
+        variables['virt_up_base'] = meta['from']
+    return variables
+
+def inventory(items=None):
+    """
+    Returns the inventory of the instances, in the format of the ansible
+    inventory script --list output. items is a list of the instance names
+    and metadata, by default read from the metadata store.
+    """
+    if items is None:
+        from virt_up.instance import metadata_store
+        items = metadata_store().items()
+    groups = {
+        'virt_up_managed': {'hosts': []},
+        'virt_up_templates': {'hosts': []},
+    }
+    variables = {}
+    for name, meta in items:
+        if 'retired' in meta or 'cloning' in meta:
+            continue
+        if not meta.get('address'):
+            log.warning(f"Skipping inventory entry for instance '{name}'; address is not available.")
+            continue
+        variables[name] = hostvars(meta)
+        if 'cloned' not in meta:
+            groups['virt_up_templates']['hosts'].append(name)
+            continue
+        groups['virt_up_managed']['hosts'].append(name)
+        for kind, key in (('template', 'template'), ('base', 'from')):
+            if meta.get(key):
+                groups.setdefault(group_name(kind, meta[key]), {'hosts': []})['hosts'].append(name)
+    groups['all'] = {'children': sorted(groups)}
+    groups['_meta'] = {'hostvars': variables}
+    return groups
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Ansible inventory of the virt-up instances.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--list', action='store_true', help='Show the inventory.')
+    group.add_argument('--host', metavar='<name>', help='Show the variables of an instance.')
+    args = parser.parse_args(argv)
+    data = inventory()
+    if args.list:
+        json.dump(data, sys.stdout, indent=4)
+    else:
+        json.dump(data['_meta']['hostvars'].get(args.host, {}), sys.stdout, indent=4)
+    sys.stdout.write('\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
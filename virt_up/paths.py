@@ -0,0 +1,49 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+"""
+Configuration, data, and runtime paths.
+
+This module does not import libvirt, so commands which only need the
+paths start quickly.
+"""
+
+import os
+
+# Environment variables
+libvirt_uri = os.environ.get('LIBVIRT_DEFAULT_URI', 'qemu:///session')
+
+virtup_config_home = os.path.expanduser(
+    os.environ.get('VIRTUP_CONFIG_HOME',
+    os.path.join(os.environ.get('XDG_CONFIG_HOME', '~/.config'), 'virt-up')))
+
+virtup_data_home = os.path.expanduser(
+    os.environ.get('VIRTUP_DATA_HOME',
+    os.path.join(os.environ.get('XDG_DATA_HOME', '~/.local/share'), 'virt-up')))
+
+def runtime_dir():
+    """
+    Directory for the lock file and daemon socket.
+    """
+    path = '/var/run/user/%d' % os.getuid()
+    if os.path.exists(path):
+        return path
+    return '/tmp'
@@ -0,0 +1,244 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+"""
+Run external commands with asyncio.
+
+The output of a command is read in chunks from the pipes by the event
+loop, without extra threads, and given line by line to the output
+callbacks, or captured when no callback is given. Several commands may be
+run at once from one thread with gather(), or from coroutines with
+Command.run_async(). The synchronous calls may be made from a thread which
+is running an event loop; the command is then run on a private event loop
+in a worker thread, and the caller is blocked until it exits.
+"""
+
+import asyncio
+import codecs
+import concurrent.futures
+import contextvars
+import io
+import logging
+import shlex
+import shutil
+
+log = logging.getLogger(__name__)
+
+# Bytes read from the output pipes at a time.
+CHUNK_SIZE = 65536
+
+class CommandNotFound(Exception):
+    """
+    The command was not found in the PATH.
+    """
+
+class ErrorReturnCode(Exception):
+    """
+    The command exited with a non-zero exit code.
+    """
+    def __init__(self, full_cmd, exit_code, stdout='', stderr=''):
+        self.full_cmd = full_cmd
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        message = f"Command '{full_cmd}' failed with exit code {exit_code}."
+        if stderr:
+            message += f"\n{stderr.rstrip()}"
+        super().__init__(message)
+
+class TimeoutException(Exception):
+    """
+    The command did not exit before the timeout, and was killed.
+    """
+    def __init__(self, full_cmd, timeout):
+        self.full_cmd = full_cmd
+        self.timeout = timeout
+        super().__init__(f"Command '{full_cmd}' timed out after {timeout} seconds.")
+
+def _flatten(args):
+    for arg in args:
+        if isinstance(arg, (list, tuple)):
+            yield from _flatten(arg)
+        else:
+            yield str(arg)
+
+def _run(coro):
+    """
+    Run a coroutine to completion. asyncio.run() cannot be called from a
+    thread with a running event loop, so the coroutine is then run on a
+    private event loop in a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(contextvars.copy_context().run, asyncio.run, coro).result()
+
+async def _pump(stream, sink, captured):
+    # Lines may be longer than the stream limit, so read in chunks, not with
+    # readline(), and join the parts of each line.
+    def emit(line):
+        if sink is None:
+            captured.write(line)
+        elif callable(sink):
+            sink(line)
+        else:
+            sink.write(line)
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    partial = []
+    while True:
+        chunk = await stream.read(CHUNK_SIZE)
+        lines = decoder.decode(chunk, final=not chunk).split('\n')
+        for line in lines[:-1]:
+            partial.append(line)
+            emit(''.join(partial) + '\n')
+            partial = []
+        if lines[-1]:
+            partial.append(lines[-1])
+        if not chunk:
+            if partial:
+                emit(''.join(partial))
+            return
+
+async def run_async(argv, out=None, err=None, input=None, timeout=None):
+    """
+    Run a command and wait for it to exit. The stdout and stderr lines are
+    given to out and err, which may be a callable or a file-like object,
+    or are captured when None. Returns the captured stdout.
+    """
+    full_cmd = shlex.join(argv)
+    log.debug(f"Running: {full_cmd}")
+    process = await asyncio.create_subprocess_exec(
+        *argv,
+        stdin=asyncio.subprocess.DEVNULL if input is None else asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=2**20)
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+
+    async def communicate():
+        if input is not None:
+            process.stdin.write(input.encode() if isinstance(input, str) else input)
+            await process.stdin.drain()
+            process.stdin.close()
+        await asyncio.gather(
+            _pump(process.stdout, out, stdout),
+            _pump(process.stderr, err, stderr))
+        return await process.wait()
+
+    try:
+        code = await asyncio.wait_for(communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise TimeoutException(full_cmd, timeout) from None
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    log.debug(f"Exit code {code}: {full_cmd}")
+    if code != 0:
+        raise ErrorReturnCode(full_cmd, code, stdout.getvalue(), stderr.getvalue())
+    return stdout.getvalue()
+
+def run(argv, **kwargs):
+    """
+    Run a command and wait for it to exit. See run_async().
+    """
+    return _run(run_async(argv, **kwargs))
+
+def gather(*calls):
+    """
+    Run several commands at once and wait for all of them. Each call is a
+    coroutine, for example from Command.run_async(). Returns the results
+    in order; exceptions are returned, not raised.
+    """
+    async def main():
+        return await asyncio.gather(*calls, return_exceptions=True)
+    return _run(main())
+
+class Command:
+    """
+    An external command which is looked up on first use.
+
+    Commands are called with the command arguments, and the options out,
+    err, input, and timeout (in seconds), prefixed with an underscore:
+
+        qemu_img('info', path, _timeout=60)
+
+    Attributes are sub-commands, for example qemu_img.create(...) runs
+    'qemu-img create ...'.
+    """
+    def __init__(self, name, out=None, err=None, timeout=None, prefix=()):
+        self.name = name
+        self.out = out
+        self.err = err
+        self.timeout = timeout
+        self.prefix = tuple(prefix)
+        self._path = None
+
+    @property
+    def path(self):
+        if self._path is None:
+            path = shutil.which(self.name)
+            if path is None:
+                raise CommandNotFound(self.name)
+            self._path = path
+        return self._path
+
+    @property
+    def __name__(self):
+        return self.path
+
+    def __bool__(self):
+        try:
+            self.path
+        except CommandNotFound:
+            return False
+        return True
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        sub = Command(self.name, self.out, self.err, self.timeout, self.prefix + (attr,))
+        sub._path = self._path
+        return sub
+
+    def _argv(self, args):
+        return [self.path, *self.prefix, *_flatten(args)]
+
+    def run_async(self, *args, _out=None, _err=None, _in=None, _timeout=None):
+        """
+        Returns a coroutine to run the command.
+        """
+        return run_async(
+            self._argv(args),
+            out=self.out if _out is None else _out,
+            err=self.err if _err is None else _err,
+            input=_in,
+            timeout=self.timeout if _timeout is None else _timeout)
+
+    def __call__(self, *args, **kwargs):
+        return _run(self.run_async(*args, **kwargs))
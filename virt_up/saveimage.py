@@ -0,0 +1,77 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+Read and replace the domain xml embedded in a libvirt qemu save image.
+
+libvirt only accepts a replacement xml for a save image when the domain
+name and uuid are unchanged, so restoring a clone from the saved state of
+its base instance requires the embedded xml to be rewritten. The save
+image starts with a fixed size header, followed by the xml and the
+migration cookie (each nul terminated and zero padded to data_len bytes),
+followed by the qemu migration stream.
+"""
+
+import struct
+
+MAGIC = b'LibvirtQemudSave'
+HEADER = struct.Struct('=16s19I') # magic, version, data_len, was_running,
+                                  # compressed, cookieOffset, unused[14]
+
+def _read(fp):
+    header = list(HEADER.unpack(fp.read(HEADER.size)))
+    if header[0] != MAGIC:
+        raise ValueError("Not a libvirt qemu save image.")
+    data_len = header[2]
+    data = fp.read(data_len)
+    if len(data) != data_len:
+        raise ValueError("Truncated libvirt qemu save image.")
+    return header, data
+
+def read_xml(path):
+    """
+    Returns the domain xml of a save image.
+    """
+    with open(path, 'rb') as fp:
+        header, data = _read(fp)
+    return data.split(b'\0', 1)[0].decode()
+
+def write_xml(path, xml):
+    """
+    Replace the domain xml of a save image in place. The new xml must fit
+    in the padding reserved by libvirt.
+    """
+    with open(path, 'r+b') as fp:
+        header, data = _read(fp)
+        data_len = header[2]
+        version = header[1]
+        cookie = b''
+        if version >= 2 and header[5]:
+            cookie = data[header[5]:].split(b'\0', 1)[0] + b'\0'
+        xml = xml.encode() + b'\0'
+        if len(xml) + len(cookie) > data_len:
+            raise ValueError(f"New xml does not fit in the save image '{path}'.")
+        if version >= 2:
+            header[5] = len(xml) if cookie else 0
+        data = xml + cookie
+        data += b'\0' * (data_len - len(data))
+        fp.seek(0)
+        fp.write(HEADER.pack(*header))
+        fp.write(data)
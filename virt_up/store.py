@@ -0,0 +1,306 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+"""
+Embedded SQLite store for the instance metadata, mac addresses, and
+lifecycle history.
+
+The store replaces the instance/*.json and macaddrs.json files, which
+are imported once when the store is created. Each thread has its own
+connection to the database, and concurrent processes are serialized by
+SQLite.
+"""
+
+import contextlib
+import datetime
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+log = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instance (
+    name TEXT PRIMARY KEY,
+    template TEXT,
+    base TEXT,
+    uri TEXT,
+    meta TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS instance_template ON instance (template);
+CREATE INDEX IF NOT EXISTS instance_base ON instance (base);
+
+CREATE TABLE IF NOT EXISTS creds (
+    instance TEXT NOT NULL REFERENCES instance (name) ON DELETE CASCADE,
+    username TEXT NOT NULL,
+    ssh_identity TEXT,
+    PRIMARY KEY (instance, username)
+);
+
+CREATE TABLE IF NOT EXISTS mac (
+    name TEXT PRIMARY KEY,
+    address TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mac_address ON mac (address);
+
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    time TEXT NOT NULL,
+    name TEXT NOT NULL,
+    event TEXT NOT NULL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS history_name ON history (name);
+"""
+
+def _now():
+    return str(datetime.datetime.now())
+
+class Store:
+    """
+    A connection to the store database.
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # The store holds the instance passwords, so the database and its
+        # -wal and -shm files are private to the user.
+        old_umask = os.umask(0o077)
+        try:
+            self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+            self.depth = 0
+            self.db.execute('PRAGMA foreign_keys = ON')
+            self.db.execute('PRAGMA journal_mode = WAL')
+            self.db.execute('PRAGMA synchronous = NORMAL')
+        finally:
+            os.umask(old_umask)
+        for f in (path, f'{path}-wal', f'{path}-shm'):
+            if os.path.exists(f):
+                os.chmod(f, 0o600)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            self._setup()
+
+    def _setup(self):
+        """
+        Create the schema and import the files of previous versions.
+        """
+        with self.transaction():
+            # Check again, now that we hold the write lock.
+            if self.db.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+                return
+            for statement in SCHEMA.split(';'):
+                if statement.strip():
+                    self.db.execute(statement)
+            self._migrate()
+            self.db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def _migrate(self):
+        data_home = os.path.dirname(self.path)
+        count = 0
+        for metafile in sorted(glob.glob(f'{data_home}/instance/*.json')):
+            name = os.path.basename(metafile)[:-len('.json')]
+            try:
+                with open(metafile) as fp:
+                    meta = json.load(fp)
+            except (OSError, ValueError) as e:
+                log.warning(f"Skipping metafile '{metafile}': {e}")
+                continue
+            self._put(name, meta)
+            self._record(name, 'migrated', metafile)
+            count += 1
+        try:
+            with open(f'{data_home}/macaddrs.json') as fp:
+                for name, address in json.load(fp).items():
+                    self.db.execute('INSERT OR REPLACE INTO mac (name, address) VALUES (?, ?)',
+                                    (name, address))
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            log.warning(f"Skipping mac addresses file: {e}")
+        if count:
+            log.info(f"Imported {count} instance metafiles into '{self.path}'.")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Nestable write transaction. Only the outermost level begins and
+        commits, or rolls back on an exception.
+        """
+        if self.depth == 0:
+            self.db.execute('BEGIN IMMEDIATE')
+        self.depth += 1
+        try:
+            yield self.db
+        except BaseException:
+            self.depth -= 1
+            if self.depth == 0:
+                self.db.execute('ROLLBACK')
+            raise
+        self.depth -= 1
+        if self.depth == 0:
+            self.db.execute('COMMIT')
+
+    # Instances.
+
+    def get(self, name):
+        """
+        Returns the metadata of an instance, or None.
+        """
+        row = self.db.execute('SELECT meta FROM instance WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _put(self, name, meta):
+        self.db.execute(
+            'INSERT OR REPLACE INTO instance (name, template, base, uri, meta, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (name, meta.get('template'), meta.get('from'), meta.get('uri'),
+             json.dumps(meta), _now()))
+        self.db.execute('DELETE FROM creds WHERE instance = ?', (name,))
+        for key in ('root', 'user'):
+            creds = meta.get(key)
+            if isinstance(creds, dict) and creds.get('username'):
+                self.db.execute(
+                    'INSERT OR REPLACE INTO creds (instance, username, ssh_identity) VALUES (?, ?, ?)',
+                    (name, creds['username'], creds.get('ssh_identity')))
+
+    def put(self, name, meta):
+        """
+        Create or replace the metadata of an instance.
+        """
+        with self.transaction():
+            self._put(name, meta)
+
+    def delete(self, name):
+        """
+        Remove an instance.
+        """
+        with self.transaction():
+            self.db.execute('DELETE FROM instance WHERE name = ?', (name,))
+
+    def rename(self, name, target):
+        """
+        Rename an instance, and the base of the instances cloned from it.
+        """
+        with self.transaction():
+            meta = self.get(name)
+            if meta is None:
+                raise LookupError(f"Instance '{name}' not found.")
+            self._put(target, meta)
+            for clone in self.clones(name):
+                clone_meta = self.get(clone)
+                clone_meta['from'] = target
+                self._put(clone, clone_meta)
+            self.db.execute('DELETE FROM instance WHERE name = ?', (name,))
+            self._record(name, 'renamed', target)
+
+    def names(self, template=None):
+        """
+        Returns the instance names, optionally only of a template.
+        """
+        if template is None:
+            rows = self.db.execute('SELECT name FROM instance ORDER BY name')
+        else:
+            rows = self.db.execute('SELECT name FROM instance WHERE template = ? ORDER BY name',
+                                   (template,))
+        return [r[0] for r in rows]
+
+    def items(self):
+        """
+        Returns the names and metadata of all of the instances.
+        """
+        rows = self.db.execute('SELECT name, meta FROM instance ORDER BY name')
+        return [(name, json.loads(meta)) for name, meta in rows]
+
+    def clones(self, base):
+        """
+        Returns the names of the instances cloned from a base instance.
+        """
+        rows = self.db.execute('SELECT name FROM instance WHERE base = ? ORDER BY name', (base,))
+        return [r[0] for r in rows]
+
+    # Mac addresses.
+
+    def mac(self, name):
+        row = self.db.execute('SELECT address FROM mac WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def mac_owner(self, address):
+        """
+        Returns the name of the instance which had the mac address, or None.
+        """
+        row = self.db.execute('SELECT name FROM mac WHERE address = ?', (address.lower(),)).fetchone()
+        return row[0] if row else None
+
+    def set_mac(self, name, address):
+        with self.transaction():
+            self.db.execute('INSERT OR REPLACE INTO mac (name, address) VALUES (?, ?)',
+                            (name, address.lower()))
+
+    def erase_mac(self, name):
+        with self.transaction():
+            self.db.execute('DELETE FROM mac WHERE name = ?', (name,))
+
+    # Lifecycle history.
+
+    def _record(self, name, event, detail=None):
+        self.db.execute('INSERT INTO history (time, name, event, detail) VALUES (?, ?, ?, ?)',
+                        (_now(), name, event, detail))
+
+    def record(self, name, event, detail=None):
+        """
+        Add a lifecycle event to the history.
+        """
+        with self.transaction():
+            self._record(name, event, detail)
+
+    def history(self, name=None):
+        """
+        Returns the lifecycle events, as (time, name, event, detail) tuples,
+        oldest first.
+        """
+        if name is None:
+            rows = self.db.execute('SELECT time, name, event, detail FROM history ORDER BY id')
+        else:
+            rows = self.db.execute('SELECT time, name, event, detail FROM history '
+                                   'WHERE name = ? ORDER BY id', (name,))
+        return list(rows)
+
+_local = threading.local()
+
+def connect(path):
+    """
+    Returns the store of the current thread for the database path.
+    """
+    stores = getattr(_local, 'stores', None)
+    if stores is None:
+        stores = _local.stores = {}
+    store = stores.get(path)
+    if store is None:
+        store = stores[path] = Store(path)
+    return store
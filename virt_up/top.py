@@ -0,0 +1,161 @@
+# Copyright (c) 2021 Sine Nomine Associates
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+"""
+Live resource monitor of the virt-up instances.
+
+The domain stats of the virt-up managed domains are sampled with one
+getAllDomainStats call per host, and the rates of each instance are
+computed over the samples kept in a fixed-size ring buffer.
+"""
+
+import collections
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# Sort keys of the table.
+columns = ('name', 'cpu', 'memory', 'read', 'write', 'rx', 'tx')
+
+def totals(record):
+    """
+    Reduce a getAllDomainStats record to the counters of interest.
+    """
+    def total(prefix, suffix):
+        count = record.get(f'{prefix}.count', 0)
+        return sum(record.get(f'{prefix}.{i}.{suffix}', 0) for i in range(count))
+    return {
+        'cpu': record.get('cpu.time', 0),
+        'read': total('block', 'rd.bytes'),
+        'write': total('block', 'wr.bytes'),
+        'rx': total('net', 'rx.bytes'),
+        'tx': total('net', 'tx.bytes'),
+        'memory': record.get('balloon.rss', record.get('balloon.current', 0)),
+    }
+
+class Monitor:
+    """
+    Per-instance ring buffers of samples.
+    """
+    def __init__(self, window=3):
+        self.window = max(window, 2)
+        self.samples = {}
+
+    def add(self, name, when, record):
+        """
+        Add a sample of an instance, taken at time when (in seconds).
+        """
+        buffer = self.samples.get(name)
+        if buffer is None:
+            buffer = self.samples[name] = collections.deque(maxlen=self.window)
+        buffer.append((when, totals(record)))
+
+    def forget(self, names):
+        """
+        Drop the instances which are not in names.
+        """
+        for name in list(self.samples):
+            if name not in names:
+                del self.samples[name]
+
+    def rates(self):
+        """
+        Returns the rates of each instance over the ring buffer: the cpu
+        usage in percent of one cpu, and the disk and network rates in
+        bytes per second, and the memory in MiB. The rates are None
+        until there are two samples at different times.
+        """
+        rates = []
+        for name, buffer in self.samples.items():
+            when, last = buffer[-1]
+            entry = {'name': name, 'memory': last['memory'] // 1024}
+            first_when, first = buffer[0]
+            elapsed = when - first_when
+            if len(buffer) < 2 or elapsed <= 0:
+                entry.update(cpu=None, read=None, write=None, rx=None, tx=None)
+            else:
+                # The counters are reset when the domain is restarted.
+                entry['cpu'] = round(max(last['cpu'] - first['cpu'], 0) / (elapsed * 1e9) * 100, 1)
+                for key in ('read', 'write', 'rx', 'tx'):
+                    entry[key] = int(max(last[key] - first[key], 0) / elapsed)
+            rates.append(entry)
+        return rates
+
+def sort(rates, key='cpu'):
+    """
+    Sort the rates by a column, largest first, and by name.
+    """
+    if key == 'name':
+        return sorted(rates, key=lambda r: r['name'])
+    return sorted(rates, key=lambda r: (-(r[key] or 0), r['name']))
+
+def sample(monitor, templates=False):
+    """
+    Sample the domain stats of the virt-up instances on each host.
+    """
+    import libvirt
+    from virt_up.instance import Connection, libvirt_uri, metadata_store
+    hosts = {}
+    for name, meta in metadata_store().items():
+        if 'cloning' not in meta and (templates or 'cloned' in meta):
+            hosts.setdefault(meta.get('uri'), set()).add(name)
+    stats = (libvirt.VIR_DOMAIN_STATS_CPU_TOTAL | libvirt.VIR_DOMAIN_STATS_BALLOON |
+             libvirt.VIR_DOMAIN_STATS_BLOCK | libvirt.VIR_DOMAIN_STATS_INTERFACE)
+    seen = set()
+    for uri, names in hosts.items():
+        try:
+            with Connection(uri) as conn:
+                records = conn.getAllDomainStats(stats, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        except libvirt.libvirtError as e:
+            log.warning(f"Unable to get domain stats from '{uri or libvirt_uri}': {e}")
+            continue
+        when = time.monotonic()
+        for domain, record in records:
+            name = domain.name()
+            if name in names:
+                monitor.add(name, when, record)
+                seen.add(name)
+    monitor.forget(seen)
+
+def human(value):
+    """
+    Format a byte rate.
+    """
+    if value is None:
+        return '-'
+    for unit in ('', 'K', 'M', 'G'):
+        if value < 1024:
+            return f'{value:.0f}{unit}'
+        value /= 1024
+    return f'{value:.0f}T'
+
+def table(rates):
+    """
+    Returns the lines of the monitor table.
+    """
+    lines = [f"{'# name': <24} {'cpu%': >6} {'mem MiB': >8} {'read/s': >8} {'write/s': >8} "
+             f"{'rx/s': >8} {'tx/s': >8}"]
+    for r in rates:
+        cpu = '-' if r['cpu'] is None else f"{r['cpu']:.1f}"
+        lines.append(f"{r['name']: <24} {cpu: >6} {r['memory']: >8} {human(r['read']): >8} "
+                     f"{human(r['write']): >8} {human(r['rx']): >8} {human(r['tx']): >8}")
+    return lines